@@ -32,6 +32,7 @@ def stop_func():
 
 class ChatUI:
     POLL_MS = 20     # 刷新周期：20 ms ≈ 50 FPS
+    COALESCE_INTERVAL = 0.016   # 模型输出回调按 16ms 合并投递，界面刷新不拖慢网络读取
 
     def __init__(self, root: tk.Tk):
         self.root = root
@@ -105,12 +106,12 @@ class ChatUI:
     # -- 向窗口追加字符（仅主线程调用） --
 
 
-    def _append(self, key: str, char: str, color: str):
+    def _append(self, key: str, text: str, color: str):
         widget: tk.Text = self.text_map[key]
         tag = f"clr_{color}"
         if tag not in widget.tag_names():
             widget.tag_config(tag, foreground=color)
-        widget.insert(tk.END, char, (tag,))
+        widget.insert(tk.END, text, (tag,))
         widget.see(tk.END)
     
     def _poll_updates(self):
@@ -119,8 +120,8 @@ class ChatUI:
             while pending_updates:
                 batch.append(pending_updates.popleft())
     
-        for win, ch, color in batch:
-            self._append(win, ch, color)
+        for win, text, color in batch:
+            self._append(win, text, color)
     
         self.root.after(self.POLL_MS, self._poll_updates)
     
@@ -128,59 +129,59 @@ class ChatUI:
 def sys_printer(msg_type, msg):
     with lock:
         if msg_type == SYS_OUTPUT_TYPE.debug:
-            pending_updates.extend(("sys1", ch, COLOR_GOLD) for ch in msg + '\n')
+            pending_updates.append(("sys1", msg + '\n', COLOR_GOLD))
         else:
-            pending_updates.extend(("sys1", ch, "red") for ch in msg + '\n')
+            pending_updates.append(("sys1", msg + '\n', "red"))
 
 
 def ai_printer(msg_type, msg):
     with lock: 
         if msg_type == AI_OUTPUT_TYPE.analyst_resp:
-            pending_updates.extend(("chat1", ch, "green") for ch in msg)
+            pending_updates.append(("chat1", msg, "green"))
         elif msg_type == AI_OUTPUT_TYPE.analyst_think:
-            pending_updates.extend(("chat1", ch, COLOR_GOLD) for ch in msg)
+            pending_updates.append(("chat1", msg, COLOR_GOLD))
         elif msg_type == AI_OUTPUT_TYPE.developer_resp:
-            pending_updates.extend(("chat2", ch, "green") for ch in msg)
+            pending_updates.append(("chat2", msg, "green"))
         elif msg_type == AI_OUTPUT_TYPE.developer_think:
-            pending_updates.extend(("chat2", ch, COLOR_GOLD) for ch in msg)
+            pending_updates.append(("chat2", msg, COLOR_GOLD))
         elif msg_type == AI_OUTPUT_TYPE.tester_resp:
-            pending_updates.extend(("chat3", ch, "green") for ch in msg)
+            pending_updates.append(("chat3", msg, "green"))
         elif msg_type == AI_OUTPUT_TYPE.tester_think:
-            pending_updates.extend(("chat3", ch, COLOR_GOLD) for ch in msg)
+            pending_updates.append(("chat3", msg, COLOR_GOLD))
 
 
 def event_callback(event, manager):
     with lock:
         if event == EVENT_CODE.question_done:
-            pending_updates.extend(("sys1", ch, "red") for ch in "问题如下\n")
-            pending_updates.extend(("sys1", ch, "green") for ch in manager.question + '\n')
+            pending_updates.append(("sys1", "问题如下\n", "red"))
+            pending_updates.append(("sys1", manager.question + '\n', "green"))
         elif event == EVENT_CODE.analyzing_done:
-            pending_updates.extend(("sys1", ch, "red") for ch in "分析如下\n")
-            pending_updates.extend(("sys1", ch, "green") for ch in manager.analysis + '\n')
+            pending_updates.append(("sys1", "分析如下\n", "red"))
+            pending_updates.append(("sys1", manager.analysis + '\n', "green"))
         elif event == EVENT_CODE.developing_done:
-            pending_updates.extend(("sys1", ch, "red") for ch in "代码如下\n")
-            pending_updates.extend(("sys1", ch, "green") for ch in manager.code + '\n')
+            pending_updates.append(("sys1", "代码如下\n", "red"))
+            pending_updates.append(("sys1", manager.code + '\n', "green"))
         elif event == EVENT_CODE.test_developing_done:
-            pending_updates.extend(("sys1", ch, "red") for ch in "测试代码如下\n")
-            pending_updates.extend(("sys1", ch, "green") for ch in manager.test_code + '\n')
+            pending_updates.append(("sys1", "测试代码如下\n", "red"))
+            pending_updates.append(("sys1", manager.test_code + '\n', "green"))
         elif event == EVENT_CODE.testing_done:
-            pending_updates.extend(("sys1", ch, "red") for ch in "测试结果如下\n")
-            pending_updates.extend(("sys1", ch, "green") for ch in manager.test_res + '\n')
+            pending_updates.append(("sys1", "测试结果如下\n", "red"))
+            pending_updates.append(("sys1", manager.test_res + '\n', "green"))
         elif event == EVENT_CODE.reporting_done:
-            pending_updates.extend(("sys1", ch, "red") for ch in "报告如下\n")
-            pending_updates.extend(("sys1", ch, "green") for ch in manager.report + '\n')
+            pending_updates.append(("sys1", "报告如下\n", "red"))
+            pending_updates.append(("sys1", manager.report + '\n', "green"))
         elif event == EVENT_CODE.repairing_done:
-            pending_updates.extend(("sys1", ch, "red") for ch in "修复如下\n")
-            pending_updates.extend(("sys1", ch, "green") for ch in manager.code + '\n')
+            pending_updates.append(("sys1", "修复如下\n", "red"))
+            pending_updates.append(("sys1", manager.code + '\n', "green"))
         elif event == EVENT_CODE.done:
-            pending_updates.extend(("sys1", ch, "red") for ch in "测试结果如下\n")
-            pending_updates.extend(("sys1", ch, "green") for ch in manager.test_res + '\n')
-            pending_updates.extend(("sys1", ch, "red") for ch in "开发完成！\n")
+            pending_updates.append(("sys1", "测试结果如下\n", "red"))
+            pending_updates.append(("sys1", manager.test_res + '\n', "green"))
+            pending_updates.append(("sys1", "开发完成！\n", "red"))
             
 
 def error_printer(msg: str):
     with lock:
-        pending_updates.extend(("sys2", ch, "red") for ch in msg + '\n')
+        pending_updates.append(("sys2", msg + '\n', "red"))
     
 
 def ai_worker():
@@ -194,6 +195,7 @@ def ai_worker():
     model_analyst = "deepseek-v3"
     model_developer = "deepseek-v3"
     model_tester = "deepseek-v3"
+    http_pool = HttpClientPool(max_connections=16) # 三个角色共享连接，复位后继续复用
     
     while True:
         global stopped
@@ -201,26 +203,35 @@ def ai_worker():
         input_event.clear()
         step_event.clear()
         stopped = False
+        if manager is not None:
+            manager.close()
         analyst = OpenAISession(
             base_url="https://api.lkeap.cloud.tencent.com/v1",
             api_key=token,
             model=model_analyst,
+            http_pool=http_pool,
+            coalesce_interval=ChatUI.COALESCE_INTERVAL,
             extra_params={"temperature": 0.4}
         )
         developer = OpenAISession(
             base_url="https://api.lkeap.cloud.tencent.com/v1",
             api_key=token,
             model=model_developer,
+            http_pool=http_pool,
+            coalesce_interval=ChatUI.COALESCE_INTERVAL,
             extra_params={"temperature": 0.4}
         )
         tester = OpenAISession(
             base_url="https://api.lkeap.cloud.tencent.com/v1",
             api_key=token,
             model=model_tester,
+            http_pool=http_pool,
+            coalesce_interval=ChatUI.COALESCE_INTERVAL,
             extra_params={"temperature": 0.4}
         )
         manager = CodingManager(analyst=analyst, developer=developer, tester=tester,
-                                sys_output_callback=sys_printer, ai_output_callback=ai_printer, event_callback=event_callback)
+                                sys_output_callback=sys_printer, ai_output_callback=ai_printer, event_callback=event_callback,
+                                prefetch=True) # 点击“下一步”前已在后台开始生成（运行测试除外）
         
 
         while not stopped:
@@ -121,9 +121,11 @@ def main():
     sys_output_callback：系统输出回调，用于传递系统信息
     ai_output_callback：模型输出回调，采用流式输出，用于输出ai的思考和输出原始内容
     event_callback：事件回调，传递系统事件
+    prefetch：每一步完成后立即在后台开始下一步的模型对话，等待用户按Enter时不再空闲；运行测试总是在按Enter之后才执行
     """
     manager = CodingManager(analyst=analyst, developer=developer, tester=tester,
-                            sys_output_callback=sys_printer, ai_output_callback=ai_printer, event_callback=event_callback)
+                            sys_output_callback=sys_printer, ai_output_callback=ai_printer, event_callback=event_callback,
+                            prefetch=True)
     
 
 
@@ -141,8 +143,8 @@ def main():
 
     """
     调用step()开始下一步开发操作，注意step是同步阻塞调用，返回False表示没有完成开发，还需要进行下一步，如果返回True表示开发成功或者被中断
-    调用stop()可以中断开发并使step返回True或者抛出GenerationInterrupted，所以谨慎调用stop()（因为没有实现线程安全），
-    如果因为网络中断造成生成卡住，调用stop()并不会让step()立即返回（因为没有使用异步IO）。
+    调用stop()可以中断开发并使step返回True或者抛出GenerationInterrupted，可以在其他线程调用，
+    即使因为网络中断造成生成卡住，stop()也会直接关闭底层连接，step()在毫秒级内返回（session.cancel_latency记录实际耗时）。
     """
     while not manager.step():
         input("按Enter下一步")
@@ -156,7 +158,9 @@ def main():
     DevelopRefused：开发被拒绝，通常因为需求不合理
     GenrationInterrupted：生成被打断，如果调用模型正在生成，调用stop()，step()就会抛出这个异常，
     其他类型异常：可能因为文件操作异常，网络错误，api请求超时（60s）等等
-    除了第一种异常，其他异常均无法继续开发过程，manager实例也处于无效状态，不能再调用step，一切需要重新开始
+    网络错误（429、5xx、连接重置、读超时）会按RetryPolicy自动退避重试，重试次数用完才抛出RuntimeError，
+    此时失败的这一轮不会留在历史中，可以再次调用step重试这一步；
+    DevelopConflict、DevelopRefused、GenerationInterrupted无法继续开发过程，manager实例处于无效状态，一切需要重新开始
     """
 
     """
@@ -1,6 +1,23 @@
 from .api_session import OpenAISession
+from .async_session import AsyncOpenAISession
+from .http_pool import HttpClientPool
+from .message_log import MessageLog, MessageSnapshot
+from .payload_writer import PayloadWriter
+from .transcript_store import TranscriptStore, TranscriptReader
+from .response_cache import ResponseCache
+from .cassette import Cassette, CassetteMiss
+from .compaction import SlidingWindow, PinFirstTurn, SummarizeOlder
+from .tokenizer import TokenizerService, PromptTooLarge
+from .latency import LatencyRecord, LatencyStats
+from .hedging import HedgePolicy
+from .provider_pool import ProviderPool, Endpoint
+from .rate_limiter import RateLimiter, limiter_for
+from .fence_parser import FenceParser
+from .workspace import Workspace
+from .checkpoint import Checkpoint
 from .dependency_resolver import DependencyResolver
-from .coding_manager import CodingManager
+from .coding_manager import CodingManager, RunResult
+from .batch import BatchRunner, session_factory
 from .utils import *
 
-__all__ = ["OpenAISession", "DependencyResolver", "CodingManager", "extract_code", "save", "check_syntax"]
+__all__ = ["OpenAISession", "AsyncOpenAISession", "HttpClientPool", "MessageLog", "MessageSnapshot", "PayloadWriter", "TranscriptStore", "TranscriptReader", "ResponseCache", "Cassette", "CassetteMiss", "SlidingWindow", "PinFirstTurn", "SummarizeOlder", "TokenizerService", "PromptTooLarge", "LatencyRecord", "LatencyStats", "HedgePolicy", "ProviderPool", "Endpoint", "RateLimiter", "limiter_for", "FenceParser", "Workspace", "Checkpoint", "DependencyResolver", "CodingManager", "RunResult", "BatchRunner", "session_factory", "extract_code", "save", "check_syntax"]
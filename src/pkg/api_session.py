@@ -1,15 +1,25 @@
 from __future__ import annotations
-import json, time
+import time, threading
 from pathlib import Path
 from typing import List, Dict, Optional, Callable
 import httpx, openai                 #openai >= 1.12
 from openai import OpenAIError
+from .http_pool import HttpClientPool
+from .payload_writer import PayloadWriter
+from .message_log import MessageLog
+from .response_cache import ResponseCache
+from .cassette import Cassette
+from .retry import RetryPolicy, PartialStream
+from .rate_limiter import RateLimiter
+from .compaction import CompactionPolicy
+from .tokenizer import TokenizerService, PromptTooLarge
+from .latency import StreamTimer, LatencyRecord, LatencyStats
+from .provider_pool import ProviderPool, Endpoint
+from .hedging import HedgePolicy, HedgedStream
+from .cancel import CancelScope
+from .session_core import SessionCore, StreamReader, GenerationInterrupted, parse_usage
 
-class GenerationInterrupted(Exception):
-    """手动中断生成时抛出"""
-    pass
-
-class OpenAISession:
+class OpenAISession(SessionCore):
     def __init__(
         self,
         api_key: str,
@@ -20,39 +30,71 @@ class OpenAISession:
         system_as_user: bool = True,
         trust_env: bool = False,
         extra_params: Optional[Dict] = None,
+        http_pool: Optional[HttpClientPool] = None,
+        warm_up: bool = True,
+        capture_payloads: bool = True,
+        payload_writer: Optional[PayloadWriter] = None,
+        cache: Optional[ResponseCache] = None,
+        cassette: Optional[Cassette] = None,
+        retry_policy: Optional[RetryPolicy] = None,
+        on_retry: Optional[Callable[[int, Exception, float], None]] = None,
+        compaction: Optional[CompactionPolicy] = None,
+        tokenizer: Optional[TokenizerService] = None,
+        context_window: Optional[int] = None,
+        role: str = "",
+        on_latency: Optional[Callable[[LatencyRecord], None]] = None,
+        latency_stats: Optional[LatencyStats] = None,
+        hedge: Optional[HedgePolicy] = None,
+        provider_pool: Optional[ProviderPool] = None,
+        rate_limiter: Optional[RateLimiter] = None,
+        coalesce_interval: Optional[float] = None,
+        coalesce_chars: int = 4096,
     ):
-        # 禁用系统代理
-        httpx_client = httpx.Client(trust_env=trust_env, timeout=timeout)
-        self.client = openai.OpenAI(
-            http_client=httpx_client,
+        super().__init__(api_key, base_url, model, timeout, max_tokens, system_as_user, trust_env, extra_params,
+                         http_pool, capture_payloads, payload_writer, cache, cassette, retry_policy, on_retry,
+                         compaction, tokenizer, context_window, role, on_latency, latency_stats, hedge,
+                         provider_pool, rate_limiter, coalesce_interval, coalesce_chars)
+        if warm_up and not (cassette is not None and cassette.offline):
+            for url in self._warm_up_urls():
+                self._pool.warm_up(url)
+        self._stop_event = threading.Event()
+        # stop() 通过它直接关闭正在进行的连接；cancel_latency 为最近一次从 stop() 到 send 返回的秒数
+        self._cancel = CancelScope()
+
+    def _new_client(self, base_url: str, api_key: str):
+        return openai.OpenAI(
+            http_client=self._pool.get(base_url),
             base_url=base_url,
             api_key=api_key,
-            timeout=timeout
+            timeout=self._timeout,
+            max_retries=0,      # 由 RetryPolicy 统一重试
         )
-        self.model = model
-        self.max_tokens = max_tokens
-        self.system_as_user = system_as_user
-        self.extra = extra_params or {}
-        self.history: List[Dict[str, str]] = []
-        self._stop = False
-
-        Path("debug_payloads").mkdir(exist_ok=True)
-
-    def set_sys_prompt(self, prompt):
-        if not self.history:
-            if self.system_as_user:
-                self.history.append({"role": "user", "content": prompt})
-            else:
-                self.history.append({"role": "system", "content": prompt})
-
-        else:
-            raise ValueError("设置系统提示词失败：历史不为空")
-    
+
+    def fork(self) -> OpenAISession:
+        """
+        复制出一个独立的会话，O(1)：共享父会话不可变的历史前缀（不拷贝消息）、连接池、缓存、分词器和统计汇总，
+        之后两者各自追加互不影响。适合从同一状态尝试多种修复，或重试某一轮。
+        不能在 send 进行中调用。
+        """
+        child = self._fork()
+        child._stop_event = threading.Event()
+        child._cancel = CancelScope()
+        # 连接池按引用计数归还，子会话单独持有引用
+        self._pool.get(self.base_url)
+        if self._hedge_client is not None:
+            self._pool.get(self._hedge_base_url)
+        for base_url, _ in child._endpoint_clients:
+            self._pool.get(base_url)
+        return child
+
     def stop(self):
         """
-        手动中断当前 send 生成过程。
+        手动中断当前 send 生成过程，可以在任意线程调用。
+        正在等待响应头或读取流的请求会被立即放弃（关闭底层连接），send 在毫秒级内抛出 GenerationInterrupted。
         """
         self._stop = True
+        self._stop_event.set()
+        self._cancel.cancel()
 
     def send(
         self,
@@ -63,94 +105,170 @@ class OpenAISession:
         on_chunk: Optional[Callable[[str], None]] = None,
     ) -> Dict[str, int]:
         """流式模式：回答→on_resp，思考链→on_think；两者均推给 on_chunk"""
+        started = time.perf_counter()
+        try:
+            return self._dispatch_send(user_input, on_resp, on_think, on_chunk)
+        except GenerationInterrupted:
+            stopped_at = self._cancel.cancelled_at
+            if stopped_at is not None and stopped_at >= started:
+                self.cancel_latency = time.perf_counter() - stopped_at
+            raise
+
+    def _dispatch_send(self, user_input, on_resp, on_think, on_chunk) -> Dict[str, int]:
+        dispatcher = self._dispatcher(on_resp, on_think, on_chunk)
+        if dispatcher is None:
+            return self._send(user_input, on_resp, on_think, on_chunk)
+
+        # 回调交给投递线程按批次合并执行，网络读取不受慢回调影响
+        try:
+            usage = self._send(user_input,
+                               lambda t: dispatcher.put("resp", t),
+                               lambda t: dispatcher.put("think", t),
+                               None)
+        except BaseException:
+            dispatcher.close(raise_error=False)
+            raise
+        dispatcher.close()
+        return usage
+
+    def _send(self, user_input, on_resp, on_think, on_chunk) -> Dict[str, int]:
         # 重置中断标志
         if self._stop:
             self._self_destruct()
             raise GenerationInterrupted("已手动终止生成")
 
-        # 累积上下文
-        self.history.append({"role": "user", "content": user_input})
-        history_copy = json.loads(json.dumps(self.history, ensure_ascii=False))
-
-        # 构建请求
-        request_kwargs = {
-            "model": self.model,
-            "messages": history_copy,
-            "stream": True,
-            "max_tokens": self.max_tokens,
-            "stream_options": {"include_usage": True},
-            **self.extra,
-        }
-
-        # 写调试 payload
-        payload_file = f"debug_payloads/payload_{int(time.time()*1000)}.json"
-        try:
-            p = Path(payload_file)
-            if not p.parent.exists(): p.parent.mkdir(parents=True)
-            p.write_text(
-                json.dumps(request_kwargs, ensure_ascii=False, indent=2),
-                encoding="utf-8"
-            )
-        except Exception as e:
-            print(f"无法写调试文件: {e}")
-
-        usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
-        answer_parts: List[str] = []
+        self._finish_early = False
+        # 命中缓存或回放时不产生延迟记录
+        timer = StreamTimer()
+        self.last_latency = None
+        request_kwargs, prompt_tokens, max_tokens = self._prepare(user_input)
 
+        # 回放 cassette 或命中缓存时按原始分块重放，不发起请求
+        key, replay, pacer = self._lookup(request_kwargs)
+        if replay is not None:
+            events, usage = replay
+            final_answer = self._replay(events, on_resp, on_think, on_chunk, pacer)
+            self.history.append({"role": "assistant", "content": final_answer})
+            return usage
+        # 失败重试；同一轮最终失败时回退历史，不留痕迹，会话仍可继续使用
+        history_len = len(self.history) - 1
+        partial = PartialStream()
+        attempt = 0
+        tried: List[Endpoint] = []
+        self.retry_stats["requests"] += 1
+        while True:
+            events = self._new_events(key)
+            endpoint = self._pick(tried)
+            permit = None
+            try:
+                # tpm 按 prompt + max_tokens 预留，结束后按实际用量退回
+                permit = self._acquire(endpoint, prompt_tokens + max_tokens)
+                usage, final_answer, reasoning = self._stream_once(request_kwargs, partial, events, timer, endpoint,
+                                                                   on_resp, on_think, on_chunk)
+                self._attempt_succeeded(permit, endpoint, timer, usage)
+                break
+            except GenerationInterrupted:
+                self._attempt_cancelled(permit, endpoint)
+                self._self_destruct()
+                raise
+            except Exception as e:
+                self._attempt_failed(permit, endpoint, e, tried)
+                if self._stop:
+                    self._self_destruct()
+                    raise GenerationInterrupted("已手动中断生成") from e
+                delay = self._retry_delay(attempt, e, endpoint, tried, history_len)
+                if delay is None:
+                    if isinstance(e, OpenAIError):
+                        raise RuntimeError(f"OpenAI API 错误: {e}") from e
+                    raise
+                # 等待期间 stop() 可立即唤醒
+                if self._stop_event.wait(delay):
+                    self._self_destruct()
+                    raise GenerationInterrupted("已手动中断生成") from e
+                attempt += 1
+                partial.restart()
+
+        return self._finish(request_kwargs, usage, final_answer, reasoning, prompt_tokens, timer, endpoint, key, events)
+
+    def _stream_once(self, request_kwargs, partial, events, timer, endpoint, on_resp, on_think, on_chunk):
+        """发起一次流式请求，返回 (usage, 完整回答, 思考链)；重试时已输出过的前缀不再推给回调"""
+        reader = StreamReader(partial, events, timer, on_resp, on_think, on_chunk)
+
+        # 发起流式请求
+        # 在辅助线程中等待响应头，stop() 可以立即放弃
+        stream_iter = self._cancel.open(lambda: self._open_stream(request_kwargs, endpoint))
+        timer.connected()
+        self._opened(stream_iter)
+        # 提前退出（异常、中断）时立即关闭这个流
+        chunks = self._cancel.iterate(stream_iter)
         try:
-            # 发起流式请求
-            stream_iter = self.client.chat.completions.create(**request_kwargs)
-            for chunk in stream_iter:
+            for chunk in chunks:
                 # 检查中断
                 if self._stop:
                     raise GenerationInterrupted("已手动中断生成")
+                reader.feed(chunk)
+                # 调用方已经拿到需要的内容（如代码块已结束），不再等待后面的输出
+                if self._finish_early:
+                    break
+        finally:
+            chunks.close()
+        if self._stop:
+            raise GenerationInterrupted("已手动中断生成")
 
-                if not chunk.choices:
-                    continue
-
-                delta = chunk.choices[0].delta
-
-                # 处理思考链
-                rc = getattr(delta, "reasoning_content", None)
-                if rc:
-                    if on_think: on_think(rc)
-                    if on_chunk: on_chunk(rc)
-
-                # 处理回答
-                cc = getattr(delta, "content", None)
-                if cc:
-                    if on_resp: on_resp(cc)
-                    if on_chunk: on_chunk(cc)
-                    answer_parts.append(cc)
-
-                fr = getattr(chunk.choices[0], "finish_reason", None)
-                if fr and fr != "stop":
-                    raise RuntimeError(f"生成被意外中断，finish_reason={fr}")
-
-                # 最后一个 chunk 带 usage
-                if hasattr(chunk, "usage") and chunk.usage:
-                    usage = {
-                        "prompt_tokens": chunk.usage.prompt_tokens,
-                        "completion_tokens": chunk.usage.completion_tokens,
-                        "total_tokens": chunk.usage.total_tokens,
-                    }
-
-        except OpenAIError as e:
-            self._self_destruct()
-            raise RuntimeError(f"OpenAI API 错误: {e}") from e
-        except Exception:
-            # 其它异常自毁并抛出
-            self._self_destruct()
-            raise
+        return reader.result()
 
-        # 拼接并保存历史
-        final_answer = "".join(answer_parts)
-        self.history.append({"role": "assistant", "content": final_answer})
-        #print(f"\nToken Usage: {usage}")
-        return usage
+    def _acquire(self, endpoint, tokens):
+        """按端点或会话的限流器排队，排队期间 stop() 可立即打断"""
+        limiter = self._limiter_for(endpoint)
+        if limiter is None:
+            return None
+        permit = limiter.acquire(tokens, self.owner, self._stop_event)
+        if permit is None:
+            raise GenerationInterrupted("已手动中断生成")
+        return permit
+
+    def _open_stream(self, request_kwargs, endpoint=None):
+        client, request_kwargs = self._route(request_kwargs, endpoint)
+        if self._hedge is None:
+            return client.chat.completions.create(**request_kwargs)
+        secondary_kwargs = self._hedge_kwargs(request_kwargs)
+        return HedgedStream(lambda: client.chat.completions.create(**request_kwargs),
+                            lambda: self._hedge_client.chat.completions.create(**secondary_kwargs),
+                            self._hedge, self._stop_event)
+
+    def _replay(self, events, on_resp, on_think, on_chunk, pacer=None) -> str:
+        """把记录的 (类型, 文本[, 相对时间]) 分块依次推给回调，返回完整回答；pacer 控制回放节奏"""
+        answer_parts: List[str] = []
+        start = time.perf_counter()
+        for kind, text, *offset in events:
+            if self._stop:
+                raise GenerationInterrupted("已手动中断生成")
+            if pacer is not None and offset:
+                wait = pacer.delay(offset[0], start)
+                if wait > 0: time.sleep(wait)
+            self._replay_event(kind, text, answer_parts, on_resp, on_think, on_chunk)
+        return "".join(answer_parts)
+
+    def close(self):
+        """归还连接池引用；连接本身由连接池管理，不会被关闭"""
+        if getattr(self, "_pool", None) is not None:
+            self._pool.release(self.base_url)
+            if self._hedge_client is not None:
+                self._pool.release(self._hedge_base_url)
+            for base_url, _ in self._endpoint_clients:
+                self._pool.release(base_url)
+            self._endpoint_clients.clear()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
     def _self_destruct(self):
         """删除自身以防重复使用"""
+        self.close()
         try:
             del self.history
             del self.client
@@ -0,0 +1,363 @@
+from __future__ import annotations
+import time, asyncio
+from collections import deque
+from typing import Deque, List, Dict, Optional, Callable
+import httpx, openai                 #openai >= 1.12
+from openai import OpenAIError
+from .http_pool import HttpClientPool
+from .payload_writer import PayloadWriter
+from .response_cache import ResponseCache
+from .cassette import Cassette
+from .retry import RetryPolicy, PartialStream
+from .rate_limiter import RateLimiter
+from .compaction import CompactionPolicy
+from .tokenizer import TokenizerService
+from .latency import StreamTimer, LatencyRecord, LatencyStats
+from .provider_pool import ProviderPool, Endpoint
+from .hedging import HedgePolicy, AsyncHedgedStream
+from .session_core import SessionCore, StreamReader, GenerationInterrupted
+
+# close() 在事件循环中调度的关闭任务，保持引用直到完成
+_closing = set()
+
+class AsyncOpenAISession(SessionCore):
+    """
+    OpenAISession 的 asyncio 版本，接口保持一致（set_sys_prompt/send/stop/subscribe/回调）。
+    基于 httpx.AsyncClient 和 openai.AsyncOpenAI，一个事件循环即可并发驱动多个会话。
+    """
+    def __init__(
+        self,
+        api_key: str,
+        base_url: str = "https://api.openai.com",
+        model: str = "gpt-4o",
+        timeout: int = 60,
+        max_tokens: int = 8192,
+        system_as_user: bool = True,
+        trust_env: bool = False,
+        extra_params: Optional[Dict] = None,
+        http_pool: Optional[HttpClientPool] = None,
+        warm_up: bool = True,
+        capture_payloads: bool = True,
+        payload_writer: Optional[PayloadWriter] = None,
+        cache: Optional[ResponseCache] = None,
+        cassette: Optional[Cassette] = None,
+        retry_policy: Optional[RetryPolicy] = None,
+        on_retry: Optional[Callable[[int, Exception, float], None]] = None,
+        compaction: Optional[CompactionPolicy] = None,
+        tokenizer: Optional[TokenizerService] = None,
+        context_window: Optional[int] = None,
+        role: str = "",
+        on_latency: Optional[Callable[[LatencyRecord], None]] = None,
+        latency_stats: Optional[LatencyStats] = None,
+        hedge: Optional[HedgePolicy] = None,
+        provider_pool: Optional[ProviderPool] = None,
+        rate_limiter: Optional[RateLimiter] = None,
+        coalesce_interval: Optional[float] = None,
+        coalesce_chars: int = 4096,
+    ):
+        # 异步客户端按当前事件循环复用，不在事件循环中创建时为会话私有，见 HttpClientPool.get_async
+        self._http_clients: List[httpx.AsyncClient] = []
+        super().__init__(api_key, base_url, model, timeout, max_tokens, system_as_user, trust_env, extra_params,
+                         http_pool, capture_payloads, payload_writer, cache, cassette, retry_policy, on_retry,
+                         compaction, tokenizer, context_window, role, on_latency, latency_stats, hedge,
+                         provider_pool, rate_limiter, coalesce_interval, coalesce_chars)
+        self._task: Optional[asyncio.Task] = None
+        # 最近一次从 stop() 到 send 返回的秒数
+        self._stop_at: Optional[float] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        # 合并投递时为 (投递器, 队列满时暂存的分块)
+        self._backlog = None
+
+        # 在事件循环中创建时后台预热连接
+        if warm_up and not (cassette is not None and cassette.offline):
+            try:
+                loop = asyncio.get_running_loop()
+                for url in self._warm_up_urls():
+                    loop.create_task(self._pool.awarm_up(url))
+            except RuntimeError:
+                pass
+
+    def _new_client(self, base_url: str, api_key: str):
+        self._http_clients.append(self._pool.get_async(base_url))
+        return openai.AsyncOpenAI(
+            http_client=self._http_clients[-1],
+            base_url=base_url,
+            api_key=api_key,
+            timeout=self._timeout,
+            max_retries=0,      # 由 RetryPolicy 统一重试
+        )
+
+    def fork(self) -> AsyncOpenAISession:
+        """
+        复制出一个独立的会话，O(1)：共享父会话不可变的历史前缀（不拷贝消息）、连接池、缓存、分词器和统计汇总，
+        之后两者各自追加互不影响。适合从同一状态尝试多种修复，或重试某一轮。
+        不能在 send 进行中调用。
+        """
+        child = self._fork()
+        child._task = None
+        child._loop = None
+        child._backlog = None
+        child._stop_at = None
+        # 连接池按引用计数归还，子会话对同一批客户端单独持有引用
+        child._http_clients = list(self._http_clients)
+        for c in child._http_clients:
+            self._pool.retain_async(c)
+        return child
+
+    def stop(self):
+        """
+        手动中断当前 send 生成过程，并取消正在进行的请求任务。
+        可以在任意线程调用。
+        """
+        self._stop = True
+        self._stop_at = time.perf_counter()
+        task, loop = self._task, self._loop
+        if task is None or task.done() or loop is None:
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            task.cancel()
+        else:
+            loop.call_soon_threadsafe(task.cancel)
+
+    async def send(
+        self,
+        user_input: str,
+        *,
+        on_resp: Optional[Callable[[str], None]] = None,
+        on_think: Optional[Callable[[str], None]] = None,
+        on_chunk: Optional[Callable[[str], None]] = None,
+    ) -> Dict[str, int]:
+        """流式模式：回答→on_resp，思考链→on_think；两者均推给 on_chunk"""
+        if self._stop:
+            await self._self_destruct()
+            raise GenerationInterrupted("已手动终止生成")
+
+        if self._task is not None and not self._task.done():
+            raise RuntimeError("同一会话不能并发调用 send")
+
+        # 在独立任务中生成，stop() 取消该任务即可立即中断网络读取
+        started = time.perf_counter()
+        self._loop = asyncio.get_running_loop()
+        self._task = asyncio.ensure_future(self._dispatch_send(user_input, on_resp, on_think, on_chunk))
+        try:
+            return await asyncio.shield(self._task)
+        except asyncio.CancelledError:
+            # 外部取消 send 时一并取消生成任务，并等它回退本轮历史后再返回
+            if not self._task.done():
+                self._task.cancel()
+                await asyncio.wait([self._task])
+            if self._stop:
+                if self._stop_at is not None and self._stop_at >= started:
+                    self.cancel_latency = time.perf_counter() - self._stop_at
+                await self._self_destruct()
+                raise GenerationInterrupted("已手动中断生成")
+            raise
+
+    async def _dispatch_send(self, user_input, on_resp, on_think, on_chunk) -> Dict[str, int]:
+        dispatcher = self._dispatcher(on_resp, on_think, on_chunk)
+        if dispatcher is None:
+            return await self._generate(user_input, on_resp, on_think, on_chunk)
+
+        # 回调交给投递线程按批次合并执行。事件循环线程上只做不阻塞的 put，队列满时先暂存，
+        # 读取下一个分块前在线程中等待投递（背压），慢的消费者不会卡住其他协程
+        backlog: Deque = deque()
+        self._backlog = (dispatcher, backlog)
+
+        def put(kind, text):
+            if backlog or not dispatcher.put_nowait(kind, text):
+                backlog.append((kind, text))
+        try:
+            usage = await self._generate(user_input, lambda t: put("resp", t), lambda t: put("think", t), None)
+            await self._drain()
+        except BaseException:
+            await asyncio.to_thread(dispatcher.close, False)
+            raise
+        finally:
+            self._backlog = None
+        await asyncio.to_thread(dispatcher.close)
+        return usage
+
+    async def _drain(self):
+        """把暂存的分块交给投递器，在线程中阻塞等待队列空位"""
+        if self._backlog is None:
+            return
+        dispatcher, backlog = self._backlog
+        while backlog:
+            kind, text = backlog.popleft()
+            await asyncio.to_thread(dispatcher.put, kind, text)
+
+    async def _generate(self, user_input, on_resp, on_think, on_chunk) -> Dict[str, int]:
+        self._finish_early = False
+        # 命中缓存或回放时不产生延迟记录
+        timer = StreamTimer()
+        self.last_latency = None
+        request_kwargs, prompt_tokens, max_tokens = self._prepare(user_input)
+        # 同一轮最终失败或被外部取消（如 arun 的阶段超时）时回退历史，不留痕迹，会话仍可继续使用
+        history_len = len(self.history) - 1
+        try:
+            # 回放 cassette 或命中缓存时按原始分块重放，不发起请求
+            key, replay, pacer = self._lookup(request_kwargs)
+            if replay is not None:
+                events, usage = replay
+                final_answer = await self._replay(events, on_resp, on_think, on_chunk, pacer)
+                self.history.append({"role": "assistant", "content": final_answer})
+                return usage
+            # 失败重试
+            partial = PartialStream()
+            attempt = 0
+            tried: List[Endpoint] = []
+            self.retry_stats["requests"] += 1
+            while True:
+                events = self._new_events(key)
+                endpoint = self._pick(tried)
+                permit = None
+                try:
+                    # tpm 按 prompt + max_tokens 预留，结束后按实际用量退回
+                    permit = await self._acquire(endpoint, prompt_tokens + max_tokens)
+                    usage, final_answer, reasoning = await self._stream_once(request_kwargs, partial, events, timer,
+                                                                             endpoint, on_resp, on_think, on_chunk)
+                    self._attempt_succeeded(permit, endpoint, timer, usage)
+                    break
+                except (asyncio.CancelledError, GenerationInterrupted) as e:
+                    self._attempt_cancelled(permit, endpoint)
+                    if isinstance(e, asyncio.CancelledError):
+                        raise
+                    await self._self_destruct()
+                    raise
+                except Exception as e:
+                    self._attempt_failed(permit, endpoint, e, tried)
+                    delay = self._retry_delay(attempt, e, endpoint, tried, history_len)
+                    if delay is None:
+                        if isinstance(e, OpenAIError):
+                            raise RuntimeError(f"OpenAI API 错误: {e}") from e
+                        raise
+                    # stop() 取消任务即可打断等待
+                    await asyncio.sleep(delay)
+                    attempt += 1
+                    partial.restart()
+        except asyncio.CancelledError:
+            self.history.truncate(history_len)
+            raise
+
+        return self._finish(request_kwargs, usage, final_answer, reasoning, prompt_tokens, timer, endpoint, key, events)
+
+    async def _stream_once(self, request_kwargs, partial, events, timer, endpoint, on_resp, on_think, on_chunk):
+        """发起一次流式请求，返回 (usage, 完整回答, 思考链)；重试时已输出过的前缀不再推给回调"""
+        reader = StreamReader(partial, events, timer, on_resp, on_think, on_chunk)
+
+        # 发起流式请求
+        stream_iter = await self._open_stream(request_kwargs, endpoint)
+        timer.connected()
+        self._opened(stream_iter)
+        try:
+            async for chunk in stream_iter:
+                # 检查中断
+                if self._stop:
+                    raise GenerationInterrupted("已手动中断生成")
+                reader.feed(chunk)
+                if self._backlog is not None and self._backlog[1]:
+                    await self._drain()
+                # 调用方已经拿到需要的内容（如代码块已结束），不再等待后面的输出
+                if self._finish_early:
+                    break
+        finally:
+            # 提前退出（异常、中断）时立即关闭连接
+            await stream_iter.close()
+        if self._stop:
+            raise GenerationInterrupted("已手动中断生成")
+
+        return reader.result()
+
+    async def _acquire(self, endpoint, tokens):
+        """按端点或会话的限流器排队，任务被取消时撤销排队"""
+        limiter = self._limiter_for(endpoint)
+        if limiter is None:
+            return None
+        return await limiter.aacquire(tokens, self.owner)
+
+    async def _open_stream(self, request_kwargs, endpoint=None):
+        client, request_kwargs = self._route(request_kwargs, endpoint)
+        if self._hedge is None:
+            return await client.chat.completions.create(**request_kwargs)
+        secondary_kwargs = self._hedge_kwargs(request_kwargs)
+        return AsyncHedgedStream(lambda: client.chat.completions.create(**request_kwargs),
+                                 lambda: self._hedge_client.chat.completions.create(**secondary_kwargs),
+                                 self._hedge)
+
+    async def _replay(self, events, on_resp, on_think, on_chunk, pacer=None) -> str:
+        """把记录的 (类型, 文本[, 相对时间]) 分块依次推给回调，返回完整回答；pacer 控制回放节奏"""
+        answer_parts: List[str] = []
+        start = time.perf_counter()
+        for kind, text, *offset in events:
+            if self._stop:
+                raise GenerationInterrupted("已手动中断生成")
+            if pacer is not None and offset:
+                wait = pacer.delay(offset[0], start)
+                if wait > 0: await asyncio.sleep(wait)
+            self._replay_event(kind, text, answer_parts, on_resp, on_think, on_chunk)
+            if self._backlog is not None and self._backlog[1]:
+                await self._drain()
+        return "".join(answer_parts)
+
+    def _release_clients(self) -> List[httpx.AsyncClient]:
+        """归还连接池引用，返回引用归零、需要由会话关闭的私有客户端"""
+        if getattr(self, "_pool", None) is None:
+            return []
+        pool, self._pool = self._pool, None
+        private = [c for c in self._http_clients if pool.release_async(c)]
+        self._http_clients = []
+        self._endpoint_clients.clear()
+        return private
+
+    async def aclose(self):
+        """归还连接池引用；共享客户端由连接池管理，会话私有的客户端在这里关闭"""
+        for c in self._release_clients():
+            try:
+                await c.aclose()
+            except Exception:
+                pass
+
+    def close(self):
+        """
+        aclose 的同步版本，便于和 OpenAISession 统一管理。
+        在事件循环中调用时私有客户端在该循环中后台关闭，否则在临时事件循环中关闭。
+        """
+        private = self._release_clients()
+        if not private:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        for c in private:
+            try:
+                if loop is not None:
+                    task = loop.create_task(c.aclose())
+                    _closing.add(task)
+                    task.add_done_callback(_closing.discard)
+                else:
+                    asyncio.run(c.aclose())
+            except Exception:
+                pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+    async def _self_destruct(self):
+        """归还连接并删除自身以防重复使用"""
+        try:
+            await self.aclose()
+        except Exception:
+            pass
+        try:
+            del self.history
+            del self.client
+        except:
+            pass
@@ -0,0 +1,279 @@
+from __future__ import annotations
+import os, re, sys, json, time, asyncio, argparse
+from typing import AsyncIterator, Callable, Dict, Iterable, Optional, Union
+from .http_pool import HttpClientPool
+from .async_session import AsyncOpenAISession
+from .rate_limiter import limiter_for
+from .coding_manager import CodingManager, no_more_info
+from .workspace import Workspace
+
+QUESTION_POLICIES = ("skip", "answers", "fail")
+
+
+def session_factory(base_url: str, api_key: str, model: str, rpm: Optional[int] = None, tpm: Optional[int] = None,
+                    max_connections: int = 64, **session_kwargs) -> Callable[[str], AsyncOpenAISession]:
+    """
+    返回 factory(role)：创建 AsyncOpenAISession，所有任务共用一个连接池和同一个 (base_url, api_key) 的限流器。
+    session_kwargs 原样传给 AsyncOpenAISession（默认不保存请求体）。
+    连接池由 factory 持有（factory.pool），await factory.aclose() 关闭它，之后再创建会话时使用新的连接池；
+    BatchRunner.run() 结束时自动调用。
+    """
+    limiter = limiter_for(base_url, api_key, rpm=rpm, tpm=tpm)
+    session_kwargs.setdefault("capture_payloads", False)
+
+    def factory(role: str) -> AsyncOpenAISession:
+        if factory.pool is None:
+            factory.pool = HttpClientPool(max_connections=max_connections)
+        return AsyncOpenAISession(api_key=api_key, base_url=base_url, model=model, http_pool=factory.pool,
+                                  rate_limiter=limiter, role=role, **session_kwargs)
+
+    async def aclose():
+        pool, factory.pool = factory.pool, None
+        if pool is not None:
+            await pool.aclose()
+
+    factory.pool = None
+    factory.aclose = aclose
+    return factory
+
+
+def _ignore(*args):
+    pass
+
+
+class BatchRunner:
+    """
+    批量运行需求：最多同时运行 concurrency 个 CodingManager（每个任务一个独立的工作目录），结果按完成顺序逐个产出。
+    任务的会话共用连接池和限流器，吞吐随并发数增加，直到达到服务商的限流（之后请求排队，不会失败）。
+
+        factory:   factory(role) 返回新会话，推荐 session_factory(...)；同步会话也可以（在线程池中调用）。
+                   factory 有 aclose 协程函数时（如 session_factory 的连接池），run() 结束时调用
+        questions: 分析师提问时的策略：skip 让分析师按自己的理解分析 / answers 依次使用任务中的 answers，用完后 skip /
+                   fail 视为失败 / 函数 (job, question) -> 回答（可以是协程函数）
+        tmpfs/keep/base_dir: 工作目录参数，见 Workspace
+        stage_timeout/job_timeout/max_repairs/max_questions: 见 CodingManager.arun
+        manager_kwargs: 传给 CodingManager 的其他参数（如 parallel_tests=True）
+
+    任务为需求字符串，或 {"id": ..., "requirement": ..., "answers": [...]} 形式的字典。
+
+    usage:
+        runner = BatchRunner(session_factory(base_url, key, "deepseek-chat", rpm=600), concurrency=8)
+        async for result in runner.run(requirements):
+            print(result["id"], result["status"])
+    """
+
+    def __init__(
+        self,
+        factory: Callable[[str], object],
+        concurrency: int = 4,
+        questions: Union[str, Callable] = "skip",
+        tmpfs: bool = False,
+        keep: str = "on_failure",
+        base_dir: Optional[str] = None,
+        stage_timeout: Optional[float] = None,
+        job_timeout: Optional[float] = None,
+        max_repairs: int = 5,
+        max_questions: int = 3,
+        manager_kwargs: Optional[Dict] = None,
+    ):
+        if concurrency < 1:
+            raise ValueError("concurrency 至少为 1")
+        if not callable(questions) and questions not in QUESTION_POLICIES:
+            raise ValueError(f"questions 只能是 {', '.join(QUESTION_POLICIES)} 或函数")
+        self.factory = factory
+        self.concurrency = concurrency
+        self.questions = questions
+        self.tmpfs = tmpfs
+        self.keep = keep
+        self.base_dir = base_dir
+        self.stage_timeout = stage_timeout
+        self.job_timeout = job_timeout
+        self.max_repairs = max_repairs
+        self.max_questions = max_questions
+        self.manager_kwargs = dict(manager_kwargs or {})
+        self.stats = {"started": 0, "finished": 0, "passed": 0, "total_tokens": 0, "wall": 0.0}
+
+    @staticmethod
+    def _normalize(job, index: int) -> Dict:
+        if isinstance(job, str):
+            job = {"requirement": job}
+        else:
+            job = dict(job)
+        if not job.get("requirement"):
+            raise ValueError("任务缺少 requirement")
+        job.setdefault("id", str(index))
+        return job
+
+    def _answer(self, job: Dict) -> Optional[Callable]:
+        policy = self.questions
+        if callable(policy):
+            return lambda question: policy(job, question)
+        if policy == "fail":
+            def fail(question):
+                raise RuntimeError(f"分析师需要补充信息：{question.strip()}")
+            return fail
+        if policy == "answers":
+            answers = list(job.get("answers") or [])
+            return lambda question: answers.pop(0) if answers else no_more_info
+        return None
+
+    async def run_job(self, job: Dict) -> Dict:
+        """运行单个任务，任何异常都记录在结果中"""
+        self.stats["started"] += 1
+        start = time.perf_counter()
+        data = {"id": job.get("id"), "requirement": job.get("requirement")}
+        manager = None
+        try:
+            sessions = [self.factory(role) for role in ("analyst", "developer", "tester")]
+            prefix = re.sub(r"[^\w.-]", "_", str(data["id"]))[:40] + "-"
+            workspace = Workspace(tmpfs=self.tmpfs, keep=self.keep, prefix=prefix, base_dir=self.base_dir)
+            kwargs = dict(ai_output_callback=_ignore, sys_output_callback=_ignore, event_callback=_ignore)
+            kwargs.update(self.manager_kwargs)
+            manager = CodingManager(*sessions, workspace=workspace, **kwargs)
+            result = await manager.arun(job["requirement"], answer=self._answer(job),
+                                        stage_timeout=self.stage_timeout, job_timeout=self.job_timeout,
+                                        max_repairs=self.max_repairs, max_questions=self.max_questions)
+            data.update(result.to_dict())
+            data["passed"] = result.passed
+        except Exception as e:
+            data.update(status="error", passed=False, error=f"{type(e).__name__}: {e}")
+        finally:
+            if manager is not None:
+                try:
+                    await manager.aclose()
+                except Exception:
+                    pass
+        data["wall"] = time.perf_counter() - start
+        self.stats["finished"] += 1
+        self.stats["passed"] += bool(data["passed"])
+        self.stats["total_tokens"] += data.get("total_tokens", 0)
+        return data
+
+    async def run(self, jobs: Union[Iterable, AsyncIterator]) -> AsyncIterator[Dict]:
+        """按完成顺序产出每个任务的结果；任务按需从 jobs 中读取，不会一次性全部加载"""
+        start = time.perf_counter()
+        if hasattr(jobs, "__aiter__"):
+            source = jobs.__aiter__()
+        else:
+            source = iter(jobs)
+        lock = asyncio.Lock()
+        counter = [0]
+        results: asyncio.Queue = asyncio.Queue()
+
+        async def next_job():
+            async with lock:
+                try:
+                    job = await source.__anext__() if hasattr(source, "__anext__") else next(source)
+                except (StopIteration, StopAsyncIteration):
+                    return None
+                counter[0] += 1
+                return counter[0] - 1, job
+
+        async def worker():
+            while True:
+                item = await next_job()
+                if item is None:
+                    return
+                index, job = item
+                try:
+                    job = self._normalize(job, index)
+                except (ValueError, TypeError) as e:
+                    await results.put({"id": str(index), "status": "error", "passed": False, "error": str(e), "wall": 0.0})
+                    continue
+                await results.put(await self.run_job(job))
+
+        workers = [asyncio.ensure_future(worker()) for _ in range(self.concurrency)]
+        finished = asyncio.ensure_future(asyncio.gather(*workers))
+        finished.add_done_callback(lambda _: results.put_nowait(None))
+        try:
+            while True:
+                item = await results.get()
+                if item is None:
+                    break
+                yield item
+            await finished
+        finally:
+            for w in workers:
+                w.cancel()
+            # 等被取消的任务归还连接后再关闭 factory 持有的连接池
+            await asyncio.gather(*workers, return_exceptions=True)
+            aclose = getattr(self.factory, "aclose", None)
+            if aclose is not None:
+                await aclose()
+            self.stats["wall"] = time.perf_counter() - start
+
+    def summary(self) -> Dict:
+        stats = dict(self.stats)
+        stats["pass_rate"] = stats["passed"] / stats["finished"] if stats["finished"] else 0.0
+        stats["jobs_per_min"] = stats["finished"] / stats["wall"] * 60 if stats["wall"] else 0.0
+        return stats
+
+
+def read_jsonl(path: str) -> Iterable[Union[str, Dict]]:
+    """逐行读取任务：JSON 对象或 JSON 字符串，无法解析的行作为需求原文；"-" 表示标准输入"""
+    f = sys.stdin if path == "-" else open(path, encoding="utf-8")
+    try:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                yield line
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m pkg.batch", description="批量运行开发需求")
+    parser.add_argument("input", help="需求文件（JSONL），- 表示标准输入")
+    parser.add_argument("-o", "--output", default="-", help="结果文件（JSONL），默认输出到标准输出")
+    parser.add_argument("-n", "--concurrency", type=int, default=4)
+    parser.add_argument("--base-url", default="https://api.lkeap.cloud.tencent.com/v1")
+    parser.add_argument("--model", default="deepseek-v3")
+    parser.add_argument("--rpm", type=int, default=None)
+    parser.add_argument("--tpm", type=int, default=None)
+    parser.add_argument("--questions", choices=QUESTION_POLICIES, default="skip")
+    parser.add_argument("--parallel-tests", action="store_true")
+    parser.add_argument("--tmpfs", action="store_true")
+    parser.add_argument("--keep", choices=("never", "on_failure", "always"), default="on_failure")
+    parser.add_argument("--workspace-dir", default=None)
+    parser.add_argument("--stage-timeout", type=float, default=None)
+    parser.add_argument("--job-timeout", type=float, default=None)
+    parser.add_argument("--max-repairs", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    token = os.getenv("API_KEY")
+    if not token:
+        print("API_KEY 未设置", file=sys.stderr)
+        sys.exit(1)
+
+    runner = BatchRunner(
+        session_factory(args.base_url, token, args.model, rpm=args.rpm, tpm=args.tpm,
+                        extra_params={"temperature": 0.4}),
+        concurrency=args.concurrency, questions=args.questions, tmpfs=args.tmpfs, keep=args.keep,
+        base_dir=args.workspace_dir, stage_timeout=args.stage_timeout, job_timeout=args.job_timeout,
+        max_repairs=args.max_repairs, manager_kwargs={"parallel_tests": args.parallel_tests},
+    )
+
+    async def run():
+        out = sys.stdout if args.output == "-" else open(args.output, "a", encoding="utf-8")
+        try:
+            async for result in runner.run(read_jsonl(args.input)):
+                out.write(json.dumps(result, ensure_ascii=False, default=str) + "\n")
+                out.flush()
+                print(f"[{runner.stats['finished']}] {result['id']}: {result['status']} "
+                      f"rounds={result.get('rounds', 0)} tokens={result.get('total_tokens', 0)} "
+                      f"wall={result['wall']:.1f}s", file=sys.stderr)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+
+    asyncio.run(run())
+    print(json.dumps(runner.summary(), ensure_ascii=False), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+from __future__ import annotations
+import time, queue, socket, threading
+from typing import Callable, Optional
+
+_END = object()
+_CANCELLED = object()
+
+
+class _Failed:
+    """读取线程中抛出的异常，交给调用线程重新抛出"""
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+class Cancelled(Exception):
+    """CancelScope 已取消，请求被放弃"""
+    pass
+
+
+def shares_connection(stream) -> bool:
+    """流所在的连接是否可能与其他流共用（HTTP/2 多路复用）；HTTP/1.1 的连接只属于这一个流"""
+    response = getattr(stream, "response", None)
+    if response is None:
+        return False
+    return response.extensions.get("http_version") != b"HTTP/1.1"
+
+
+def close_stream(stream):
+    """由读取该流的线程关闭它，失败忽略"""
+    try:
+        stream.close()
+    except Exception:
+        pass
+
+
+def abort_stream(stream) -> bool:
+    """
+    从其他线程立即中断一个 openai 流：先 shutdown 底层 socket（正在阻塞读取的线程会马上返回），再关闭响应。
+    只 close 不一定能唤醒另一个线程里阻塞的 recv。失败忽略。
+    HTTP/2 的 network_stream 是多个流共用的整条连接，shutdown 会中断其他所有生成；
+    从其他线程关闭单个流也不安全（httpcore 的读取线程会一直等不到这个流的数据，超时后连接被标记为出错），
+    因此不做任何操作并返回 False，由读取线程在下一个分块到达时自己关闭（见 CancelScope.iterate）。
+    """
+    if shares_connection(stream):
+        return False
+    response = getattr(stream, "response", None)
+    if response is not None:
+        try:
+            network_stream = response.extensions.get("network_stream")
+            sock = network_stream.get_extra_info("socket") if network_stream is not None else None
+            if sock is not None:
+                sock.shutdown(socket.SHUT_RDWR)
+        except Exception:
+            pass
+    close_stream(stream)
+    return True
+
+
+class CancelScope:
+    """
+    同步会话的取消范围：cancel() 可以从任意线程调用，立即放弃正在等待响应头的请求，
+    或中断正在读取的流（HTTP/1.1 的连接被关闭，不会归还连接池；HTTP/2 只关闭这一个流）。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stream = None
+        self._queue: Optional[queue.Queue] = None
+        self._wake = threading.Event()
+        self.cancelled = False
+        self.cancelled_at: Optional[float] = None
+
+    def cancel(self):
+        with self._lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            self.cancelled_at = time.perf_counter()
+            stream, self._stream = self._stream, None
+            pending = self._queue
+        self._wake.set()
+        if pending is not None:
+            pending.put(_CANCELLED)
+        if stream is not None:
+            abort_stream(stream)
+
+    def open(self, open_stream: Callable):
+        """
+        在辅助线程中发起请求并等待响应头，调用线程同时等待取消信号；
+        取消时立即抛出 Cancelled，之后才到达的响应由辅助线程直接关闭。
+        """
+        if self.cancelled:
+            raise Cancelled()
+        result = {}
+        done = threading.Event()
+
+        def _run():
+            try:
+                stream = open_stream()
+            except BaseException as e:
+                result["error"] = e
+            else:
+                with self._lock:
+                    if self.cancelled:
+                        late = stream
+                    else:
+                        late = None
+                        self._stream = result["stream"] = stream
+                if late is not None:
+                    close_stream(late)
+            done.set()
+            self._wake.set()
+
+        threading.Thread(target=_run, name="stream-open", daemon=True).start()
+        while not done.is_set():
+            self._wake.wait()
+            if self.cancelled:
+                raise Cancelled()
+            self._wake.clear()
+        if "error" in result:
+            raise result["error"]
+        if "stream" not in result:
+            raise Cancelled()
+        return result["stream"]
+
+    def iterate(self, stream):
+        """
+        逐个产出流的分块，结束或提前退出时关闭流。
+        HTTP/1.1 在当前线程读取，cancel() shutdown socket 即可唤醒；可能共用连接的 HTTP/2 流在辅助线程中读取，
+        cancel() 时当前线程立即抛出 Cancelled，辅助线程在下一个分块到达时自己关闭这个流，同一连接上的其他流不受影响。
+        """
+        if not shares_connection(stream):
+            try:
+                yield from stream
+            finally:
+                self.detach(stream)
+                close_stream(stream)
+            return
+
+        chunks: queue.Queue = queue.Queue()
+        finished = threading.Event()
+        with self._lock:
+            if self.cancelled:
+                self._stream = None
+                close_stream(stream)
+                raise Cancelled()
+            self._queue = chunks
+
+        def _pump():
+            try:
+                for chunk in stream:
+                    if finished.is_set() or self.cancelled:
+                        break
+                    chunks.put(chunk)
+                else:
+                    chunks.put(_END)
+            except BaseException as e:
+                chunks.put(_Failed(e))
+            finally:
+                close_stream(stream)
+
+        threading.Thread(target=_pump, name="stream-read", daemon=True).start()
+        try:
+            while True:
+                chunk = chunks.get()
+                if chunk is _CANCELLED:
+                    raise Cancelled()
+                if chunk is _END:
+                    return
+                if isinstance(chunk, _Failed):
+                    raise chunk.error
+                yield chunk
+        finally:
+            finished.set()
+            with self._lock:
+                if self._queue is chunks:
+                    self._queue = None
+            self.detach(stream)
+
+    def detach(self, stream):
+        """流结束后解除关联"""
+        with self._lock:
+            if self._stream is stream:
+                self._stream = None
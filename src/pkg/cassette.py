@@ -0,0 +1,87 @@
+from __future__ import annotations
+import json, time, threading
+from collections import defaultdict, deque
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from .response_cache import cache_key
+
+
+class CassetteMiss(Exception):
+    """回放模式下找不到匹配的录制请求时抛出"""
+    pass
+
+
+class Cassette:
+    """
+    录制/回放 OpenAISession 的完整流式会话（分块内容、思考链、分块间隔、usage），
+    回放时不联网、不经过 openai SDK，可用于离线回归和性能基准。
+
+    参数:
+        path:  录制文件（JSONL，每行一次请求）
+        mode:  "record" 联网并追加录制；"replay" 只回放，缺失即报错；
+               "auto" 有录制就回放，没有就联网录制
+        speed: 回放速度，1.0 为原速，2.0 为两倍速，None 为不等待（尽快回放）
+
+    usage:
+        tape = Cassette("tests/sort.cassette.jsonl", mode="replay", speed=None)
+        session = OpenAISession(api_key="-", cassette=tape)
+    """
+
+    def __init__(self, path: str, mode: str = "replay", speed: Optional[float] = None):
+        if mode not in ("record", "replay", "auto"):
+            raise ValueError(f"未知的 cassette 模式: {mode}")
+        self.path = Path(path)
+        self.mode = mode
+        self.speed = speed
+        self._lock = threading.Lock()
+        # 同一请求可能出现多次，按录制顺序依次回放
+        self._tapes: Dict[str, deque] = defaultdict(deque)
+        self.played = 0
+        self.recorded = 0
+        if mode != "record" and self.path.exists():
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self._tapes[entry["key"]].append(entry)
+
+    @property
+    def offline(self) -> bool:
+        return self.mode == "replay"
+
+    def take(self, request_kwargs: Dict) -> Optional[Tuple[List[Tuple[str, str, float]], Dict[str, int]]]:
+        """取出匹配的录制 (events, usage)；record 模式总是返回 None"""
+        if self.mode == "record":
+            return None
+        key = cache_key(request_kwargs)
+        with self._lock:
+            tape = self._tapes.get(key)
+            if not tape:
+                if self.mode == "replay":
+                    raise CassetteMiss(f"cassette 中没有匹配的请求: {key[:12]}")
+                return None
+            entry = tape.popleft()
+            self.played += 1
+        return [tuple(e) for e in entry["events"]], entry["usage"]
+
+    def record(self, request_kwargs: Dict, events: List[Tuple[str, str, float]], usage: Dict[str, int]):
+        messages = request_kwargs.get("messages", [])
+        entry = {
+            "key": cache_key(request_kwargs),
+            "model": request_kwargs.get("model"),
+            "messages": [dict(m) for m in messages],
+            "events": events,
+            "usage": usage,
+        }
+        line = json.dumps(entry, ensure_ascii=False) + "\n"
+        with self._lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+            self.recorded += 1
+
+    def delay(self, offset: float, start: float) -> float:
+        """第 offset 秒的分块在回放时还需等待多久"""
+        if not self.speed:
+            return 0.0
+        return start + offset / self.speed - time.perf_counter()
@@ -0,0 +1,125 @@
+from __future__ import annotations
+import os, json, threading
+from pathlib import Path
+from typing import Dict, List, Optional
+from .message_log import MessageSnapshot, freeze
+
+STATE_FILE = "state.json"
+HISTORY_FILE = "history.jsonl"
+
+
+def atomic_write(path: Path, text: str):
+    """写临时文件、fsync 后 rename，崩溃时只会看到旧文件或新文件"""
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class Checkpoint:
+    """
+    CodingManager 的崩溃安全检查点目录：
+        state.json     管理器状态和会话配置，每次整体原子替换
+        history.jsonl  各会话的消息历史，每次只追加新增的消息；历史被压缩或回退时先追加一条 reset 再重写该会话
+    每次保存有递增的序号 seq，先追加历史再替换 state.json；读取时只接受 seq 不超过 state.json 的历史，
+    崩溃在两步之间写入的多余内容（包括写了一半的行）在下次打开时被截掉。
+
+    fresh=True 时清空已有的检查点，否则读取已有内容并继续追加。
+    """
+
+    def __init__(self, directory: str, fresh: bool = False):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._state_path = self.directory / STATE_FILE
+        self._history_path = self.directory / HISTORY_FILE
+        self._lock = threading.Lock()
+        self._written: Dict[str, int] = {}          # 已写入的消息数
+        self._last: Dict[str, str] = {}             # 已写入的最后一条消息的哈希
+        self.seq = 0
+        self.saves = 0
+        self.bytes_appended = 0
+        self.state: Optional[Dict] = None
+        self.histories: Dict[str, List[Dict]] = {}
+        if fresh:
+            for path in (self._state_path, self._history_path):
+                if path.exists():
+                    path.unlink()
+        else:
+            self._load()
+
+    @property
+    def exists(self) -> bool:
+        return self.state is not None
+
+    def _load(self):
+        if not self._state_path.exists():
+            return
+        with open(self._state_path, encoding="utf-8") as f:
+            self.state = json.load(f)
+        self.seq = self.state["seq"]
+
+        histories: Dict[str, List[Dict]] = {}
+        valid = 0
+        if self._history_path.exists():
+            with open(self._history_path, "rb") as f:
+                for raw in f:
+                    try:
+                        entry = json.loads(raw)
+                    except ValueError:
+                        break           # 写了一半的行
+                    if entry["seq"] > self.seq:
+                        break
+                    messages = histories.setdefault(entry["role"], [])
+                    if entry.get("reset"):
+                        messages.clear()
+                    else:
+                        messages.append(entry["m"])
+                    valid += len(raw)
+            if valid < self._history_path.stat().st_size:
+                with open(self._history_path, "r+b") as f:
+                    f.truncate(valid)
+
+        for role, length in self.state.get("lengths", {}).items():
+            messages = histories.setdefault(role, [])
+            if len(messages) != length:
+                raise RuntimeError(f"检查点损坏：{role} 的历史为 {len(messages)} 条，应为 {length} 条")
+        self.histories = histories
+        for role, messages in histories.items():
+            self._written[role] = len(messages)
+            if messages:
+                self._last[role] = freeze(messages[-1]).hash
+
+    def save(self, state: Dict, histories: Dict[str, MessageSnapshot]):
+        """保存一次检查点；histories 为各会话历史的快照（history.snapshot()）"""
+        with self._lock:
+            seq = self.seq + 1
+            lines = []
+            written, last = dict(self._written), dict(self._last)
+            for role, snap in histories.items():
+                n = written.get(role, 0)
+                if n > len(snap) or (n and snap[n - 1].hash != last[role]):
+                    lines.append(json.dumps({"seq": seq, "role": role, "reset": True}))
+                    n = 0
+                prefix = '{"seq":%d,"role":%s,"m":' % (seq, json.dumps(role))
+                for i in range(n, len(snap)):
+                    lines.append(prefix + snap[i].encoded + "}")
+                written[role] = len(snap)
+                if len(snap):
+                    last[role] = snap[-1].hash
+
+            if lines:
+                data = "\n".join(lines) + "\n"
+                with open(self._history_path, "a", encoding="utf-8") as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                self.bytes_appended += len(data.encode("utf-8"))
+
+            state = dict(state, seq=seq, lengths={role: len(snap) for role, snap in histories.items()})
+            atomic_write(self._state_path, json.dumps(state, ensure_ascii=False, indent=1))
+            self.seq = seq
+            self._written, self._last = written, last
+            self.state = state
+            self.saves += 1
@@ -1,10 +1,15 @@
 from __future__ import annotations
-import sys, subprocess, weakref
-from typing import Callable
+import os, sys, time, asyncio, functools, subprocess, threading, weakref
+from typing import Callable, Dict, Optional
 from enum import Enum
 from .api_session import *
 from .utils import *
 from .dependency_resolver import *
+from .fence_parser import FenceParser, PreparedFile
+from .workspace import Workspace
+from .checkpoint import Checkpoint
+from .async_session import AsyncOpenAISession
+from .message_log import MessageLog
 
 analyst_system_prompt=(
     "你是 Python 开发需求分析专家。\n"
@@ -64,6 +69,8 @@ tester_system_prompt=(
 )
 
 add_on_analyst="（别忘你是需求分析专家：如果想正式开始分析，先输出“<ANALYSIS>”标志之后再给出分析正文）"
+add_on_tester_blackbox="（开发者正在同时编写 solution.py，你暂时看不到代码：请只根据需求描述编写黑盒测试脚本，输入输出格式严格按照需求描述；之后我会把开发者代码和运行结果一起给你）"
+no_more_info="没有更多补充信息了，请按你自己的理解开始分析。"
 add_on_tester="（别忘你是测试工程师：如果想修改测试脚本后重新运行测试，就先输出“<TEST_ERROR>”标志然后务必给出新的测试脚本；如果想让开发者修改代码，就直接生成错误报告和修改建议）"
 
 class DevelopConflict(Exception):
@@ -87,6 +94,13 @@ class AI_OUTPUT_TYPE(Enum):
     tester_resp = 6
 
 
+role_output_types = {
+    "analyst": (AI_OUTPUT_TYPE.analyst_think, AI_OUTPUT_TYPE.analyst_resp),
+    "developer": (AI_OUTPUT_TYPE.developer_think, AI_OUTPUT_TYPE.developer_resp),
+    "tester": (AI_OUTPUT_TYPE.tester_think, AI_OUTPUT_TYPE.tester_resp),
+}
+
+
 class SYS_OUTPUT_TYPE(Enum):
     debug = 1
     info = 2
@@ -112,6 +126,46 @@ class INTERNAL_STAGE(Enum):
     need_repairing = 5
 
 
+class RunResult:
+    """
+    CodingManager.arun() 的结果。
+        status: passed 测试通过 / failed 修复轮数用完 / timeout 超时 / refused 被拒绝 / conflict 意见冲突 /
+                dependency_error 依赖补全失败 / interrupted 被终止 / error 其他异常
+        timings: 各阶段累计耗时（秒），键为 analyzing、developing、test_developing、testing、reporting、repairing
+        tokens: 各角色累计 token 用量
+    """
+
+    def __init__(self):
+        self.status = "running"
+        self.error: Optional[str] = None
+        self.stage: Optional[str] = None        # 结束时所处的阶段
+        self.rounds = 0                         # 修复轮数
+        self.test_runs = 0
+        self.timings: Dict[str, float] = {}
+        self.wall = 0.0
+        self.tokens: Dict[str, Dict[str, int]] = {}
+        self.code = ""
+        self.test_code = ""
+        self.test_res = ""
+        self.workspace: Optional[str] = None    # 任务的工作目录
+
+    @property
+    def passed(self) -> bool:
+        return self.status == "passed"
+
+    @property
+    def total_tokens(self) -> int:
+        return sum(usage.get("total_tokens", 0) for usage in self.tokens.values())
+
+    def to_dict(self) -> Dict:
+        data = dict(self.__dict__)
+        data["total_tokens"] = self.total_tokens
+        return data
+
+    def __repr__(self):
+        return f"RunResult(status={self.status!r}, rounds={self.rounds}, wall={self.wall:.1f}s, tokens={self.total_tokens})"
+
+
 class CodingManager:
     def __init__(self,
                  analyst: OpenAISession,
@@ -119,14 +173,21 @@ class CodingManager:
                  tester: OpenAISession,
                  ai_output_callback: Callable[[AI_OUTPUT_TYPE, str], None],
                  sys_output_callback: Callable[[SYS_OUTPUT_TYPE, str], None],
-                 event_callback: Callable[[EVENT_CODE, CodingManager], None]
+                 event_callback: Callable[[EVENT_CODE, CodingManager], None],
+                 early_extract: bool = False,
+                 stop_after_code: bool = False,
+                 parallel_tests: bool = False,
+                 prefetch: bool = False,
+                 workspace: Optional[Workspace] = None,
+                 checkpoint: Optional[str] = None
                  ):
         self._analyst = analyst
         self._developer = developer
         self._tester = tester
         self._ai_output_calllback = ai_output_callback
         self._sys_output_callback = sys_output_callback
-        self._event_callback = event_callback
+        self._event_listener = event_callback
+        self._event_callback = self._checkpointed(event_callback)
         
         self._stage = INTERNAL_STAGE.need_analyzing
         self.question = ""
@@ -138,17 +199,150 @@ class CodingManager:
 
         self._code_repaired = False
         self._stop = False
+        self.token_usage = {"analyst": {}, "developer": {}, "tester": {}}
+        # 代码块一结束就在后台保存、检查语法和依赖（stop_after_code 时同时结束生成）
+        self._early_extract = early_extract
+        self._stop_after_code = stop_after_code
+        self._prepared: Dict[str, PreparedFile] = {}
+        # 测试脚本只根据需求分析编写，与开发同时进行；代码在第一次报告时才交给 tester
+        self._parallel_tests = parallel_tests
+        self._blackbox_tests = False
+        # 每一步完成后立即在后台开始下一步，step() 直接取结果或等待进行中的那一步
+        self._prefetch = prefetch
+        self._prefetched = None
+        # 文件读写、依赖扫描和测试子进程都限定在工作目录中，默认为当前目录
+        self.workspace = workspace if workspace is not None else Workspace(".")
+        self.passed = False
+        # 每次阶段切换后保存检查点（目录），崩溃后用 CodingManager.resume 继续
+        self._checkpoint_store = Checkpoint(checkpoint, fresh=True) if checkpoint is not None else None
         
+        # 延迟记录按角色分组；共用限流器时同一个任务的请求参与同一轮转
+        for role, session in (("analyst", analyst), ("developer", developer), ("tester", tester)):
+            if not session.role:
+                session.role = role
+            if session.owner is None:
+                session.owner = f"manager-{id(self)}"
+
         self._analyst.set_sys_prompt(analyst_system_prompt)
         self._developer.set_sys_prompt(developer_system_prompt)
         self._tester.set_sys_prompt(tester_system_prompt)
         
+        self._sessions = {"analyst": analyst, "developer": developer, "tester": tester}
         self._analyst_ref = weakref.ref(self._analyst)
         self._developer_ref = weakref.ref(self._developer)
         self._tester_ref = weakref.ref(self._tester)
 
         
     
+    @classmethod
+    def resume(cls,
+               path: str,
+               ai_output_callback: Callable[[AI_OUTPUT_TYPE, str], None],
+               sys_output_callback: Callable[[SYS_OUTPUT_TYPE, str], None],
+               event_callback: Callable[[EVENT_CODE, CodingManager], None],
+               analyst=None, developer=None, tester=None,
+               api_key: Optional[str] = None,
+               **kwargs) -> CodingManager:
+        """
+        从检查点恢复，之后从最后完成的阶段继续调用 step()/arun()（或在提问阶段继续 chat()），检查点继续写在同一目录。
+        未传入的会话按保存的配置重建（api_key 默认取环境变量 API_KEY）；kwargs 为 CodingManager 的其他参数。
+        """
+        store = Checkpoint(path)
+        if not store.exists:
+            raise FileNotFoundError(f"没有可恢复的检查点：{path}")
+        state = store.state
+
+        sessions = {"analyst": analyst, "developer": developer, "tester": tester}
+        for role, session in sessions.items():
+            if session is None:
+                config = dict(state["sessions"][role])
+                session_cls = AsyncOpenAISession if config.pop("cls") == "AsyncOpenAISession" else OpenAISession
+                key = api_key or os.getenv("API_KEY")
+                if not key:
+                    raise ValueError("重建会话需要 api_key")
+                sessions[role] = session_cls(api_key=key, **config)
+        if "workspace" not in kwargs:
+            workspace = Workspace(state["workspace"])
+            workspace.owned, workspace.keep = state["workspace_owned"], state["workspace_keep"]
+            kwargs["workspace"] = workspace
+        kwargs.pop("checkpoint", None)
+
+        manager = cls(sessions["analyst"], sessions["developer"], sessions["tester"],
+                      ai_output_callback, sys_output_callback, event_callback, **kwargs)
+        for role, session in manager._sessions.items():
+            session.history = MessageLog(store.histories.get(role, []))
+        manager._restore(state)
+        manager._checkpoint_store = store
+        return manager
+
+
+    def _restore(self, state: Dict):
+        self._stage = INTERNAL_STAGE[state["stage"]]
+        self.question = state["question"]
+        self.analysis = state["analysis"]
+        self.code = state["code"]
+        self.test_code = state["test_code"]
+        self.test_res = state["test_res"]
+        self.report = state["report"]
+        self._code_repaired = state["code_repaired"]
+        self._blackbox_tests = state["blackbox_tests"]
+        self.passed = state["passed"]
+        self.token_usage = state["token_usage"]
+        # 工作目录可能在内存文件系统上，重新写入代码
+        if self.code:
+            self._save("solution.py", self.code)
+        if self.test_code:
+            self._save("test_solution.py", self.test_code)
+
+
+    def _checkpoint_state(self) -> Dict:
+        sessions = {}
+        for role, session in self._sessions.items():
+            sessions[role] = {
+                "cls": type(session).__name__,
+                "base_url": str(session.base_url),
+                "model": session.model,
+                "max_tokens": session.max_tokens,
+                "system_as_user": session.system_as_user,
+                "extra_params": session.extra,
+            }
+        return {
+            "stage": self._stage.name,
+            "question": self.question,
+            "analysis": self.analysis,
+            "code": self.code,
+            "test_code": self.test_code,
+            "test_res": self.test_res,
+            "report": self.report,
+            "code_repaired": self._code_repaired,
+            "blackbox_tests": self._blackbox_tests,
+            "passed": self.passed,
+            "token_usage": self.token_usage,
+            "workspace": str(self.workspace.root.resolve()),
+            "workspace_owned": self.workspace.owned,
+            "workspace_keep": self.workspace.keep,
+            "sessions": sessions,
+        }
+
+
+    def _checkpoint(self):
+        if self._checkpoint_store is None:
+            return
+        try:
+            self._checkpoint_store.save(self._checkpoint_state(),
+                                        {role: session.history.snapshot() for role, session in self._sessions.items()})
+        except OSError as e:
+            self._sys_output_callback(SYS_OUTPUT_TYPE.info, f"检查点保存失败：{e}")
+
+
+    def _checkpointed(self, callback):
+        """事件都在状态更新之后触发：先保存检查点再通知调用方"""
+        def __cb(event, manager):
+            self._checkpoint()
+            callback(event, manager)
+        return __cb
+
+
     def get_stage(self):
         return self._stage
 
@@ -161,6 +355,29 @@ class CodingManager:
         if self._developer_ref is not None: self._developer.stop()
         if self._tester_ref is not None: self._tester.stop()
 
+
+    def close(self):
+        """归还三个会话占用的连接池引用（先等待后台预取的步骤结束），并按保留策略清理工作目录"""
+        if self._prefetched is not None:
+            self._prefetched[0].join()
+            self._prefetched = None
+        for session in (self._analyst, self._developer, self._tester):
+            session.close()
+        self.workspace.cleanup(self.passed)
+
+
+    async def aclose(self):
+        """close() 的异步版本：同样先等待后台预取的步骤，异步会话在当前事件循环中关闭私有客户端"""
+        if self._prefetched is not None:
+            await asyncio.to_thread(self._prefetched[0].join)
+            self._prefetched = None
+        for session in (self._analyst, self._developer, self._tester):
+            if hasattr(session, "aclose"):
+                await session.aclose()
+            else:
+                session.close()
+        self.workspace.cleanup(self.passed)
+
     
     def chat(self, user_input: str) -> bool:
         if self._stop: return True
@@ -169,53 +386,321 @@ class CodingManager:
             raise RuntimeError("重复的需求分析")
         
         res = self._analyzing(user_input + "\n" + add_on_analyst)
+        if res:
+            self._start_prefetch()
         return res or self._stop
 
 
     def step(self) -> bool:
         if self._stop: return True
 
+        if self._prefetched is not None:
+            res = self._join_prefetch()
+        else:
+            res = self._advance()
+        if not res:
+            self._start_prefetch()
+        return res
+
+
+    async def arun(self,
+                   requirement: Optional[str] = None,
+                   answer: Optional[Callable[[str], str]] = None,
+                   stage_timeout: Optional[float] = None,
+                   job_timeout: Optional[float] = None,
+                   max_repairs: int = 5,
+                   max_questions: int = 3) -> RunResult:
+        """
+        在事件循环中跑完整个流程（分析→开发→测试→报告→修复），不再需要手写 step() 循环和异常分类，
+        异常和超时都记录在返回的 RunResult 中。会话为 AsyncOpenAISession 时不占用线程，同步会话在线程池中调用。
+            requirement:   需求；为 None 表示已经通过 chat() 完成分析
+            answer:        回答分析师提问的函数（可以是协程函数），为 None、返回 None 或问答超过 max_questions 次时让分析师按自己的理解分析
+            stage_timeout: 单个阶段的时限（秒）；job_timeout：整个任务的时限，超时后终止任务
+            max_repairs:   最多修复轮数，用完仍未通过时结果为 failed
+        和 step() 一样，结束后 manager 和三个会话都不能再使用。
+        """
+        result = RunResult()
+        start = time.perf_counter()
+        deadline = start + job_timeout if job_timeout is not None else None
+
+        async def run_stage(name, coro):
+            timeout = stage_timeout
+            if deadline is not None:
+                remaining = deadline - time.perf_counter()
+                timeout = remaining if timeout is None else min(timeout, remaining)
+            t0 = time.perf_counter()
+            try:
+                if timeout is None:
+                    return await coro
+                if timeout <= 0:
+                    coro.close()
+                    raise asyncio.TimeoutError()
+                return await asyncio.wait_for(coro, timeout)
+            except asyncio.TimeoutError:
+                result.error = f"{name} 超时"
+                raise
+            finally:
+                result.timings[name] = result.timings.get(name, 0.0) + time.perf_counter() - t0
+
+        try:
+            if requirement is not None:
+                reply = requirement
+                for questions in range(max_questions + 2):
+                    if await run_stage("analyzing", self._aexchange(*self._analysis_turn(reply + "\n" + add_on_analyst))) is not False:
+                        break
+                    if questions >= max_questions or answer is None:
+                        reply = no_more_info
+                    else:
+                        reply = answer(self.question)
+                        if asyncio.iscoroutine(reply):
+                            reply = await reply
+                        if reply is None:
+                            reply = no_more_info
+                else:
+                    raise RuntimeError("分析师一直在提问，未能完成需求分析")
+            if not self._stop and self.analysis == "":
+                raise RuntimeError("未完成需求分析")
+
+            while not self._stop:
+                stage = self._stage
+                name = stage.name[len("need_"):]
+                if stage == INTERNAL_STAGE.need_testing:
+                    result.test_runs += 1
+                    if await run_stage(name, self._atesting()):
+                        result.status = "passed"
+                        break
+                elif stage == INTERNAL_STAGE.need_repairing and result.rounds >= max_repairs:
+                    result.status = "failed"
+                    result.error = f"修复 {max_repairs} 轮后测试仍未通过"
+                    break
+                elif stage == INTERNAL_STAGE.need_developing and self._parallel_tests:
+                    await run_stage(name, self._adeveloping_with_tests())
+                else:
+                    if stage == INTERNAL_STAGE.need_repairing:
+                        result.rounds += 1
+                    await run_stage(name, self._aexchange(*self._turn()))
+            if self._stop and result.status == "running":
+                result.status = "interrupted"
+        except asyncio.TimeoutError:
+            result.status = "timeout"
+            self.stop()
+        except DevelopRefused as e:
+            result.status, result.error = "refused", str(e)
+        except DevelopConflict as e:
+            result.status, result.error = "conflict", str(e)
+        except DependencyError as e:
+            result.status, result.error = "dependency_error", str(e)
+        except GenerationInterrupted as e:
+            result.status, result.error = "interrupted", str(e)
+        except asyncio.CancelledError:
+            self.stop()
+            raise
+        except Exception as e:
+            result.status, result.error = "error", f"{type(e).__name__}: {e}"
+        finally:
+            result.stage = self._stage.name
+            result.wall = time.perf_counter() - start
+            result.tokens = {role: dict(usage) for role, usage in self.token_usage.items()}
+            result.code, result.test_code, result.test_res = self.code, self.test_code, self.test_res
+            result.workspace = str(self.workspace.root)
+        return result
+
+
+    def _start_prefetch(self):
+        # 只预取模型对话；测试阶段会运行生成的代码、安装依赖，必须等用户点击后才执行
+        if not self._prefetch or self._stop or self._stage == INTERNAL_STAGE.need_testing:
+            return
+        result = {}
+        def _run():
+            try:
+                result["done"] = self._advance()
+            except BaseException as e:
+                result["error"] = e
+        worker = threading.Thread(target=_run, name="stage-prefetch", daemon=True)
+        self._prefetched = (worker, result)
+        worker.start()
+
+
+    def _join_prefetch(self) -> bool:
+        """等待后台预取的步骤，结果和异常与直接调用 step() 相同"""
+        worker, result = self._prefetched
+        worker.join()
+        self._prefetched = None
+        if "error" in result:
+            raise result["error"]
+        return result["done"]
+
+
+    def _advance(self) -> bool:
+        if self._stop: return True
+
         if self._stage == INTERNAL_STAGE.need_analyzing or self.analysis == "":
             raise RuntimeError("未完成需求分析")
 
-        elif self._stage == INTERNAL_STAGE.need_developing:
-            self._developing(f"需求描述：\n{self.analysis}")
-        elif self._stage == INTERNAL_STAGE.need_test_developing:
-            self._tester_developing(f"需求描述：\n{self.analysis}\n\n\n开发者代码：\n{self.code}")
-        elif self._stage == INTERNAL_STAGE.need_testing:
+        if self._stage == INTERNAL_STAGE.need_testing:
             res = self._testing()
             return res or self._stop
+        elif self._stage == INTERNAL_STAGE.need_developing and self._parallel_tests:
+            self._developing_with_tests()
+        else:
+            self._exchange(*self._turn())
+        return self._stop
+
+
+    def _turn(self):
+        """当前阶段的模型调用：(角色, 提示信息, 提示词, 代码文件, 处理回答的方法)"""
+        if self._stage == INTERNAL_STAGE.need_developing:
+            return ("developer", "开发中", self._layout([("需求描述", self.analysis)]), "solution.py", self._developed)
+        elif self._stage == INTERNAL_STAGE.need_test_developing:
+            return ("tester", "测试脚本开发中", self._layout([("需求描述", self.analysis), ("开发者代码", self.code)]),
+                    "test_solution.py", self._test_developed)
         elif self._stage == INTERNAL_STAGE.need_reporting:
-            if self._code_repaired == True:
-                self._tester_reporting(f"开发者修改后的代码：\n{self.code}\n\n\n运行结果：\n{self.test_res}\n" + add_on_tester)
-                self._code_repaired = False
+            if self._blackbox_tests:
+                blocks = [("开发者代码", self.code)]
+            elif self._code_repaired == True:
+                blocks = [("开发者修改后的代码", self.code)]
             else:
-                self._tester_reporting(f"运行结果：\n{self.test_res}\n" + add_on_tester)
+                blocks = []
+            return ("tester", "测试报告生成中", self._layout(blocks + [("运行结果", self.test_res)], "\n" + add_on_tester),
+                    None, self._reported)
         elif self._stage == INTERNAL_STAGE.need_repairing:
-            self._repairing(f"错误报告：\n{self.report}")
+            return ("developer", "修复中", self._layout([("错误报告", self.report)]), "solution.py", self._repaired)
+        raise RuntimeError(f"{self._stage.name} 阶段不调用模型")
+
+
+    def _exchange(self, role, message, prompt, code_path, handler):
+        """发送一次请求并处理回答，返回 handler 的结果；已终止时返回 None"""
+        if self._stop: return None
+        self._sys_output_callback(SYS_OUTPUT_TYPE.info, message)
+        session = self._sessions[role]
+        think, resp = role_output_types[role]
+        parser = self._code_parser(code_path, session) if code_path is not None else None
+        usage = session.send(prompt, on_think=self._cb_ai(think), on_resp=self._cb_ai(resp, parser))
+        return self._received(role, usage, handler)
+
+
+    async def _aexchange(self, role, message, prompt, code_path, handler):
+        """_exchange 的异步版本：AsyncOpenAISession 直接 await，同步会话在线程池中调用"""
+        if self._stop: return None
+        self._sys_output_callback(SYS_OUTPUT_TYPE.info, message)
+        session = self._sessions[role]
+        think, resp = role_output_types[role]
+        parser = self._code_parser(code_path, session) if code_path is not None else None
+        send = functools.partial(session.send, prompt, on_think=self._cb_ai(think), on_resp=self._cb_ai(resp, parser))
+        if asyncio.iscoroutinefunction(session.send):
+            usage = await send()
+        else:
+            usage = await asyncio.to_thread(send)
+        return self._received(role, usage, handler)
 
-        return self._stop
-            
 
-    def _cb_ai(self, msg_type):
+    def _received(self, role, usage, handler):
+        output = self._sessions[role].history[-1]["content"]
+        self._print_token_usage(usage, role)
+        return handler(output)
+
+
+    def _cb_ai(self, msg_type, parser: Optional[FenceParser] = None):
         def __cb(msg):
             self._ai_output_calllback(msg_type, msg)
+            if parser is not None:
+                parser.feed(msg)
         return __cb
 
 
-    def _print_token_usage(self, usage):
+    def _code_parser(self, path, session) -> Optional[FenceParser]:
+        """early_extract 模式下边生成边识别代码块，结束后立即开始保存和检查"""
+        if not self._early_extract:
+            return None
+        def on_code(code):
+            self._prepared[path] = PreparedFile(self.workspace.path(path), code, name=path,
+                                                project_root=str(self.workspace.root))
+            if self._stop_after_code:
+                session.finish_early()
+        return FenceParser(on_code)
+
+
+    def _save(self, path, code):
+        prepared = self._prepared.get(path)
+        if prepared is not None:
+            # 后台写入的就是这份代码时只需等它写完；否则等它写完再覆盖
+            prepared.wait_saved()
+            if prepared.code == code:
+                return
+            del self._prepared[path]
+        save(self.workspace.path(path), code)
+
+
+    def _check_syntax(self, path, code):
+        prepared = self._prepared.get(path)
+        if prepared is not None and prepared.code == code:
+            if prepared.wait().syntax_error is not None:
+                raise prepared.syntax_error
+            return
+        check_syntax(self.workspace.path(path), filename=path)
+
+
+    def _imports_ok(self, resolver, path, code) -> bool:
+        prepared = self._prepared.pop(path, None)
+        if prepared is not None and prepared.code == code and prepared.wait().imports_ok is not None:
+            return prepared.imports_ok
+        return resolver.test_from_file(self.workspace.path(path), str(self.workspace.root))
+
+
+    def _layout(self, blocks, suffix=""):
+        """拼接提示词：每块为 (标题, 内容)"""
+        return "\n\n\n".join(f"{title}：\n{content}" for title, content in blocks) + suffix
+
+
+    def _print_token_usage(self, usage, role):
         formatted_usage = ', '.join(f'{k}={v}' for k, v in usage.items())
         self._sys_output_callback(SYS_OUTPUT_TYPE.debug, f"Tokens Usage: ({formatted_usage})")
 
+        record = {"analyst": self._analyst, "developer": self._developer, "tester": self._tester}[role].last_latency
+        if record is not None:
+            ttft = f"{record.ttft:.2f}s" if record.ttft is not None else "-"
+            self._sys_output_callback(SYS_OUTPUT_TYPE.debug,
+                                      f"Latency: (ttft={ttft}, tokens_per_sec={record.tokens_per_sec:.1f}, "
+                                      f"gap_p95={record.gap_p95:.3f}s, gap_max={record.gap_max:.3f}s, wall={record.wall:.2f}s)")
+
+        total = self.token_usage[role]
+        for k, v in usage.items():
+            total[k] = total.get(k, 0) + v
+        if "prompt_cache_hit_tokens" in usage:
+            report = self.cache_report()
+            self._sys_output_callback(SYS_OUTPUT_TYPE.debug,
+                                      f"Prefix Cache: hit_ratio={report[role]:.1%}, run_hit_ratio={report['total']:.1%}")
+
+
+    def latency_report(self) -> Dict[str, Dict]:
+        """三个会话的延迟汇总，键为 "角色/模型"；多个会话共用同一个 LatencyStats 时只统计一次"""
+        report = {}
+        seen = set()
+        for session in (self._analyst, self._developer, self._tester):
+            if id(session.latency) not in seen:
+                seen.add(id(session.latency))
+                report.update(session.latency.summary())
+        return report
+
+
+    def cache_report(self) -> Dict[str, float]:
+        """各角色及整个流程的前缀缓存命中率（命中 token / prompt token）"""
+        report = {}
+        hit_sum = prompt_sum = 0
+        for role, total in self.token_usage.items():
+            hit = total.get("prompt_cache_hit_tokens", 0)
+            prompt = total.get("prompt_tokens", 0)
+            report[role] = hit / prompt if prompt else 0.0
+            hit_sum += hit
+            prompt_sum += prompt
+        report["total"] = hit_sum / prompt_sum if prompt_sum else 0.0
+        return report
+
     
-    def _tester_reporting(self, prompt):
-        if self._stop: return
-        self._sys_output_callback(SYS_OUTPUT_TYPE.info, "测试报告生成中")
-        usage = self._tester.send(prompt,
-                                                  on_think=self._cb_ai(AI_OUTPUT_TYPE.tester_think),
-                                                  on_resp=self._cb_ai(AI_OUTPUT_TYPE.tester_resp))
-        self.report = self._tester.history[-1]["content"]
-        self._print_token_usage(usage)
+    def _reported(self, output):
+        self.report = output
+        self._blackbox_tests = False
+        self._code_repaired = False
         
         if "<refused>" in self.report.lower() or "<refuse>" in self.report.lower():
             raise DevelopRefused("报告生成被拒绝")
@@ -223,7 +708,7 @@ class CodingManager:
         if "<test_error>" in self.report.lower() or "<testerror>" in self.report.lower():
             self.test_code = extract_code(self.report).replace("<TEST_ERROR>", "", 1).lstrip()
             self.test_code = self.test_code.replace("</TEST_ERROR>", "", 1)
-            save("test_solution.py", self.test_code)
+            self._save("test_solution.py", self.test_code)
             
             self._sys_output_callback(SYS_OUTPUT_TYPE.info, "测试脚本有错，已修复")
             self._stage = INTERNAL_STAGE.need_testing
@@ -234,44 +719,32 @@ class CodingManager:
             self._event_callback(EVENT_CODE.reporting_done, self) 
 
 
-    def _tester_developing(self, prompt):
-        if self._stop: return
-        
-        self._sys_output_callback(SYS_OUTPUT_TYPE.info, "测试脚本开发中")
-        usage = self._tester.send(prompt,
-                                                  on_think=self._cb_ai(AI_OUTPUT_TYPE.tester_think),
-                                                  on_resp=self._cb_ai(AI_OUTPUT_TYPE.tester_resp))
-        output = self._tester.history[-1]["content"]
-        self._print_token_usage(usage)
-
+    def _tests_received(self, output) -> bool:
+        """保存测试脚本，不切换阶段"""
         if "<refused>" in output.lower() or "<refuse>" in output.lower():
             raise DevelopRefused("测试脚本开发被拒绝")
 
         self.test_code = extract_code(output)
-        save("test_solution.py", self.test_code)
+        self._save("test_solution.py", self.test_code)
+        return True
+
+
+    def _test_developed(self, output):
+        self._tests_received(output)
         
         self._sys_output_callback(SYS_OUTPUT_TYPE.info, "测试脚本开发完成")
         self._stage = INTERNAL_STAGE.need_testing
         self._event_callback(EVENT_CODE.test_developing_done, self)
 
 
-    def _repairing(self, prompt):
-        if self._stop: return
-
-        self._sys_output_callback(SYS_OUTPUT_TYPE.info, "修复中") 
-        usage = self._developer.send(prompt,
-                                                     on_think=self._cb_ai(AI_OUTPUT_TYPE.developer_think),
-                                                     on_resp=self._cb_ai(AI_OUTPUT_TYPE.developer_resp))
-        output = self._developer.history[-1]["content"]
-        self._print_token_usage(usage)
-        
+    def _repaired(self, output):
         if "<test_error>" in output.lower() or "<testerror>" in output.lower():
             raise DevelopConflict("开发者和测试工程师意见冲突")
         if "<refused>" in output.lower() or "<refuse>" in output.lower():
             raise DevelopRefused("开发被拒绝")
         
         self.code = extract_code(output)
-        save("solution.py", self.code)
+        self._save("solution.py", self.code)
         self._code_repaired = True
         
         self._sys_output_callback(SYS_OUTPUT_TYPE.info, "修复完成")
@@ -279,21 +752,107 @@ class CodingManager:
         self._event_callback(EVENT_CODE.repairing_done, self)
 
 
-    def _developing(self, prompt):
-        if self._stop: return
+    def _blackbox_turn(self):
+        return ("tester", "测试脚本开发中", self._layout([("需求描述", self.analysis)], "\n" + add_on_tester_blackbox),
+                "test_solution.py", self._blackbox_received)
 
-        self._sys_output_callback(SYS_OUTPUT_TYPE.info, "开发中")
-        usage = self._developer.send(prompt,
-                                                     on_think=self._cb_ai(AI_OUTPUT_TYPE.developer_think),
-                                                     on_resp=self._cb_ai(AI_OUTPUT_TYPE.developer_resp))
-        output = self._developer.history[-1]["content"]
-        self._print_token_usage(usage)
-        
+
+    def _blackbox_received(self, output) -> bool:
+        self._tests_received(output)
+        self._blackbox_tests = True
+        return True
+
+
+    def _developer_turn(self):
+        """并行开发时 developer 的调用：只保存代码，阶段和事件由 _parallel_done 统一处理"""
+        role, message, prompt, code_path, _ = self._turn()
+        return role, message, prompt, code_path, self._code_received
+
+
+    def _developing_with_tests(self):
+        """
+        developer 写代码的同时 tester 只根据需求分析写黑盒测试，两次生成不再串行。
+        两边的回调只保存结果，都结束后由当前线程统一切换阶段并按顺序触发事件。
+        任一方失败时已完成的一方保留：测试脚本已生成则重试时只重新开发；代码已生成则退回普通的测试开发步骤。
+        """
+        results = {}
+        def _test_developing():
+            try:
+                results["tester"] = self._exchange(*self._blackbox_turn())
+            except BaseException as e:
+                results["tester_error"] = e
+
+        worker = None
+        if not self.test_code:
+            worker = threading.Thread(target=_test_developing, name="test-developing", daemon=True)
+            worker.start()
+        developer_error = None
+        try:
+            results["developer"] = self._exchange(*self._developer_turn())
+        except BaseException as e:
+            developer_error = e
+        if worker is not None:
+            worker.join()
+        self._parallel_done(results.get("developer") is True, results.get("tester") is True,
+                            developer_error or results.get("tester_error"))
+
+
+    async def _adeveloping_with_tests(self):
+        tester = None
+        if not self.test_code:
+            tester = asyncio.ensure_future(self._aexchange(*self._blackbox_turn()))
+        developed = tested = error = None
+        try:
+            developed = await self._aexchange(*self._developer_turn())
+        except asyncio.CancelledError:
+            if tester is not None:
+                tester.cancel()
+            raise
+        except Exception as e:
+            error = e
+        if tester is not None:
+            try:
+                tested = await tester
+            except Exception as e:
+                error = error or e
+        self._parallel_done(developed is True, tested is True, error)
+
+
+    def _parallel_done(self, developed: bool, tested: bool, error: Optional[BaseException]):
+        """
+        两边都结束后设置阶段、保存一次检查点，再按 developing_done、test_developing_done 的顺序触发事件；
+        有失败时随后抛出（developer 的异常优先）
+        """
+        if self._stop or not developed:
+            self._stage = INTERNAL_STAGE.need_developing
+        elif not self.test_code:
+            self._stage = INTERNAL_STAGE.need_test_developing
+        else:
+            self._stage = INTERNAL_STAGE.need_testing
+        if developed or tested:
+            self._checkpoint()
+        if developed:
+            self._sys_output_callback(SYS_OUTPUT_TYPE.info, "开发完成")
+            self._event_listener(EVENT_CODE.developing_done, self)
+        if tested:
+            self._sys_output_callback(SYS_OUTPUT_TYPE.info, "测试脚本开发完成")
+            self._event_listener(EVENT_CODE.test_developing_done, self)
+        if error is not None:
+            raise error
+
+
+    def _code_received(self, output) -> bool:
+        """保存开发者的代码，不切换阶段"""
         if "<refused>" in output.lower() or "<refuse>" in output.lower():
             raise DevelopRefused("开发被拒绝")
 
         self.code = extract_code(output)
-        save("solution.py", self.code)
+        self._save("solution.py", self.code)
+        return True
+
+
+    def _developed(self, output):
+        self._code_received(output)
 
         self._sys_output_callback(SYS_OUTPUT_TYPE.info, "开发完成")
         self._stage = INTERNAL_STAGE.need_test_developing
@@ -301,15 +860,15 @@ class CodingManager:
 
 
     def _analyzing(self, requirement) -> bool:
-        self._sys_output_callback(SYS_OUTPUT_TYPE.info, "需求分析中")
-        
-        if self._stop: return True
-        usage = self._analyst.send(requirement, on_think=self._cb_ai(AI_OUTPUT_TYPE.analyst_think),
-                           on_resp=self._cb_ai(AI_OUTPUT_TYPE.analyst_resp))
+        res = self._exchange(*self._analysis_turn(requirement))
+        return True if res is None else res
 
-        output = self._analyst.history[-1]["content"]
-        self._print_token_usage(usage)
-        
+
+    def _analysis_turn(self, requirement):
+        return ("analyst", "需求分析中", requirement, None, self._analyzed)
+
+
+    def _analyzed(self, output) -> bool:
         if "<refused>" in output.lower() or "<refuse>" in output.lower():
             raise DevelopRefused("需求分析被拒绝")
 
@@ -327,11 +886,43 @@ class CodingManager:
 
 
     def _testing(self) -> bool:
+        res = self._prepare_testing()
+        if res is not None:
+            return res
+        try:
+            res = subprocess.run([sys.executable, "test_solution.py"], cwd=self.workspace.root,
+                                capture_output=True, text=True, timeout=120)
+        except subprocess.TimeoutExpired as e:
+            return self._tested(None, e.stdout, e.stderr)
+        return self._tested(res.returncode, res.stdout, res.stderr)
+
+
+    async def _atesting(self) -> bool:
+        """_testing 的异步版本：测试脚本作为异步子进程运行，检查和补全依赖在线程池中进行"""
+        res = await asyncio.to_thread(self._prepare_testing)
+        if res is not None:
+            return res
+        proc = await asyncio.create_subprocess_exec(sys.executable, "test_solution.py", cwd=self.workspace.root,
+                                                    stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        try:
+            stdout, stderr = await asyncio.wait_for(proc.communicate(), 120)
+        except asyncio.TimeoutError:
+            proc.kill()
+            stdout, stderr = await proc.communicate()
+            return self._tested(None, stdout.decode(errors="replace"), stderr.decode(errors="replace"))
+        except asyncio.CancelledError:
+            proc.kill()
+            raise
+        return self._tested(proc.returncode, stdout.decode(errors="replace"), stderr.decode(errors="replace"))
+
+
+    def _prepare_testing(self) -> Optional[bool]:
+        """语法检查和依赖补全；返回 None 表示可以运行测试脚本，否则为测试结果"""
         self._sys_output_callback(SYS_OUTPUT_TYPE.info, "测试运行中")
         
         if self._stop: return True
         try:
-            check_syntax("solution.py")
+            self._check_syntax("solution.py", self.code)
         except SyntaxError as e:
             self.test_res = f"开发者代码 (solution.py) 语法错误：\n{e}"
             self._sys_output_callback(SYS_OUTPUT_TYPE.info, "测试未通过")
@@ -340,7 +931,7 @@ class CodingManager:
             return False
 
         try:
-            check_syntax("test_solution.py")
+            self._check_syntax("test_solution.py", self.test_code)
         except SyntaxError as e:
             self.test_res = f"测试脚本 (test_solution.py) 语法错误：\n{e}"
             self._sys_output_callback(SYS_OUTPUT_TYPE.info, "测试未通过")
@@ -350,63 +941,33 @@ class CodingManager:
         
         
         resolver = DependencyResolver()
-        if not resolver.test_from_file("solution.py") or not resolver.test_from_file("test_solution.py"):
+        if not self._imports_ok(resolver, "solution.py", self.code) or \
+                not self._imports_ok(resolver, "test_solution.py", self.test_code):
             try:
-                resolver.install_from_files()
+                resolver.install_from_files(str(self.workspace.root))
                 self._sys_output_callback(SYS_OUTPUT_TYPE.info, "依赖已补全")
             except Exception as e:
                 self._sys_output_callback(SYS_OUTPUT_TYPE.info, "无法补全依赖")
                 raise DependencyError("无法补全依赖") from e
+        return None
 
-        """
-        try:
-            resolver.install_from_files(["solution.py"])
-        except SyntaxError as e:
-            self.test_res = f"开发者代码（solution.py）语法错误：\n{e}"
-            self._sys_output_callback(SYS_OUTPUT_TYPE.info, "测试未通过")
-            self._stage = INTERNAL_STAGE.need_reporting
-            self._event_callback(EVENT_CODE.testing_done, self)
-            return False
-        except:
-            self._sys_output_callback(SYS_OUTPUT_TYPE.info, "无法为 solution.py 补全依赖")
-            raise
-        self._sys_output_callback(SYS_OUTPUT_TYPE.info, "solution.py 依赖已补全")
 
-        try:
-            resolver.install_from_files(["test_solution.py"])
-        except SyntaxError as e:
-            self.test_res = f"测试脚本（test_solution.py）语法错误：\n{e}"
-            self._sys_output_callback(SYS_OUTPUT_TYPE.info, "测试未通过")
-            self._stage = INTERNAL_STAGE.need_reporting
-            self._event_callback(EVENT_CODE.testing_done, self)
-            return False
-        except:
-            self._sys_output_callback(SYS_OUTPUT_TYPE.info, "无法为 test_solution.py 补全依赖")
-            raise
-        self._sys_output_callback(SYS_OUTPUT_TYPE.info, "test_solution.py 依赖已补全")
-        """
-        
-        try:
-            res = subprocess.run([sys.executable, "test_solution.py"],
-                                capture_output=True, text=True, timeout=120)
-            time_out = False
-            if res.returncode == 0:
-                self.test_res = f"[stdout]:\n{res.stdout}\n[stderr]:\n{res.stderr}"
-                self._sys_output_callback(SYS_OUTPUT_TYPE.info, "测试通过")
-                self._event_callback(EVENT_CODE.done, self)
-                return True
-        except subprocess.TimeoutExpired as e:
-            time_out = True
-            res = e
+    def _tested(self, returncode: Optional[int], stdout, stderr) -> bool:
+        """returncode 为 None 表示超时"""
+        if returncode == 0:
+            self.passed = True
+            self.test_res = f"[stdout]:\n{stdout}\n[stderr]:\n{stderr}"
+            self._sys_output_callback(SYS_OUTPUT_TYPE.info, "测试通过")
+            self._event_callback(EVENT_CODE.done, self)
+            return True
 
-        if time_out:
-            self.test_res = f"测试超时：\n[stdout]:\n{res.stdout}\n[stderr]:\n{res.stderr}"
+        if returncode is None:
+            self.test_res = f"测试超时：\n[stdout]:\n{stdout}\n[stderr]:\n{stderr}"
             self._sys_output_callback(SYS_OUTPUT_TYPE.info, "测试超时")
         else:
-            self.test_res = f"[stdout]:\n{res.stdout}\n[stderr]:\n{res.stderr}"
+            self.test_res = f"[stdout]:\n{stdout}\n[stderr]:\n{stderr}"
             self._sys_output_callback(SYS_OUTPUT_TYPE.info, "测试未通过")
         
         self._stage = INTERNAL_STAGE.need_reporting
         self._event_callback(EVENT_CODE.testing_done, self)
         return False
-
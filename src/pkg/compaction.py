@@ -0,0 +1,137 @@
+from __future__ import annotations
+from typing import Callable, Dict, List, Optional, Sequence
+from .tokenizer import approx_tokens, MESSAGE_OVERHEAD
+
+
+def approx_message_tokens(message: Dict) -> int:
+    return approx_tokens(message.get("content") or "") + MESSAGE_OVERHEAD
+
+
+class CompactionResult:
+    def __init__(self, messages: List[Dict], tokens_before: int, tokens_after: int, dropped: int):
+        self.messages = messages
+        self.tokens_before = tokens_before
+        self.tokens_after = tokens_after
+        self.dropped = dropped
+
+    @property
+    def tokens_saved(self) -> int:
+        return self.tokens_before - self.tokens_after
+
+
+class CompactionPolicy:
+    """
+    历史压缩策略基类：超出 budget 时丢弃中间的旧回合，只保留开头固定的 pinned 条消息和最近的回合。
+    回合以 user 消息为边界，保证 user/assistant 交替不被破坏；当前这条 user 消息一定保留。
+    整个过程对消息数线性。
+
+    参数:
+        budget:  历史 token 预算
+        pinned:  开头固定保留的消息数（默认 1，即系统提示词）
+        counter: 单条消息的 token 计数函数，不指定时使用会话的分词器
+    """
+
+    def __init__(self, budget: int, pinned: int = 1, counter: Optional[Callable[[Dict], int]] = None):
+        self.budget = budget
+        self.pinned = pinned
+        self.counter = counter
+
+    def compact(self, messages: Sequence[Dict], counter: Optional[Callable[[Dict], int]] = None) -> Optional[CompactionResult]:
+        """不需要压缩时返回 None"""
+        counter = self.counter or counter or approx_message_tokens
+        counts = [counter(m) for m in messages]
+        total = sum(counts)
+        if total <= self.budget:
+            return None
+
+        pinned = min(self.pinned, len(messages) - 1)
+        head = sum(counts[:pinned])
+        # 从尾部向前累加，找到能放进预算的最早回合边界
+        cut = len(messages) - 1
+        tail = counts[cut]
+        reserve = self.reserve(messages, pinned)
+        i = cut - 1
+        acc = tail
+        while i >= pinned:
+            acc += counts[i]
+            if head + acc + reserve > self.budget:
+                break
+            if messages[i].get("role") == "user":
+                cut, tail = i, acc
+            i -= 1
+        if cut <= pinned:
+            return None
+
+        dropped = list(messages[pinned:cut])
+        replacement = self.replace(dropped, counter)
+        kept = list(messages[:pinned]) + replacement + list(messages[cut:])
+        after = head + tail + sum(counter(m) for m in replacement)
+        return CompactionResult(kept, total, after, len(dropped))
+
+    def reserve(self, messages: Sequence[Dict], pinned: int) -> int:
+        """为替代内容（如摘要）预留的 token 数"""
+        return 0
+
+    def replace(self, dropped: List[Dict], counter: Callable[[Dict], int]) -> List[Dict]:
+        """被丢弃的消息用什么代替"""
+        return []
+
+
+class SlidingWindow(CompactionPolicy):
+    """只保留系统提示词和最近的回合"""
+    pass
+
+
+class PinFirstTurn(CompactionPolicy):
+    """固定保留系统提示词和第一个回合（通常是需求描述及其回答），其余按滑动窗口"""
+
+    def __init__(self, budget: int, counter: Optional[Callable[[Dict], int]] = None):
+        super().__init__(budget, pinned=3, counter=counter)
+
+
+def head_summarizer(max_chars: int = 200) -> Callable[[List[Dict]], str]:
+    """默认摘要：保留每条被丢弃消息的开头部分（不调用模型）"""
+    def summarize(dropped: List[Dict]) -> str:
+        lines = []
+        for m in dropped:
+            content = (m.get("content") or "").strip()
+            if len(content) > max_chars:
+                content = content[:max_chars] + "……"
+            lines.append(f"[{m.get('role')}] {content}")
+        return "\n".join(lines)
+    return summarize
+
+
+class SummarizeOlder(CompactionPolicy):
+    """
+    把被丢弃的旧回合替换为一段摘要（一对 user/assistant 消息，保持交替）。
+    summarizer 接收被丢弃的消息列表返回摘要文本，可以接入模型生成摘要。
+    """
+
+    def __init__(
+        self,
+        budget: int,
+        pinned: int = 1,
+        summarizer: Optional[Callable[[List[Dict]], str]] = None,
+        summary_tokens: int = 512,
+        counter: Optional[Callable[[Dict], int]] = None,
+    ):
+        super().__init__(budget, pinned=pinned, counter=counter)
+        self.summarizer = summarizer or head_summarizer()
+        self.summary_tokens = summary_tokens
+
+    def reserve(self, messages, pinned):
+        return self.summary_tokens
+
+    def replace(self, dropped, counter):
+        summary = self.summarizer(dropped)
+        ack = {"role": "assistant", "content": "已了解此前的对话内容。"}
+        budget = self.summary_tokens - counter(ack)
+        # 摘要超出预留时按比例截短
+        for _ in range(3):
+            msg = {"role": "user", "content": f"（以下是此前对话的摘要）\n{summary}"}
+            tokens = counter(msg)
+            if tokens <= budget or not summary:
+                break
+            summary = summary[:int(len(summary) * budget / tokens * 0.95)]
+        return [msg, ack]
@@ -72,7 +72,11 @@ class DependencyResolver:
         except subprocess.CalledProcessError as e:
             raise RuntimeError(f"依赖安装失败：{package} (exit {e.returncode})") from e
 
-    def test_from_file(self, path: str) -> bool:
+    def test_from_file(self, path: str, project_root: str = None) -> bool:
+        """
+        检查文件中的 import 是否都能导入；
+        指定 project_root 时该目录下的本地模块（如 solution）视为可导入，不在当前进程中导入。
+        """
         import importlib
         with open(path, 'r', encoding='utf-8') as f:
             tree = ast.parse(f.read(), filename=path)
@@ -87,6 +91,8 @@ class DependencyResolver:
                     mods.add(node.module)
 
         for m in sorted(mods):
+            if project_root is not None and self._is_local(project_root, m):
+                continue
             try:
                 importlib.import_module(m)
             except ImportError:
@@ -95,12 +101,19 @@ class DependencyResolver:
         return True
 
 
-    def install_from_files(self) -> None:
+    @staticmethod
+    def _is_local(project_root: str, module: str) -> bool:
+        top = Path(project_root) / module.split(".", 1)[0]
+        return top.with_suffix(".py").is_file() or (top / "__init__.py").is_file()
+
+
+    def install_from_files(self, project_root: str = None) -> None:
         """
         扫描文件并使用 pipreqs 自动生成、安装缺失依赖（接口保持不变）。
+        project_root 为扫描的目录，默认为当前工作目录。
         """
-        # 假设脚本在项目根目录下执行；也可根据 filepaths 动态计算根目录
-        project_root = str(Path.cwd())
+        # 默认假设脚本在项目根目录下执行
+        project_root = str(project_root or Path.cwd())
 
         # 生成依赖列表
         to_install = self._generate_requirements(project_root)
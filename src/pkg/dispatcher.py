@@ -0,0 +1,143 @@
+from __future__ import annotations
+import time, queue, threading
+from typing import Callable, Dict, List, Optional
+
+_STOP = object()
+KINDS = ("think", "resp")
+
+
+class Subscriber:
+    """
+    流式输出的订阅者。
+        kind:        "think" / "resp" / "all"
+        granularity: "chunk" 原始分块；"batch" 按时间/大小合并；"line" 只投递完整的行
+    """
+
+    def __init__(self, callback: Callable[[str], None], kind: str = "all", granularity: str = "batch"):
+        if kind not in ("think", "resp", "all"):
+            raise ValueError(f"未知的订阅类型: {kind}")
+        if granularity not in ("chunk", "batch", "line"):
+            raise ValueError(f"未知的订阅粒度: {granularity}")
+        self.callback = callback
+        self.kinds = set(KINDS) if kind == "all" else {kind}
+        self.granularity = granularity
+        self._line_buf: Dict[str, List[str]] = {k: [] for k in KINDS}
+
+    def deliver_chunks(self, kind: str, chunks: List[str]):
+        if kind not in self.kinds:
+            return
+        if self.granularity == "chunk":
+            for text in chunks:
+                self.callback(text)
+        elif self.granularity == "batch":
+            self.callback("".join(chunks))
+        else:
+            buf = self._line_buf[kind]
+            buf.append("".join(chunks))
+            text = "".join(buf)
+            cut = text.rfind("\n") + 1
+            if cut:
+                self.callback(text[:cut])
+            buf[:] = [text[cut:]] if cut < len(text) else []
+
+    def flush(self):
+        if self.granularity != "line":
+            return
+        for kind in KINDS:
+            buf = self._line_buf[kind]
+            if buf:
+                self.callback("".join(buf))
+                buf.clear()
+
+
+class StreamDispatcher:
+    """
+    把网络读取和回调投递解耦：读取方只 put 到有界队列，
+    投递线程每 interval 秒或累计 max_chars 字符合并一次，交给各订阅者。
+    慢的消费者只会让分块合并得更大，不会拖慢读取（队列满时才形成背压）。
+    """
+
+    def __init__(
+        self,
+        subscribers: List[Subscriber],
+        interval: float = 0.016,
+        max_chars: int = 4096,
+        max_queue: int = 4096,
+    ):
+        self.subscribers = subscribers
+        self.interval = interval
+        self.max_chars = max_chars
+        self.batches = 0
+        self.chunks = 0
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        self._error: Optional[BaseException] = None
+        self._thread = threading.Thread(target=self._run, name="stream-dispatcher", daemon=True)
+        self._thread.start()
+
+    def put(self, kind: str, text: str):
+        if self._error is not None:
+            # 回调出错时尽早中断生成
+            raise self._error
+        self._queue.put((kind, text))
+
+    def put_nowait(self, kind: str, text: str) -> bool:
+        """不阻塞的 put，供事件循环线程使用；队列已满时返回 False"""
+        if self._error is not None:
+            raise self._error
+        try:
+            self._queue.put_nowait((kind, text))
+        except queue.Full:
+            return False
+        return True
+
+    def close(self, raise_error: bool = True):
+        """投递完剩余分块后结束；回调抛出的异常在这里重新抛出"""
+        self._queue.put(_STOP)
+        self._thread.join()
+        if raise_error and self._error is not None:
+            raise self._error
+
+    def _deliver(self, batch):
+        # 合并相邻的同类分块，保持顺序
+        runs = []
+        for kind, text in batch:
+            if runs and runs[-1][0] == kind:
+                runs[-1][1].append(text)
+            else:
+                runs.append((kind, [text]))
+        for kind, chunks in runs:
+            for sub in self.subscribers:
+                sub.deliver_chunks(kind, chunks)
+        self.batches += 1
+        self.chunks += len(batch)
+
+    def _run(self):
+        stopped = False
+        while not stopped:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            batch, size = [item], len(item[1])
+            deadline = time.perf_counter() + self.interval
+            while size < self.max_chars:
+                timeout = deadline - time.perf_counter()
+                try:
+                    item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopped = True
+                    break
+                batch.append(item)
+                size += len(item[1])
+            if self._error is None:
+                try:
+                    self._deliver(batch)
+                except BaseException as e:
+                    self._error = e
+        if self._error is None:
+            try:
+                for sub in self.subscribers:
+                    sub.flush()
+            except BaseException as e:
+                self._error = e
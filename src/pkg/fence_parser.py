@@ -0,0 +1,91 @@
+from __future__ import annotations
+import ast, threading
+from typing import Callable, List, Optional
+from .utils import FENCE_RE, clean_code, save
+from .dependency_resolver import DependencyResolver
+
+
+class FenceParser:
+    """
+    增量识别流式回答中的第一个代码块，结果与 extract_code 完全一致。
+    只有新到的文本里出现 ``` 时才在缓冲区上匹配，代码块一结束就回调 on_code(code)。
+
+    usage:
+        parser = FenceParser(on_code=lambda code: ...)
+        session.send(prompt, on_resp=parser.feed)
+    """
+
+    def __init__(self, on_code: Optional[Callable[[str], None]] = None):
+        self.on_code = on_code
+        self.code: Optional[str] = None
+        self._parts: List[str] = []
+        self._tail = ""
+
+    def feed(self, text: str) -> Optional[str]:
+        """输入一个分块，代码块在这一块结束时返回代码，否则返回 None"""
+        if self.code is not None or not text:
+            return None
+        self._parts.append(text)
+        # 与上一块末尾拼接，避免 ``` 被拆在两个分块之间
+        window = self._tail + text
+        self._tail = window[-2:]
+        if "```" not in window:
+            return None
+        buf = "".join(self._parts)
+        self._parts = [buf]
+        if "```python" not in buf.lower():
+            return None
+        m = FENCE_RE.search(buf)
+        if m is None:
+            return None
+        self.code = clean_code(m.group(1))
+        if self.on_code is not None:
+            self.on_code(self.code)
+        return self.code
+
+
+class PreparedFile:
+    """
+    代码块结束后在后台保存文件，并预先完成语法检查和 import 检查，
+    与模型的剩余输出并行；生成结束后直接使用结果，不再串行等待。
+    """
+
+    def __init__(self, path: str, code: str, name: Optional[str] = None, project_root: Optional[str] = None):
+        self.path = path
+        self.code = code
+        self.name = name or path                        # 报错信息中显示的文件名
+        self.project_root = project_root
+        self.save_error: Optional[BaseException] = None
+        self.syntax_error: Optional[SyntaxError] = None
+        self.imports_ok: Optional[bool] = None         # None 表示未能检查
+        self._saved = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"prepare-{path}", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            save(self.path, self.code)
+        except BaseException as e:
+            self.save_error = e
+            return
+        finally:
+            self._saved.set()
+        try:
+            ast.parse(self.code, filename=self.name)
+        except SyntaxError as e:
+            self.syntax_error = e
+            return
+        try:
+            self.imports_ok = DependencyResolver().test_from_file(self.path, self.project_root)
+        except Exception:
+            self.imports_ok = None
+
+    def wait_saved(self):
+        """等待文件写完，写入失败时抛出原异常"""
+        self._saved.wait()
+        if self.save_error is not None:
+            raise self.save_error
+
+    def wait(self) -> PreparedFile:
+        self._thread.join()
+        return self
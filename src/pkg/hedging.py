@@ -0,0 +1,333 @@
+from __future__ import annotations
+import time, queue, asyncio, threading
+from collections import deque
+from typing import Callable, Deque, Dict, Optional
+from .latency import percentile
+from .cancel import abort_stream, close_stream
+
+_END = object()
+_CLOSED = object()
+
+
+def _has_content(chunk) -> bool:
+    """分块是否带有思考链或回答内容（只有 role 的首个分块不算）"""
+    for choice in getattr(chunk, "choices", None) or ():
+        delta = choice.delta
+        if getattr(delta, "content", None) or getattr(delta, "reasoning_content", None):
+            return True
+    return False
+
+
+class HedgePolicy:
+    """
+    对冲请求策略：主请求在 delay 秒内没有产生第一个 token，就把同一请求发给备用端点/模型，
+    先产生内容的一方胜出，另一方被关闭。
+
+    参数:
+        base_url/api_key/model: 备用端点，不指定时沿用主会话的配置（例如只换模型）
+        threshold:   固定的对冲等待（秒）；为 None 时按主端点最近的首 token 时间学习
+        percentile:  学习模式下取主端点首 token 时间的百分位
+        min_samples: 样本不足时使用 default_threshold
+        max_samples: 只保留最近的样本
+    """
+
+    def __init__(
+        self,
+        base_url: Optional[str] = None,
+        api_key: Optional[str] = None,
+        model: Optional[str] = None,
+        threshold: Optional[float] = None,
+        percentile: float = 95,
+        min_samples: int = 20,
+        default_threshold: float = 5.0,
+        max_samples: int = 200,
+    ):
+        self.base_url = base_url
+        self.api_key = api_key
+        self.model = model
+        self.threshold = threshold
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.default_threshold = default_threshold
+        self._samples: Deque[float] = deque(maxlen=max_samples)
+        self._lock = threading.Lock()
+        self.stats = {"requests": 0, "hedged": 0, "secondary_wins": 0, "censored": 0}
+
+    def delay(self) -> float:
+        if self.threshold is not None:
+            return self.threshold
+        with self._lock:
+            samples = list(self._samples)
+        if len(samples) < self.min_samples:
+            return self.default_threshold
+        return percentile(samples, self.percentile)
+
+    def observe(self, ttft: float):
+        """记录主端点的一次首 token 时间"""
+        with self._lock:
+            self._samples.append(ttft)
+
+    def _count(self, key: str, value=1):
+        with self._lock:
+            self.stats[key] += value
+
+
+class _Race:
+    """两个流的比赛结果，供同步和异步实现共用"""
+
+    def __init__(self, policy: HedgePolicy):
+        self.policy = policy
+        self.start = time.perf_counter()
+        self.winner: Optional[int] = None
+        self.first: Dict[int, float] = {}
+        self.hedged = False
+        self.censored = False
+
+    def content(self, index: int):
+        """index 号流产生了第一个内容分块"""
+        now = time.perf_counter() - self.start
+        if index in self.first:
+            return
+        self.first[index] = now
+        if index == 0:
+            self.policy.observe(now)
+
+    def ended(self, index: int):
+        """
+        index 号流结束（正常、失败或被关闭）。主请求没产生内容就结束时（包括备用胜出后被立即关闭），
+        它的首 token 时间至少是已经过的时间，按此记录一个删失样本；否则学习到的阈值只来自够快的请求，越来越低，慢的端点上会一直对冲
+        """
+        if index != 0 or index in self.first or self.censored:
+            return
+        self.censored = True
+        self.policy.observe(time.perf_counter() - self.start)
+        self.policy._count("censored")
+
+    def win(self, index: int):
+        self.winner = index
+        if index == 1:
+            self.policy._count("secondary_wins")
+
+
+class HedgedStream:
+    """
+    同步版本：每个请求在独立线程中读取，分块放进同一个队列，迭代时只输出胜出一方的分块。
+    输掉的一方立即关闭，不再占用线程、连接和限流名额。
+    """
+
+    def __init__(self, open_primary: Callable, open_secondary: Callable, policy: HedgePolicy,
+                 stop_event: Optional[threading.Event] = None, poll: float = 0.05):
+        self._open = (open_primary, open_secondary)
+        self._race = _Race(policy)
+        self._policy = policy
+        self._stop_event = stop_event
+        self._poll = poll
+        self._queue: queue.Queue = queue.Queue()
+        self._streams: Dict[int, object] = {}
+        self._cancelled = {0: threading.Event(), 1: threading.Event()}
+        policy._count("requests")
+        self._start(0)
+
+    def _start(self, index: int):
+        threading.Thread(target=self._read, args=(index,), name=f"hedge-{index}", daemon=True).start()
+
+    def _read(self, index: int):
+        try:
+            stream = self._open[index]()
+            self._streams[index] = stream
+            if self._cancelled[index].is_set():
+                return
+            for chunk in stream:
+                if _has_content(chunk):
+                    self._race.content(index)
+                if self._cancelled[index].is_set():
+                    return
+                self._queue.put((index, chunk))
+            self._queue.put((index, _END))
+        except BaseException as e:
+            if not self._cancelled[index].is_set():
+                self._queue.put((index, e))
+        finally:
+            self._race.ended(index)
+            self._close_stream(index)
+
+    def _close_stream(self, index: int):
+        # 只由读取该流的线程调用
+        stream = self._streams.pop(index, None)
+        if stream is not None:
+            close_stream(stream)
+
+    def _cancel(self, index: int):
+        self._cancelled[index].set()
+        # 只关闭这一个流：独占连接时 shutdown 唤醒读取线程；共用的 HTTP/2 连接不受影响，由读取线程关闭这个流
+        stream = self._streams.get(index)
+        if stream is not None:
+            abort_stream(stream)
+
+    def _hedge(self):
+        if not self._race.hedged:
+            self._race.hedged = True
+            self._policy._count("hedged")
+            self._start(1)
+
+    def __iter__(self):
+        race = self._race
+        pending: Dict[int, list] = {0: [], 1: []}
+        failed: Dict[int, BaseException] = {}
+        deadline = race.start + self._policy.delay()
+        while True:
+            if self._stop_event is not None and self._stop_event.is_set():
+                return
+            timeout = self._poll
+            if not race.hedged:
+                timeout = max(0.0, min(timeout, deadline - time.perf_counter()))
+            try:
+                index, item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                if not race.hedged and time.perf_counter() >= deadline:
+                    self._hedge()
+                continue
+            if item is _CLOSED:
+                return
+
+            if race.winner is None:
+                if isinstance(item, BaseException):
+                    failed[index] = item
+                    if not race.hedged:
+                        # 主请求在产生内容前就失败了，立即改用备用请求
+                        self._hedge()
+                        continue
+                    if len(failed) == 2:
+                        raise failed[0]
+                    continue
+                if item is not _END and not _has_content(item):
+                    pending[index].append(item)
+                    continue
+                # 先产生内容（或直接正常结束）的一方胜出
+                race.win(index)
+                if race.hedged:
+                    self._cancel(1 - index)
+                yield from pending[index]
+                if item is _END:
+                    return
+                yield item
+                continue
+
+            if index != race.winner:
+                continue
+            if item is _END:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+
+    def close(self):
+        for index in (0, 1):
+            self._cancel(index)
+        # 唤醒正在等待的迭代
+        self._queue.put((-1, _CLOSED))
+
+
+class AsyncHedgedStream:
+    """异步版本：每个请求一个 task，逻辑与 HedgedStream 相同"""
+
+    def __init__(self, open_primary: Callable, open_secondary: Callable, policy: HedgePolicy):
+        self._open = (open_primary, open_secondary)
+        self._race = _Race(policy)
+        self._policy = policy
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self._streams: Dict[int, object] = {}
+        self._cancelled = {0: False, 1: False}
+        policy._count("requests")
+        self._start(0)
+
+    def _start(self, index: int):
+        self._tasks[index] = asyncio.ensure_future(self._read(index))
+
+    async def _read(self, index: int):
+        try:
+            stream = await self._open[index]()
+            self._streams[index] = stream
+            async for chunk in stream:
+                if _has_content(chunk):
+                    self._race.content(index)
+                if self._cancelled[index]:
+                    return
+                self._queue.put_nowait((index, chunk))
+            self._queue.put_nowait((index, _END))
+        except asyncio.CancelledError:
+            raise
+        except BaseException as e:
+            if not self._cancelled[index]:
+                self._queue.put_nowait((index, e))
+        finally:
+            self._race.ended(index)
+            stream = self._streams.pop(index, None)
+            if stream is not None:
+                try:
+                    await stream.close()
+                except Exception:
+                    pass
+
+    def _cancel(self, index: int):
+        self._cancelled[index] = True
+        task = self._tasks.get(index)
+        if task is not None:
+            task.cancel()
+
+    def _hedge(self):
+        if not self._race.hedged:
+            self._race.hedged = True
+            self._policy._count("hedged")
+            self._start(1)
+
+    async def __aiter__(self):
+        race = self._race
+        pending: Dict[int, list] = {0: [], 1: []}
+        failed: Dict[int, BaseException] = {}
+        deadline = race.start + self._policy.delay()
+        while True:
+            try:
+                if race.hedged:
+                    index, item = await self._queue.get()
+                else:
+                    timeout = max(0.0, deadline - time.perf_counter())
+                    index, item = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                self._hedge()
+                continue
+
+            if race.winner is None:
+                if isinstance(item, BaseException):
+                    failed[index] = item
+                    if not race.hedged:
+                        self._hedge()
+                        continue
+                    if len(failed) == 2:
+                        raise failed[0]
+                    continue
+                if item is not _END and not _has_content(item):
+                    pending[index].append(item)
+                    continue
+                race.win(index)
+                if race.hedged:
+                    self._cancel(1 - index)
+                for chunk in pending[index]:
+                    yield chunk
+                if item is _END:
+                    return
+                yield item
+                continue
+
+            if index != race.winner:
+                continue
+            if item is _END:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+
+    async def close(self):
+        for index in (0, 1):
+            self._cancel(index)
@@ -0,0 +1,228 @@
+from __future__ import annotations
+import asyncio, logging, threading, atexit, importlib.util
+from typing import Dict, List, Tuple, Optional
+import httpx
+
+logger = logging.getLogger(__name__)
+
+class HttpClientPool:
+    """
+    进程级 HTTP 客户端池，按 base_url 复用 httpx 客户端（keep-alive 连接池）。
+    多个会话（analyst/developer/tester，甚至多个 CodingManager）共享同一个池，
+    避免重复 TLS 握手，并用 limits 限制总连接数。
+    异步客户端只能在创建它的事件循环中使用，因此按 (base_url, 事件循环) 分别复用。
+
+    usage:
+        with HttpClientPool(max_connections=32, http2=True) as pool:
+            session = OpenAISession(api_key=..., base_url=..., http_pool=pool)
+    """
+
+    def __init__(
+        self,
+        max_connections: int = 32,
+        max_keepalive_connections: int = 16,
+        keepalive_expiry: float = 60.0,
+        http2: bool = False,
+        trust_env: bool = False,
+        timeout: float = 60,
+    ):
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        # http2 需要安装 h2，未安装时退回 HTTP/1.1
+        if http2 and importlib.util.find_spec("h2") is None:
+            logger.warning("未安装 h2，HTTP/2 已禁用（pip install httpx[http2]）")
+            http2 = False
+        self.http2 = http2
+        self.trust_env = trust_env
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._clients: Dict[str, httpx.Client] = {}
+        self._async_clients: Dict[Tuple[str, asyncio.AbstractEventLoop], httpx.AsyncClient] = {}
+        self._async_refs: Dict[int, List] = {}      # id(client) -> [client, base_url, 引用数, 是否私有]
+        self._refs: Dict[Tuple[str, str], int] = {}
+        self._warmed = set()
+        self._closed = False
+
+    @staticmethod
+    def _key(base_url: str) -> str:
+        return str(base_url).rstrip("/")
+
+    def _check(self):
+        if self._closed:
+            raise RuntimeError("HTTP 连接池已关闭")
+
+    def get(self, base_url: str) -> httpx.Client:
+        """获取（必要时创建）base_url 对应的同步客户端，引用计数 +1"""
+        key = self._key(base_url)
+        with self._lock:
+            self._check()
+            client = self._clients.get(key)
+            if client is None:
+                client = httpx.Client(trust_env=self.trust_env, timeout=self.timeout,
+                                      limits=self.limits, http2=self.http2)
+                self._clients[key] = client
+            self._refs[("sync", key)] = self._refs.get(("sync", key), 0) + 1
+            return client
+
+    def get_async(self, base_url: str) -> httpx.AsyncClient:
+        """
+        获取 base_url 对应的异步客户端，引用计数 +1，用完后调用 release_async。
+        在事件循环中调用时返回该循环共享的客户端；不在事件循环中时返回私有客户端，
+        由第一次使用它的事件循环驱动，引用归零时由调用方关闭。
+        """
+        key = self._key(base_url)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        with self._lock:
+            self._check()
+            self._drop_closed_loops()
+            client = self._async_clients.get((key, loop)) if loop is not None else None
+            if client is None:
+                client = httpx.AsyncClient(trust_env=self.trust_env, timeout=self.timeout,
+                                           limits=self.limits, http2=self.http2)
+                self._async_refs[id(client)] = [client, key, 0, loop is None]
+                if loop is not None:
+                    self._async_clients[(key, loop)] = client
+            self._async_refs[id(client)][2] += 1
+            return client
+
+    def retain_async(self, client: httpx.AsyncClient):
+        """为 get_async 取得的客户端再增加一个引用（如 fork 出的会话）"""
+        with self._lock:
+            entry = self._async_refs.get(id(client))
+            if entry is not None and entry[0] is client:
+                entry[2] += 1
+
+    def release_async(self, client: httpx.AsyncClient) -> bool:
+        """引用计数 -1；返回 True 表示这是引用归零的私有客户端，调用方应关闭它"""
+        with self._lock:
+            entry = self._async_refs.get(id(client))
+            if entry is None or entry[0] is not client or entry[2] <= 0:
+                return False
+            entry[2] -= 1
+            if entry[3] and entry[2] == 0:
+                del self._async_refs[id(client)]
+                return True
+            return False
+
+    def _drop_closed_loops(self):
+        """丢弃已关闭的事件循环的客户端（连接随循环一起失效，无法再 aclose）"""
+        for key, loop in [k for k in self._async_clients if k[1].is_closed()]:
+            client = self._async_clients.pop((key, loop))
+            self._async_refs.pop(id(client), None)
+
+    def release(self, base_url: str):
+        """同步会话关闭时调用，引用计数 -1；客户端保留以便后续会话复用"""
+        ref_key = ("sync", self._key(base_url))
+        with self._lock:
+            if self._refs.get(ref_key, 0) > 0:
+                self._refs[ref_key] -= 1
+
+    def warm_up(self, base_url: str, background: bool = True):
+        """
+        预热连接：提前完成 DNS/TCP/TLS 握手，连接留在 keep-alive 池中，
+        缩短第一次请求的首 token 时间。每个 base_url 只预热一次，失败忽略。
+        """
+        key = self._key(base_url)
+        with self._lock:
+            if key in self._warmed or self._closed:
+                return
+            self._warmed.add(key)
+
+        def _run():
+            try:
+                client = self._clients.get(key)
+                if client is not None:
+                    client.head(key, timeout=10)
+            except Exception:
+                pass
+
+        if background:
+            threading.Thread(target=_run, daemon=True).start()
+        else:
+            _run()
+
+    async def awarm_up(self, base_url: str):
+        """warm_up 的异步版本"""
+        key = self._key(base_url)
+        loop = asyncio.get_running_loop()
+        if ("async", key, id(loop)) in self._warmed or self._closed:
+            return
+        self._warmed.add(("async", key, id(loop)))
+        try:
+            client = self._async_clients.get((key, loop))
+            if client is not None:
+                await client.head(key, timeout=10)
+        except Exception:
+            pass
+
+    def stats(self) -> Dict[str, int]:
+        """每个 base_url 当前的会话引用数"""
+        with self._lock:
+            stats = {f"{kind}:{url}": n for (kind, url), n in self._refs.items()}
+            for _, url, n, _ in self._async_refs.values():
+                stats[f"async:{url}"] = stats.get(f"async:{url}", 0) + n
+            return stats
+
+    def close(self):
+        """关闭所有同步客户端（异步客户端请使用 aclose）"""
+        with self._lock:
+            self._closed = True
+            clients = list(self._clients.values())
+            self._clients.clear()
+        for c in clients:
+            try:
+                c.close()
+            except Exception:
+                pass
+
+    async def aclose(self):
+        """关闭所有同步客户端和当前事件循环的异步客户端，其他事件循环的异步客户端只丢弃"""
+        self.close()
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            clients = [c for (_, l), c in self._async_clients.items() if l is loop]
+            self._async_clients.clear()
+            self._async_refs = {k: v for k, v in self._async_refs.items() if v[3]}
+        for c in clients:
+            try:
+                await c.aclose()
+            except Exception:
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+
+_default_pools: Dict[bool, HttpClientPool] = {}
+_default_lock = threading.Lock()
+
+
+def default_pool(trust_env: bool = False) -> HttpClientPool:
+    """进程级默认连接池（按是否使用系统代理区分），退出时自动关闭"""
+    with _default_lock:
+        pool = _default_pools.get(trust_env)
+        if pool is None or pool._closed:
+            pool = _default_pools[trust_env] = HttpClientPool(trust_env=trust_env)
+        return pool
+
+
+@atexit.register
+def _close_default_pools():
+    for pool in _default_pools.values():
+        pool.close()
@@ -0,0 +1,152 @@
+from __future__ import annotations
+import math, time, threading
+from collections import deque
+from typing import Deque, Dict, List, Optional
+
+
+def percentile(values: List[float], q: float) -> float:
+    """最近秩百分位，q 取 0~100；空列表返回 0"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(q / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+class LatencyRecord:
+    """
+    一次请求的延迟记录，时间单位为秒，均相对于 send 开始（包含重试等待）。
+        connect:         最后一次尝试从发出请求到收到响应头
+        ttft_think:      第一个思考链 token，没有思考链时为 None
+        ttft_resp:       第一个回答 token，没有回答时为 None
+        gap_p50/p95/max: 相邻分块之间的间隔
+        tokens_per_sec:  completion_tokens / 从第一个 token 到结束的时间
+        wall:            总耗时
+    """
+
+    def __init__(self, role: str, model: str, base_url: str, connect: Optional[float],
+                 ttft_think: Optional[float], ttft_resp: Optional[float], gaps: List[float],
+                 completion_tokens: int, wall: float, generation: float, chunks: int, attempts: int):
+        self.role = role
+        self.model = model
+        self.base_url = base_url
+        self.connect = connect
+        self.ttft_think = ttft_think
+        self.ttft_resp = ttft_resp
+        self.gap_p50 = percentile(gaps, 50)
+        self.gap_p95 = percentile(gaps, 95)
+        self.gap_max = max(gaps) if gaps else 0.0
+        self.completion_tokens = completion_tokens
+        self.tokens_per_sec = completion_tokens / generation if generation > 0 else 0.0
+        self.wall = wall
+        self.chunks = chunks
+        self.attempts = attempts
+
+    @property
+    def ttft(self) -> Optional[float]:
+        """第一个 token（思考链或回答）"""
+        firsts = [t for t in (self.ttft_think, self.ttft_resp) if t is not None]
+        return min(firsts) if firsts else None
+
+    def to_dict(self) -> Dict:
+        return {
+            "role": self.role, "model": self.model, "base_url": self.base_url,
+            "connect": self.connect, "ttft": self.ttft, "ttft_think": self.ttft_think, "ttft_resp": self.ttft_resp,
+            "gap_p50": self.gap_p50, "gap_p95": self.gap_p95, "gap_max": self.gap_max,
+            "completion_tokens": self.completion_tokens, "tokens_per_sec": self.tokens_per_sec,
+            "wall": self.wall, "chunks": self.chunks, "attempts": self.attempts,
+        }
+
+    def __repr__(self):
+        return f"LatencyRecord({self.to_dict()!r})"
+
+
+class StreamTimer:
+    """send 内部使用：记录一次请求（可能多次尝试）的各个时间点"""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.attempts = 0
+        self.connect: Optional[float] = None
+        self.first: Dict[str, Optional[float]] = {"think": None, "resp": None}
+        self.gaps: List[float] = []
+        self.chunks = 0
+        self._attempt_start = self.start
+        self._last: Optional[float] = None
+        self.attempt_ttft: Optional[float] = None      # 本次尝试的首 token 时间
+
+    def attempt(self):
+        self.attempts += 1
+        self._attempt_start = time.perf_counter()
+        self._last = None
+        self.attempt_ttft = None
+
+    def connected(self):
+        self.connect = time.perf_counter() - self._attempt_start
+
+    def chunk(self, kind: str):
+        now = time.perf_counter()
+        if self.first[kind] is None:
+            self.first[kind] = now - self.start
+        if self.attempt_ttft is None:
+            self.attempt_ttft = now - self._attempt_start
+        if self._last is not None:
+            self.gaps.append(now - self._last)
+        self._last = now
+        self.chunks += 1
+
+    def finish(self, role: str, model: str, base_url: str, completion_tokens: int) -> LatencyRecord:
+        wall = time.perf_counter() - self.start
+        firsts = [t for t in self.first.values() if t is not None]
+        generation = wall - min(firsts) if firsts else 0.0
+        return LatencyRecord(role, model, base_url, self.connect, self.first["think"], self.first["resp"],
+                             self.gaps, completion_tokens, wall, generation, self.chunks, self.attempts)
+
+
+class LatencyStats:
+    """
+    按 (角色, 模型) 汇总延迟记录，线程安全；多个会话可以共用一个实例。
+    每个分组只保留最近 max_records 条记录。
+    """
+
+    def __init__(self, max_records: int = 1000):
+        self.max_records = max_records
+        self._records: Dict[str, Deque[LatencyRecord]] = {}
+        self._lock = threading.Lock()
+
+    def add(self, record: LatencyRecord):
+        key = f"{record.role or '-'}/{record.model}"
+        with self._lock:
+            if key not in self._records:
+                self._records[key] = deque(maxlen=self.max_records)
+            self._records[key].append(record)
+
+    def records(self) -> List[LatencyRecord]:
+        with self._lock:
+            return [r for group in self._records.values() for r in group]
+
+    def summary(self) -> Dict[str, Dict]:
+        """{"角色/模型": {requests, ttft_p50, ttft_p95, gap_p95, gap_max, tokens_per_sec, wall_p50, wall_p95}}"""
+        with self._lock:
+            groups = {k: list(v) for k, v in self._records.items()}
+        report = {}
+        for key, records in groups.items():
+            ttfts = [r.ttft for r in records if r.ttft is not None]
+            walls = [r.wall for r in records]
+            tokens = sum(r.completion_tokens for r in records)
+            generation = sum(r.completion_tokens / r.tokens_per_sec for r in records if r.tokens_per_sec > 0)
+            report[key] = {
+                "requests": len(records),
+                "ttft_p50": percentile(ttfts, 50),
+                "ttft_p95": percentile(ttfts, 95),
+                "gap_p95": percentile([r.gap_p95 for r in records], 95),
+                "gap_max": max((r.gap_max for r in records), default=0.0),
+                "tokens_per_sec": tokens / generation if generation > 0 else 0.0,
+                "wall_p50": percentile(walls, 50),
+                "wall_p95": percentile(walls, 95),
+            }
+        return report
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
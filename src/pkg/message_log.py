@@ -0,0 +1,168 @@
+from __future__ import annotations
+import json, hashlib
+from typing import Dict, List, Iterator, Optional, Sequence, Union
+
+
+class FrozenMessage(dict):
+    """不可修改的消息，可以在多个快照之间安全共享"""
+    __slots__ = ("hash", "encoded")
+
+    def __init__(self, role: str, content: str, **extra):
+        super().__init__(role=role, content=content, **extra)
+        # 规范化编码只做一次，哈希与 transcript_store.message_hash 一致
+        self.encoded = json.dumps(self, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+        self.hash = hashlib.sha256(self.encoded.encode("utf-8")).hexdigest()[:32]
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("FrozenMessage 不可修改")
+
+    __setitem__ = __delitem__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return (_rebuild, (dict(self),))
+
+
+def _rebuild(data: Dict) -> FrozenMessage:
+    return FrozenMessage(**data)
+
+
+def freeze(message: Union[Dict, FrozenMessage]) -> FrozenMessage:
+    if isinstance(message, FrozenMessage):
+        return message
+    return FrozenMessage(**message)
+
+
+class _Segment:
+    """只追加的消息段；parent 指向它所接续的快照"""
+    __slots__ = ("items", "parent")
+
+    def __init__(self, parent: Optional[MessageSnapshot] = None):
+        self.items: List[FrozenMessage] = []
+        self.parent = parent
+
+
+class MessageSnapshot(Sequence):
+    """
+    消息历史的不可变快照，O(1) 创建，不拷贝消息。
+    可以直接作为 messages 交给 openai 客户端。
+    """
+    __slots__ = ("_seg", "_len", "_base", "_json")
+
+    def __init__(self, seg: _Segment, length: int):
+        self._seg = seg
+        self._len = length
+        self._base = len(seg.parent) if seg.parent is not None else 0
+        self._json: Optional[str] = None
+
+    def __len__(self) -> int:
+        return self._base + self._len
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        n = len(self)
+        if index < 0:
+            index += n
+        if not 0 <= index < n:
+            raise IndexError("消息下标越界")
+        if index >= self._base:
+            return self._seg.items[index - self._base]
+        return self._seg.parent[index]
+
+    def __iter__(self) -> Iterator[FrozenMessage]:
+        if self._seg.parent is not None:
+            yield from self._seg.parent
+        items = self._seg.items
+        for i in range(self._len):
+            yield items[i]
+
+    def __eq__(self, other):
+        if isinstance(other, (MessageSnapshot, list, tuple)):
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        return NotImplemented
+
+    def __repr__(self):
+        return f"MessageSnapshot({list(self)!r})"
+
+    def hashes(self) -> List[str]:
+        return [m.hash for m in self]
+
+    def to_json(self) -> str:
+        """规范化 JSON，只拼接每条消息预先编码好的结果，每个快照最多生成一次"""
+        if self._json is None:
+            self._json = "[" + ",".join(m.encoded for m in self) + "]"
+        return self._json
+
+    def to_list(self) -> List[Dict]:
+        return [dict(m) for m in self]
+
+
+class MessageLog(Sequence):
+    """
+    只追加的消息历史，替代 List[Dict]。
+    append 为 O(1)，snapshot() 为 O(1) 且与之后的追加互不影响。
+    """
+
+    def __init__(self, messages: Optional[Sequence[Dict]] = None):
+        self._seg = _Segment()
+        self._len = 0
+        self._snap: Optional[MessageSnapshot] = None
+        for m in messages or ():
+            self.append(m)
+
+    @classmethod
+    def from_snapshot(cls, snap: MessageSnapshot) -> MessageLog:
+        """在快照之上继续追加，不拷贝已有消息"""
+        log = cls()
+        log._seg = _Segment(snap)
+        log._snap = snap
+        return log
+
+    def append(self, message: Union[Dict, FrozenMessage]) -> FrozenMessage:
+        message = freeze(message)
+        if self._len != len(self._seg.items):
+            # 段尾已被其他日志占用，另起一段接在当前快照之后
+            self._seg = _Segment(self.snapshot())
+            self._len = 0
+        self._seg.items.append(message)
+        self._len += 1
+        self._snap = None
+        return message
+
+    def truncate(self, length: int):
+        """回退到前 length 条消息；不修改共享的消息段，已取出的快照不受影响"""
+        if length < 0 or length > len(self):
+            raise IndexError("消息下标越界")
+        snap = self.snapshot()
+        while length < snap._base:
+            snap = snap._seg.parent
+        self._seg = snap._seg
+        self._len = length - snap._base
+        self._snap = None
+
+    def snapshot(self) -> MessageSnapshot:
+        if self._snap is None:
+            self._snap = MessageSnapshot(self._seg, self._len)
+        return self._snap
+
+    def __len__(self) -> int:
+        return len(self.snapshot())
+
+    def __getitem__(self, index):
+        return self.snapshot()[index]
+
+    def __iter__(self) -> Iterator[FrozenMessage]:
+        return iter(self.snapshot())
+
+    def __eq__(self, other):
+        return self.snapshot() == other
+
+    def __repr__(self):
+        return f"MessageLog({list(self)!r})"
@@ -0,0 +1,190 @@
+from __future__ import annotations
+import json, time, queue, random, logging, threading, atexit, gzip, lzma
+from collections import deque
+from pathlib import Path
+from typing import Dict, Optional
+from .transcript_store import TranscriptStore
+
+_SUFFIX = {None: ".json", "gzip": ".json.gz", "lzma": ".json.xz"}
+_STOP = object()
+
+logger = logging.getLogger(__name__)
+
+class PayloadWriter:
+    """
+    后台写调试 payload：send 只把请求体放进有界队列，序列化、压缩和写盘都在后台线程完成。
+
+    参数:
+        directory:   输出目录
+        max_queue:   队列长度上限
+        policy:      队列满时的策略，"drop" 丢弃（默认），"block" 阻塞等待
+        compression: None / "gzip" / "lzma"
+        max_files:   最多保留的文件数，超出删除最旧的
+        max_bytes:   目录总大小上限（字节），超出删除最旧的
+        sample_rate: 采样率，0~1
+        store:       指定 TranscriptStore 时改为去重记录（每条消息只写一次），此时 compression/max_files/max_bytes
+                     不生效，大小由 store 的分段轮转（segment_bytes/max_segments）限制
+    """
+
+    def __init__(
+        self,
+        directory: str = "debug_payloads",
+        max_queue: int = 64,
+        policy: str = "drop",
+        compression: Optional[str] = None,
+        max_files: Optional[int] = 500,
+        max_bytes: Optional[int] = 200 * 1024 * 1024,
+        sample_rate: float = 1.0,
+        store: Optional[TranscriptStore] = None,
+    ):
+        if policy not in ("drop", "block"):
+            raise ValueError(f"未知的队列策略: {policy}")
+        if compression not in _SUFFIX:
+            raise ValueError(f"未知的压缩方式: {compression}")
+        self.directory = Path(directory)
+        self.policy = policy
+        self.compression = compression
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.sample_rate = sample_rate
+        self.store = store
+
+        self.written = 0
+        self.dropped = 0
+        self.sampled_out = 0
+        self.failed = 0
+
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        self._files: deque = deque()       # (path, size)，按写入顺序
+        self._total_bytes = 0
+        self._seq = 0
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="payload-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, payload: Dict, name: str = "payload") -> bool:
+        """
+        提交一个请求体（不做任何拷贝或序列化，调用方保证之后不再修改它）。
+        返回是否入队。
+        """
+        if self._closed:
+            return False
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            self.sampled_out += 1
+            return False
+        item = (name, int(time.time() * 1000), payload)
+        if self.policy == "block":
+            self._queue.put(item)
+            return True
+        try:
+            self._queue.put_nowait(item)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def flush(self):
+        """等待队列中的请求体全部写完"""
+        self._queue.join()
+
+    def close(self):
+        """写完剩余内容后停止后台线程"""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "written": self.written,
+            "dropped": self.dropped,
+            "sampled_out": self.sampled_out,
+            "failed": self.failed,
+            "files": len(self._files),
+            "bytes": self._total_bytes,
+        }
+
+    def _scan_existing(self):
+        """启动时登记目录中已有的文件，以便轮转时一并计入"""
+        try:
+            existing = sorted((p for p in self.directory.iterdir() if p.is_file()),
+                              key=lambda p: p.stat().st_mtime)
+        except FileNotFoundError:
+            return
+        for p in existing:
+            size = p.stat().st_size
+            self._files.append((p, size))
+            self._total_bytes += size
+
+    def _encode(self, payload: Dict) -> bytes:
+        data = json.dumps(payload, ensure_ascii=False, indent=2, default=list).encode("utf-8")
+        if self.compression == "gzip":
+            return gzip.compress(data, compresslevel=5)
+        if self.compression == "lzma":
+            return lzma.compress(data, preset=1)
+        return data
+
+    def _write(self, name: str, ts: int, payload: Dict):
+        if self.store is not None:
+            # MessageSnapshot 已预先算好每条消息的哈希
+            hashes = getattr(payload.get("messages"), "hashes", None)
+            self.store.record(payload, ts, hashes() if hashes else None)
+            self.written += 1
+            return
+        data = self._encode(payload)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._seq += 1
+        path = self.directory / f"{name}_{ts}_{self._seq:04d}{_SUFFIX[self.compression]}"
+        path.write_bytes(data)
+        self._files.append((path, len(data)))
+        self._total_bytes += len(data)
+        self.written += 1
+        self._rotate()
+
+    def _rotate(self):
+        """按文件数和总大小删除最旧的文件"""
+        while self._files and (
+            (self.max_files is not None and len(self._files) > self.max_files)
+            or (self.max_bytes is not None and self._total_bytes > self.max_bytes)
+        ):
+            path, size = self._files.popleft()
+            self._total_bytes -= size
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+
+    def _run(self):
+        if self.store is None:
+            self._scan_existing()
+        while True:
+            item = self._queue.get()
+            try:
+                if item is _STOP:
+                    return
+                self._write(*item)
+            except Exception as e:
+                self.failed += 1
+                logger.warning("无法写调试文件: %s", e)
+            finally:
+                self._queue.task_done()
+
+
+_default_writer: Optional[PayloadWriter] = None
+_default_lock = threading.Lock()
+
+
+def default_writer() -> PayloadWriter:
+    """进程级默认 writer，去重记录到 debug_payloads 目录（按分段轮转限制总大小），退出时写完剩余内容"""
+    global _default_writer
+    with _default_lock:
+        if _default_writer is None or _default_writer._closed:
+            _default_writer = PayloadWriter(store=TranscriptStore("debug_payloads"))
+        return _default_writer
+
+
+@atexit.register
+def _close_default_writer():
+    if _default_writer is not None:
+        _default_writer.close()
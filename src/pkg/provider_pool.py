@@ -0,0 +1,187 @@
+from __future__ import annotations
+import re, time, threading
+from collections import deque
+from typing import Deque, Dict, Iterable, List, Optional
+
+_DURATION_RE = re.compile(r"([\d.]+)(ms|h|m|s)")
+_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_reset(value: Optional[str]) -> Optional[float]:
+    """解析 x-ratelimit-reset-* 头（"1s"、"6m0s"、"250ms" 或纯数字秒），返回秒数"""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION_RE.findall(value)
+    if not parts:
+        return None
+    return sum(float(n) * _UNITS[u] for n, u in parts)
+
+
+def _int_header(headers, name: str) -> Optional[int]:
+    try:
+        value = headers.get(name)
+        return int(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+class Endpoint:
+    """
+    一个 OpenAI 兼容端点及其健康状态。
+        model:  该端点上的模型名，不指定时使用会话的 model（不同服务商的模型名可能不同）
+        weight: 权重越大越优先
+        limiter: 该端点的 RateLimiter，不指定时使用会话的限流器
+    """
+
+    def __init__(self, base_url: str, api_key: str, model: Optional[str] = None,
+                 weight: float = 1.0, name: Optional[str] = None, limiter=None):
+        self.base_url = base_url
+        self.api_key = api_key
+        self.model = model
+        self.weight = weight
+        self.name = name or base_url
+        self.limiter = limiter
+        self.results: Deque[bool] = deque()
+        self.ttft_ewma: Optional[float] = None
+        self.failures = 0                   # 连续失败次数
+        self.in_flight = 0
+        self.ejected_until = 0.0
+        self.remaining_requests: Optional[int] = None
+        self.limit_requests: Optional[int] = None
+        self.rate_limited_until = 0.0
+
+    @property
+    def error_rate(self) -> float:
+        return self.results.count(False) / len(self.results) if self.results else 0.0
+
+    def available(self, now: float) -> bool:
+        return now >= self.ejected_until and now >= self.rate_limited_until
+
+    def __repr__(self):
+        return f"Endpoint({self.name!r})"
+
+
+class ProviderPool:
+    """
+    多个 OpenAI 兼容端点组成的池，每次请求按实时健康度选择端点：
+    最近的错误率、首 token 时间的指数滑动平均（EWMA）和响应头中的剩余配额。
+    连续失败或错误率过高的端点被摘除 cooldown 秒，之后先放行一个请求试探。
+    线程安全，多个会话（同步或异步）可以共用一个池。
+
+    usage:
+        pool = ProviderPool([
+            Endpoint("https://api.deepseek.com/v1", key1, model="deepseek-reasoner"),
+            Endpoint("https://api.lkeap.cloud.tencent.com/v1", key2, model="deepseek-r1"),
+        ])
+        session = OpenAISession(api_key="", provider_pool=pool)
+    """
+
+    def __init__(
+        self,
+        endpoints: Iterable[Endpoint],
+        window: int = 20,
+        max_error_rate: float = 0.5,
+        min_requests: int = 5,
+        max_failures: int = 3,
+        cooldown: float = 30.0,
+        ewma_alpha: float = 0.3,
+        default_ttft: float = 2.0,
+    ):
+        self.endpoints: List[Endpoint] = list(endpoints)
+        if not self.endpoints:
+            raise ValueError("端点列表为空")
+        for ep in self.endpoints:
+            ep.results = deque(maxlen=window)
+        self.max_error_rate = max_error_rate
+        self.min_requests = min_requests
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.ewma_alpha = ewma_alpha
+        self.default_ttft = default_ttft
+        self._lock = threading.Lock()
+        self.failovers = 0
+
+    def _score(self, ep: Endpoint) -> float:
+        """越小越好"""
+        ttft = ep.ttft_ewma if ep.ttft_ewma is not None else self.default_ttft
+        score = ttft * (1 + 4 * ep.error_rate) * (1 + 0.5 * ep.in_flight) / ep.weight
+        if ep.remaining_requests is not None and ep.limit_requests:
+            # 剩余配额越少越靠后
+            score *= 2 - ep.remaining_requests / ep.limit_requests
+        return score
+
+    def pick(self, exclude: Iterable[Endpoint] = ()) -> Endpoint:
+        """选择一个端点（in_flight +1，必须随后调用 report）；全部不可用时选最早恢复的"""
+        exclude = set(map(id, exclude))
+        now = time.monotonic()
+        with self._lock:
+            candidates = [ep for ep in self.endpoints if id(ep) not in exclude] or self.endpoints
+            healthy = [ep for ep in candidates if ep.available(now)]
+            if healthy:
+                ep = min(healthy, key=self._score)
+            else:
+                ep = min(candidates, key=lambda e: max(e.ejected_until, e.rate_limited_until))
+            if exclude:
+                self.failovers += 1
+            ep.in_flight += 1
+            return ep
+
+    def has_alternative(self, tried: Iterable[Endpoint]) -> bool:
+        """是否还有没试过且可用的端点"""
+        tried = set(map(id, tried))
+        now = time.monotonic()
+        with self._lock:
+            return any(id(ep) not in tried and ep.available(now) for ep in self.endpoints)
+
+    def report(self, ep: Endpoint, ok: Optional[bool], ttft: Optional[float] = None, headers=None):
+        """请求结束后汇报结果；ok 为 None 表示被手动中断，不计入健康度；headers 为响应头（可以为 None）"""
+        now = time.monotonic()
+        with self._lock:
+            ep.in_flight = max(0, ep.in_flight - 1)
+            if ok is None:
+                return
+            ep.results.append(ok)
+            if ok:
+                ep.failures = 0
+                ep.ejected_until = 0.0
+                if ttft is not None:
+                    a = self.ewma_alpha
+                    ep.ttft_ewma = ttft if ep.ttft_ewma is None else a * ttft + (1 - a) * ep.ttft_ewma
+            else:
+                ep.failures += 1
+                too_many = len(ep.results) >= self.min_requests and ep.error_rate >= self.max_error_rate
+                if ep.failures >= self.max_failures or too_many:
+                    ep.ejected_until = now + self.cooldown
+                    # 恢复后只要再失败一次就重新摘除
+                    ep.failures = self.max_failures - 1
+            if headers is not None:
+                self._update_limits(ep, headers, now)
+
+    def _update_limits(self, ep: Endpoint, headers, now: float):
+        remaining = _int_header(headers, "x-ratelimit-remaining-requests")
+        if remaining is None:
+            return
+        ep.remaining_requests = remaining
+        ep.limit_requests = _int_header(headers, "x-ratelimit-limit-requests") or ep.limit_requests
+        if remaining <= 0:
+            reset = parse_reset(headers.get("x-ratelimit-reset-requests")) or 1.0
+            ep.rate_limited_until = now + reset
+
+    def stats(self) -> Dict[str, Dict]:
+        now = time.monotonic()
+        with self._lock:
+            return {
+                ep.name: {
+                    "available": ep.available(now),
+                    "error_rate": ep.error_rate,
+                    "ttft_ewma": ep.ttft_ewma,
+                    "in_flight": ep.in_flight,
+                    "remaining_requests": ep.remaining_requests,
+                    "requests": len(ep.results),
+                }
+                for ep in self.endpoints
+            }
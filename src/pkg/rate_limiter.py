@@ -0,0 +1,328 @@
+from __future__ import annotations
+import time, sqlite3, asyncio, hashlib, threading
+from collections import OrderedDict, deque
+from pathlib import Path
+from typing import Deque, Dict, Optional, Tuple
+
+
+class _Bucket:
+    """每分钟 capacity 的令牌桶，按时间连续补充"""
+
+    def __init__(self, capacity: float):
+        self.capacity = capacity
+        self.rate = capacity / 60.0
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self, n: float) -> float:
+        """取出 n 个令牌并返回 0；不够时不取，返回还需等待的秒数"""
+        n = min(n, self.capacity)
+        self._refill()
+        if self.tokens >= n:
+            self.tokens -= n
+            return 0.0
+        return (n - self.tokens) / self.rate
+
+    def give_back(self, n: float):
+        """预留多了退回，少了补扣（n 为负）"""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + n)
+
+    def available(self) -> float:
+        self._refill()
+        return self.tokens
+
+
+class _SharedBucket:
+    """保存在 sqlite 中的令牌桶，同一台机器上的多个进程共享同一份配额"""
+
+    def __init__(self, path: str, key: str, capacity: float):
+        self.capacity = capacity
+        self.rate = capacity / 60.0
+        self.key = key
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL, updated REAL)")
+        self._conn.execute("INSERT OR IGNORE INTO buckets VALUES (?, ?, ?)", (key, capacity, time.time()))
+
+    def _update(self, n: float, force: bool) -> float:
+        conn = self._conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            tokens, updated = conn.execute("SELECT tokens, updated FROM buckets WHERE key=?", (self.key,)).fetchone()
+            now = time.time()
+            tokens = min(self.capacity, tokens + max(0.0, now - updated) * self.rate)
+            wait = 0.0
+            if force or tokens >= n:
+                tokens = min(self.capacity, tokens - n)
+            else:
+                wait = (n - tokens) / self.rate
+            conn.execute("UPDATE buckets SET tokens=?, updated=? WHERE key=?", (tokens, now, self.key))
+            conn.execute("COMMIT")
+            self._tokens = tokens
+            return wait
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def try_take(self, n: float) -> float:
+        return self._update(min(n, self.capacity), force=False)
+
+    def give_back(self, n: float):
+        self._update(-n, force=True)
+
+    def available(self) -> float:
+        self._update(0.0, force=True)
+        return self._tokens
+
+
+class _Ticket:
+    __slots__ = ("owner", "tokens", "granted", "event", "future", "loop")
+
+    def __init__(self, owner, tokens: float):
+        self.owner = owner
+        self.tokens = tokens
+        self.granted = False
+        self.event = threading.Event()
+        self.future: Optional[asyncio.Future] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+class Permit:
+    """一次获准的请求；结束后必须调用 release 汇报结果（重复调用无效）"""
+
+    def __init__(self, limiter: RateLimiter, tokens: float, waited: float):
+        self._limiter = limiter
+        self.tokens = tokens
+        self.waited = waited
+        self._released = False
+
+    def release(self, ok: bool = True, throttled: bool = False,
+                latency: Optional[float] = None, tokens_used: Optional[int] = None):
+        """
+        ok:          请求是否成功
+        throttled:   是否被服务端限流（429）
+        latency:     首 token 时间，用于延迟反馈
+        tokens_used: 实际消耗的 token，多预留的部分退回 TPM 配额；失败（ok=False）且未知用量时全部退回
+        """
+        if self._released:
+            return
+        self._released = True
+        self._limiter._release(self, ok, throttled, latency, tokens_used)
+
+
+class RateLimiter:
+    """
+    客户端限流：按 API key/端点限制每分钟请求数（rpm）和 token 数（tpm），
+    并发窗口按 AIMD 自适应：成功时缓慢增加，429 时减半，首 token 时间超过 latency_target 时小幅减小。
+    排队的请求按 owner（如每个 CodingManager）轮转放行，避免一个任务占满配额；请求只排队，不失败。
+    线程安全，同步和异步会话可以共用；指定 state_path 时 rpm/tpm 配额通过 sqlite 在多个进程间共享。
+
+    参数:
+        rpm/tpm:         每分钟请求数/token 数，None 表示不限制
+        max_concurrency: 并发窗口上限；min_concurrency 为下限；initial_concurrency 为初始值（默认上限）
+        latency_target:  首 token 时间目标（秒），None 表示只根据 429 调整
+        decrease_interval: 两次减小窗口的最小间隔（秒），避免一次 429 风暴连续减半
+    """
+
+    def __init__(
+        self,
+        rpm: Optional[int] = None,
+        tpm: Optional[int] = None,
+        max_concurrency: int = 16,
+        min_concurrency: int = 1,
+        initial_concurrency: Optional[int] = None,
+        latency_target: Optional[float] = None,
+        decrease_interval: float = 2.0,
+        state_path: Optional[str] = None,
+        name: str = "default",
+    ):
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.limit = float(initial_concurrency or max_concurrency)
+        self.latency_target = latency_target
+        self.decrease_interval = decrease_interval
+        self.name = name
+
+        def bucket(capacity, kind):
+            if capacity is None:
+                return None
+            if state_path is not None:
+                return _SharedBucket(state_path, f"{name}:{kind}", capacity)
+            return _Bucket(capacity)
+        self._rpm = bucket(rpm, "rpm")
+        self._tpm = bucket(tpm, "tpm")
+
+        self._lock = threading.Lock()
+        self._queues: OrderedDict = OrderedDict()       # owner -> deque[_Ticket]
+        self._refill_wait = 0.0
+        self._last_decrease = 0.0
+        self.in_flight = 0
+        self.metrics = {"acquired": 0, "waited": 0, "wait_time": 0.0, "max_wait": 0.0,
+                        "throttled": 0, "slow": 0, "max_queue_depth": 0}
+
+    # ---------- 调度 ----------
+
+    def _queue_depth(self) -> int:
+        return sum(len(q) for q in self._queues.values())
+
+    def _enqueue(self, ticket: _Ticket):
+        with self._lock:
+            self._queues.setdefault(ticket.owner, deque()).append(ticket)
+            self.metrics["max_queue_depth"] = max(self.metrics["max_queue_depth"], self._queue_depth())
+            self._dispatch()
+
+    def _remove(self, ticket: _Ticket) -> bool:
+        """撤销排队；已经放行时返回 False"""
+        with self._lock:
+            if ticket.granted:
+                return False
+            q = self._queues.get(ticket.owner)
+            if q is not None and ticket in q:
+                q.remove(ticket)
+                if not q:
+                    del self._queues[ticket.owner]
+            self._dispatch()
+            return True
+
+    def _dispatch(self):
+        """在锁内调用：按 owner 轮转放行，直到并发窗口或配额用完"""
+        self._refill_wait = 0.0
+        while self._queues and self.in_flight < max(self.min_concurrency, int(self.limit)):
+            owner, q = next(iter(self._queues.items()))
+            ticket = q[0]
+            wait = self._rpm.try_take(1) if self._rpm is not None else 0.0
+            if wait == 0.0 and self._tpm is not None:
+                wait = self._tpm.try_take(ticket.tokens)
+                if wait > 0 and self._rpm is not None:
+                    self._rpm.give_back(1)
+            if wait > 0:
+                self._refill_wait = wait
+                break
+            q.popleft()
+            if q:
+                self._queues.move_to_end(owner)
+            else:
+                del self._queues[owner]
+            self.in_flight += 1
+            ticket.granted = True
+            ticket.event.set()
+            if ticket.future is not None:
+                ticket.loop.call_soon_threadsafe(_resolve, ticket.future)
+
+    def _poll_interval(self) -> float:
+        # 配额不足时按补充时间轮询，其余情况由 release 唤醒
+        return min(max(self._refill_wait, 0.01), 0.1)
+
+    # ---------- 获取/释放 ----------
+
+    def acquire(self, tokens: int = 0, owner=None, cancel: Optional[threading.Event] = None) -> Optional[Permit]:
+        """排队直到获准；cancel 被设置时放弃排队并返回 None"""
+        start = time.perf_counter()
+        ticket = _Ticket(owner, tokens)
+        self._enqueue(ticket)
+        while not ticket.granted:
+            if cancel is not None and cancel.is_set():
+                if self._remove(ticket):
+                    return None
+                break
+            if not ticket.event.wait(self._poll_interval()):
+                with self._lock:
+                    self._dispatch()
+        return self._granted(ticket, start)
+
+    async def aacquire(self, tokens: int = 0, owner=None) -> Permit:
+        """acquire 的异步版本，任务被取消时撤销排队"""
+        start = time.perf_counter()
+        ticket = _Ticket(owner, tokens)
+        ticket.loop = asyncio.get_running_loop()
+        ticket.future = ticket.loop.create_future()
+        self._enqueue(ticket)
+        try:
+            while not ticket.granted:
+                try:
+                    await asyncio.wait_for(asyncio.shield(ticket.future), self._poll_interval())
+                except asyncio.TimeoutError:
+                    with self._lock:
+                        self._dispatch()
+        except asyncio.CancelledError:
+            if not self._remove(ticket):
+                # 取消的同时已被放行，归还名额
+                self._granted(ticket, start).release(ok=False)
+            raise
+        return self._granted(ticket, start)
+
+    def _granted(self, ticket: _Ticket, start: float) -> Permit:
+        waited = time.perf_counter() - start
+        with self._lock:
+            self.metrics["acquired"] += 1
+            if waited > 0.001:
+                self.metrics["waited"] += 1
+                self.metrics["wait_time"] += waited
+                self.metrics["max_wait"] = max(self.metrics["max_wait"], waited)
+        return Permit(self, ticket.tokens, waited)
+
+    def _release(self, permit: Permit, ok: bool, throttled: bool, latency: Optional[float], tokens_used: Optional[int]):
+        now = time.monotonic()
+        with self._lock:
+            self.in_flight -= 1
+            if self._tpm is not None:
+                if tokens_used:
+                    self._tpm.give_back(permit.tokens - tokens_used)
+                elif not ok:
+                    # 失败或中断的请求没有 usage，退回全部预留，避免 tpm 配额越用越少
+                    self._tpm.give_back(permit.tokens)
+            slow = self.latency_target is not None and latency is not None and latency > self.latency_target
+            if throttled or slow:
+                if now - self._last_decrease >= self.decrease_interval:
+                    self._last_decrease = now
+                    factor = 0.5 if throttled else 0.9
+                    self.limit = max(float(self.min_concurrency), self.limit * factor)
+                self.metrics["throttled" if throttled else "slow"] += 1
+            elif ok:
+                self.limit = min(float(self.max_concurrency), self.limit + 1.0 / max(self.limit, 1.0))
+            self._dispatch()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self.metrics)
+            stats.update(
+                limit=self.limit,
+                in_flight=self.in_flight,
+                queue_depth=self._queue_depth(),
+                avg_wait=self.metrics["wait_time"] / self.metrics["acquired"] if self.metrics["acquired"] else 0.0,
+            )
+            if self._rpm is not None:
+                stats["rpm_available"] = self._rpm.available()
+            if self._tpm is not None:
+                stats["tpm_available"] = self._tpm.available()
+            return stats
+
+
+def _resolve(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+_limiters: Dict[Tuple[str, str], RateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def limiter_for(base_url: str, api_key: str, **kwargs) -> RateLimiter:
+    """
+    进程级共享：同一 (base_url, api_key) 返回同一个 RateLimiter，第一次调用时用 kwargs 创建。
+    所有 CodingManager 的会话都用它即可共享同一份配额。
+    """
+    key = (str(base_url).rstrip("/"), hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16])
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            kwargs.setdefault("name", f"{key[0]}#{key[1]}")
+            limiter = _limiters[key] = RateLimiter(**kwargs)
+        return limiter
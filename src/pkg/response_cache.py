@@ -0,0 +1,138 @@
+from __future__ import annotations
+import json, time, sqlite3, hashlib, threading
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+# 不影响生成结果的请求参数，不参与缓存键
+_IGNORED_PARAMS = ("stream", "stream_options")
+
+
+def cache_key(request_kwargs: Dict) -> str:
+    """model + messages + 采样参数的规范化哈希"""
+    messages = request_kwargs.get("messages", [])
+    to_json = getattr(messages, "to_json", None)
+    if to_json is not None:
+        messages_json = to_json()
+    else:
+        messages_json = json.dumps(list(messages), ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    params = {k: v for k, v in request_kwargs.items() if k != "messages" and k not in _IGNORED_PARAMS}
+    params_json = json.dumps(params, ensure_ascii=False, sort_keys=True, separators=(",", ":"), default=str)
+    h = hashlib.sha256()
+    h.update(params_json.encode("utf-8"))
+    h.update(b"\0")
+    h.update(messages_json.encode("utf-8"))
+    return h.hexdigest()
+
+
+class ResponseCache:
+    """
+    持久化的 LLM 响应缓存（sqlite），命中时按原始分块重放流式输出。
+    多进程可同时使用同一个缓存文件。
+
+    参数:
+        path:        缓存数据库路径
+        max_bytes:   缓存总大小上限，超出按最近最少使用淘汰
+        max_entries: 条目数上限
+        ttl:         默认有效期（秒），None 表示永久
+    """
+
+    def __init__(
+        self,
+        path: str = "llm_cache/cache.sqlite3",
+        max_bytes: Optional[int] = 256 * 1024 * 1024,
+        max_entries: Optional[int] = None,
+        ttl: Optional[float] = None,
+    ):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), timeout=30, check_same_thread=False,
+                                     isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            " key TEXT PRIMARY KEY,"
+            " value BLOB NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " created REAL NOT NULL,"
+            " accessed REAL NOT NULL,"
+            " expires REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_accessed ON entries(accessed)")
+
+    def get(self, key: str) -> Optional[Tuple[List[Tuple[str, str]], Dict[str, int]]]:
+        """返回 (events, usage)；events 为 [("think"|"resp", 文本), ...]"""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires FROM entries WHERE key=?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            value, expires = row
+            if expires is not None and expires < now:
+                self._conn.execute("DELETE FROM entries WHERE key=?", (key,))
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE entries SET accessed=? WHERE key=?", (now, key))
+            self.hits += 1
+        data = json.loads(value)
+        return [tuple(e) for e in data["events"]], data["usage"]
+
+    def put(self, key: str, events: List[Tuple[str, str]], usage: Dict[str, int], ttl: Optional[float] = None):
+        value = json.dumps({"events": events, "usage": usage}, ensure_ascii=False).encode("utf-8")
+        now = time.time()
+        ttl = self.ttl if ttl is None else ttl
+        expires = now + ttl if ttl is not None else None
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO entries(key, value, size, created, accessed, expires)"
+                    " VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, value, len(value), now, now, expires))
+                self._evict(now)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _evict(self, now: float):
+        """删除过期条目，再按最近最少使用淘汰到容量以内"""
+        self._conn.execute("DELETE FROM entries WHERE expires IS NOT NULL AND expires < ?", (now,))
+        if self.max_entries is not None:
+            self._conn.execute(
+                "DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY accessed DESC"
+                " LIMIT -1 OFFSET ?)", (self.max_entries,))
+        if self.max_bytes is not None:
+            total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            if total > self.max_bytes:
+                rows = self._conn.execute("SELECT key, size FROM entries ORDER BY accessed").fetchall()
+                victims = []
+                for key, size in rows:
+                    if total <= self.max_bytes:
+                        break
+                    victims.append((key,))
+                    total -= size
+                self._conn.executemany("DELETE FROM entries WHERE key=?", victims)
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM entries")
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            count, size = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "entries": count, "bytes": size}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,117 @@
+from __future__ import annotations
+import random
+from typing import Dict, List, Optional
+import httpx, openai
+
+# 可重试的网络层异常（连接被重置、读超时等）
+_TRANSIENT_ERRORS = (
+    openai.APIConnectionError,          # 包含 APITimeoutError
+    httpx.TransportError,               # ConnectError/ReadError/ReadTimeout/RemoteProtocolError...
+    ConnectionError,
+    TimeoutError,
+)
+
+
+class RetryPolicy:
+    """
+    OpenAISession 的重试策略：指数退避 + 抖动，只重试 429、5xx 和网络层瞬时错误。
+
+    参数:
+        max_retries: 最大重试次数，0 表示不重试
+        base_delay:  第一次重试的基础等待（秒），之后每次翻倍
+        max_delay:   单次等待上限（秒）
+        jitter:      抖动比例，0~1，实际等待在 [delay*(1-jitter), delay] 之间
+        respect_retry_after: 服务端返回 Retry-After 时优先使用
+    """
+
+    def __init__(
+        self,
+        max_retries: int = 3,
+        base_delay: float = 1.0,
+        max_delay: float = 30.0,
+        jitter: float = 0.5,
+        respect_retry_after: bool = True,
+    ):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.respect_retry_after = respect_retry_after
+
+    def is_retryable(self, exc: BaseException) -> bool:
+        if isinstance(exc, openai.APIStatusError):
+            return exc.status_code == 429 or exc.status_code >= 500
+        return isinstance(exc, _TRANSIENT_ERRORS)
+
+    def delay(self, attempt: int, exc: Optional[BaseException] = None) -> float:
+        """第 attempt 次重试（从 0 开始）前的等待时间"""
+        if self.respect_retry_after and isinstance(exc, openai.APIStatusError):
+            retry_after = exc.response.headers.get("retry-after")
+            try:
+                if retry_after is not None:
+                    return min(self.max_delay, max(0.0, float(retry_after)))
+            except ValueError:
+                pass
+        delay = min(self.max_delay, self.base_delay * (2 ** attempt))
+        return delay * (1 - self.jitter * random.random())
+
+
+def is_rate_limited(exc: BaseException) -> bool:
+    return isinstance(exc, openai.APIStatusError) and exc.status_code == 429
+
+
+def is_endpoint_failure(exc: BaseException) -> bool:
+    """是否说明端点本身有问题（网络错误、5xx、429）；400 等请求错误换端点也一样，不计入健康度"""
+    if isinstance(exc, openai.APIStatusError):
+        return exc.status_code == 429 or exc.status_code >= 500
+    return isinstance(exc, _TRANSIENT_ERRORS)
+
+
+def error_reason(exc: BaseException) -> str:
+    """用于统计的错误分类"""
+    if isinstance(exc, openai.APIStatusError):
+        return str(exc.status_code)
+    return type(exc).__name__
+
+
+def new_retry_stats() -> Dict:
+    return {"requests": 0, "retries": 0, "retry_delay": 0.0, "failures": 0, "reasons": {}}
+
+
+class PartialStream:
+    """
+    记录已推给回调的流式内容。重试时新的流如果重复了之前已输出的前缀，
+    这部分不再推给回调，避免界面上出现重复内容；一旦内容不一致则标记 diverged 并照常输出。
+    """
+
+    def __init__(self):
+        self._shown: Dict[str, List[str]] = {"think": [], "resp": []}
+        self._ref: Optional[Dict[str, str]] = None
+        self._pos = {"think": 0, "resp": 0}
+        self.diverged = False
+
+    def restart(self):
+        """开始新的一次尝试"""
+        self._ref = {k: "".join(v) for k, v in self._shown.items()}
+        self._pos = {"think": 0, "resp": 0}
+        self.diverged = False
+
+    def feed(self, kind: str, text: str) -> str:
+        """返回这一块中需要推给回调的部分"""
+        if self._ref is None or self.diverged:
+            self._shown[kind].append(text)
+            return text
+        ref, pos = self._ref[kind], self._pos[kind]
+        self._pos[kind] = pos + len(text)
+        if pos >= len(ref):
+            self._shown[kind].append(text)
+            return text
+        overlap = ref[pos:pos + len(text)]
+        if text.startswith(overlap):
+            out = text[len(overlap):]
+            if out:
+                self._shown[kind].append(out)
+            return out
+        self.diverged = True
+        self._shown[kind].append(text)
+        return text
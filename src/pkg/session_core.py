@@ -0,0 +1,453 @@
+from __future__ import annotations
+import time
+from typing import List, Dict, Optional, Callable
+from .http_pool import HttpClientPool, default_pool
+from .payload_writer import PayloadWriter, default_writer
+from .message_log import MessageLog
+from .response_cache import ResponseCache, cache_key
+from .cassette import Cassette, CassetteMiss
+from .retry import RetryPolicy, PartialStream, error_reason, is_rate_limited, is_endpoint_failure, new_retry_stats
+from .rate_limiter import RateLimiter
+from .compaction import CompactionPolicy
+from .tokenizer import TokenizerService, PromptTooLarge, context_window_for
+from .latency import StreamTimer, LatencyRecord, LatencyStats
+from .provider_pool import ProviderPool, Endpoint
+from .hedging import HedgePolicy
+from .dispatcher import StreamDispatcher, Subscriber
+
+class GenerationInterrupted(Exception):
+    """手动中断生成时抛出"""
+    pass
+
+def parse_usage(u) -> Dict[str, int]:
+    """
+    统一 usage 格式，并取出服务商的前缀缓存命中/未命中 token 数：
+    deepseek 为 prompt_cache_hit_tokens/prompt_cache_miss_tokens，
+    openai 为 prompt_tokens_details.cached_tokens。
+    """
+    usage = {
+        "prompt_tokens": u.prompt_tokens or 0,
+        "completion_tokens": u.completion_tokens or 0,
+        "total_tokens": u.total_tokens or 0,
+    }
+    hit = getattr(u, "prompt_cache_hit_tokens", None)
+    miss = getattr(u, "prompt_cache_miss_tokens", None)
+    if hit is None:
+        details = getattr(u, "prompt_tokens_details", None)
+        hit = getattr(details, "cached_tokens", None) if details is not None else None
+    if hit is not None:
+        usage["prompt_cache_hit_tokens"] = hit
+        usage["prompt_cache_miss_tokens"] = miss if miss is not None else usage["prompt_tokens"] - hit
+    return usage
+
+
+class StreamReader:
+    """
+    解析一次流式请求的分块：累积回答/思考链、记录分块时间和 usage，按 PartialStream 去掉重试时重复的前缀后推给回调
+    """
+
+    def __init__(self, partial: PartialStream, events: Optional[List], timer: StreamTimer,
+                 on_resp: Optional[Callable[[str], None]], on_think: Optional[Callable[[str], None]],
+                 on_chunk: Optional[Callable[[str], None]]):
+        self.usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+        self._answer: List[str] = []
+        self._think: List[str] = []
+        self._partial = partial
+        self._events = events
+        self._timer = timer
+        self._callbacks = {"think": on_think, "resp": on_resp}
+        self._on_chunk = on_chunk
+        self._start = time.perf_counter()
+        timer.attempt()
+
+    def feed(self, chunk):
+        # 最后一个 chunk 带 usage（choices 通常为空）
+        if getattr(chunk, "usage", None):
+            self.usage = parse_usage(chunk.usage)
+
+        if not chunk.choices:
+            return
+
+        delta = chunk.choices[0].delta
+        # 先处理思考链，再处理回答
+        self._text("think", getattr(delta, "reasoning_content", None), self._think)
+        self._text("resp", getattr(delta, "content", None), self._answer)
+
+        fr = getattr(chunk.choices[0], "finish_reason", None)
+        if fr and fr != "stop":
+            raise RuntimeError(f"生成被意外中断，finish_reason={fr}")
+
+    def _text(self, kind: str, text: Optional[str], parts: List[str]):
+        if not text:
+            return
+        self._timer.chunk(kind)
+        if self._events is not None:
+            self._events.append((kind, text, time.perf_counter() - self._start))
+        parts.append(text)
+        text = self._partial.feed(kind, text)
+        if text:
+            callback = self._callbacks[kind]
+            if callback: callback(text)
+            if self._on_chunk: self._on_chunk(text)
+
+    def result(self):
+        """(usage, 完整回答, 思考链)"""
+        return self.usage, "".join(self._answer), "".join(self._think)
+
+
+class SessionCore:
+    """
+    OpenAISession 和 AsyncOpenAISession 共用的部分：会话配置、历史、请求构建、缓存/回放查找、
+    重试判断，以及限流、端点健康度、延迟和缓存的记账。子类只负责 I/O（创建客户端、打开流、等待、关闭）。
+    """
+
+    def __init__(
+        self,
+        api_key: str,
+        base_url: str,
+        model: str,
+        timeout: int,
+        max_tokens: int,
+        system_as_user: bool,
+        trust_env: bool,
+        extra_params: Optional[Dict],
+        http_pool: Optional[HttpClientPool],
+        capture_payloads: bool,
+        payload_writer: Optional[PayloadWriter],
+        cache: Optional[ResponseCache],
+        cassette: Optional[Cassette],
+        retry_policy: Optional[RetryPolicy],
+        on_retry: Optional[Callable[[int, Exception, float], None]],
+        compaction: Optional[CompactionPolicy],
+        tokenizer: Optional[TokenizerService],
+        context_window: Optional[int],
+        role: str,
+        on_latency: Optional[Callable[[LatencyRecord], None]],
+        latency_stats: Optional[LatencyStats],
+        hedge: Optional[HedgePolicy],
+        provider_pool: Optional[ProviderPool],
+        rate_limiter: Optional[RateLimiter],
+        coalesce_interval: Optional[float],
+        coalesce_chars: int,
+    ):
+        if provider_pool is not None:
+            # 使用端点池时 base_url/api_key 取第一个端点
+            base_url, api_key = provider_pool.endpoints[0].base_url, provider_pool.endpoints[0].api_key
+        # 共享连接池（默认禁用系统代理），同一 base_url 的会话复用 keep-alive 连接
+        self._pool = http_pool or default_pool(trust_env)
+        self.base_url = base_url
+        self._timeout = timeout
+        self.client = self._new_client(base_url, api_key)
+        self.model = model
+        self.max_tokens = max_tokens
+        self.system_as_user = system_as_user
+        self.extra = extra_params or {}
+        self.history = MessageLog()
+        self._sys_len = 0           # 系统提示词占用的消息数，rewind 时保留
+        self._stop = False
+        self._finish_early = False
+        self.cancel_latency: Optional[float] = None
+
+        # 调试 payload 由后台线程写盘，不占用请求延迟
+        self._payload_writer = (payload_writer or default_writer()) if capture_payloads else None
+        self._cache = cache
+        self._cassette = cassette
+
+        # 429/5xx/网络错误自动重试，on_retry(第几次重试, 异常, 等待秒数)
+        self._retry = retry_policy or RetryPolicy()
+        self._on_retry = on_retry
+        self.retry_stats = new_retry_stats()
+
+        # 历史超出 token 预算时按策略压缩
+        self._compaction = compaction
+        self.compaction_stats = {"compactions": 0, "tokens_saved": 0, "dropped_messages": 0}
+
+        # 本地分词器：发送前预估提示词大小，服务商不返回 usage 时用来补全
+        self.tokenizer = tokenizer or TokenizerService.for_model(model)
+        self.context_window = context_window or context_window_for(model)
+        self.last_preflight = 0
+
+        # 延迟统计：每次联网请求生成一条 LatencyRecord，按 (角色, 模型) 汇总到 latency
+        self.role = role
+        self._on_latency = on_latency
+        self.latency = latency_stats or LatencyStats()
+        self.last_latency: Optional[LatencyRecord] = None
+
+        # 多端点：每次请求（包括重试）按健康度选择端点，失败时立即切换到其他端点
+        self._providers = provider_pool
+        self._endpoint_clients: Dict[tuple, object] = {}
+        self.last_response_headers = None
+
+        # 客户端限流：请求前按 rpm/tpm 和自适应并发窗口排队，owner 相同的请求参与同一轮转（CodingManager 会设置）
+        self._limiter = rate_limiter
+        self.owner = None
+
+        # 对冲请求：主请求迟迟没有首 token 时把同一请求发给备用端点/模型，统计见 hedge.stats
+        self._hedge = hedge
+        self._hedge_client = None
+        if hedge is not None:
+            self._hedge_base_url = hedge.base_url or base_url
+            self._hedge_client = self._new_client(self._hedge_base_url, hedge.api_key or api_key)
+
+        # coalesce_interval 不为 None 时回调在独立线程按批次投递（例如 0.016 秒或 4096 字符）
+        self._coalesce_interval = coalesce_interval
+        self._coalesce_chars = coalesce_chars
+        self._subscribers: List[Subscriber] = []
+
+    def _new_client(self, base_url: str, api_key: str):
+        """从连接池取 httpx 客户端并创建 openai 客户端，由子类实现"""
+        raise NotImplementedError
+
+    def _warm_up_urls(self) -> List[str]:
+        return [ep.base_url for ep in self._providers.endpoints] if self._providers is not None else [self.base_url]
+
+    def set_sys_prompt(self, prompt):
+        if not self.history:
+            if self.system_as_user:
+                self.history.append({"role": "user", "content": prompt})
+            else:
+                self.history.append({"role": "system", "content": prompt})
+            self._sys_len = 1
+
+        else:
+            raise ValueError("设置系统提示词失败：历史不为空")
+
+    def _fork(self):
+        """复制会话对象并重置每次 send 的状态和统计；连接池引用由子类处理"""
+        if self._pool is None:
+            raise RuntimeError("会话已关闭")
+        child = object.__new__(type(self))
+        child.__dict__.update(self.__dict__)
+        child.history = MessageLog.from_snapshot(self.history.snapshot())
+        child._stop = False
+        child._finish_early = False
+        child.cancel_latency = None
+        child.retry_stats = new_retry_stats()
+        child.compaction_stats = {"compactions": 0, "tokens_saved": 0, "dropped_messages": 0}
+        child.last_preflight = 0
+        child.last_latency = None
+        child.last_response_headers = None
+        child._subscribers = list(self._subscribers)
+        child._endpoint_clients = dict(self._endpoint_clients)
+        return child
+
+    def rewind(self, turns: int = 1):
+        """撤销最近 turns 轮对话（user 及其回答），系统提示词保留；已 fork 出的会话不受影响"""
+        starts = [i for i, m in enumerate(self.history) if i >= self._sys_len and m["role"] == "user"]
+        if turns < 1 or turns > len(starts):
+            raise ValueError(f"只能撤销 1~{len(starts)} 轮对话")
+        self.history.truncate(starts[-turns])
+
+    @property
+    def turns(self) -> int:
+        """已完成的对话轮数（不含系统提示词）"""
+        return sum(1 for i, m in enumerate(self.history) if i >= self._sys_len and m["role"] == "user")
+
+    def subscribe(self, callback: Callable[[str], None], kind: str = "all", granularity: str = "batch") -> Subscriber:
+        """
+        订阅之后每次 send 的流式输出，在投递线程中执行。
+        kind: "think"/"resp"/"all"；granularity: "chunk"/"batch"/"line"
+        """
+        sub = Subscriber(callback, kind, granularity)
+        self._subscribers.append(sub)
+        return sub
+
+    def unsubscribe(self, sub: Subscriber):
+        self._subscribers.remove(sub)
+
+    def _dispatcher(self, on_resp, on_think, on_chunk) -> Optional[StreamDispatcher]:
+        """需要合并投递或有订阅者时返回投递器（回调都交给它），否则返回 None"""
+        if self._coalesce_interval is None and not self._subscribers:
+            return None
+        subscribers = list(self._subscribers)
+        if on_resp: subscribers.append(Subscriber(on_resp, "resp"))
+        if on_think: subscribers.append(Subscriber(on_think, "think"))
+        if on_chunk: subscribers.append(Subscriber(on_chunk, "all"))
+        return StreamDispatcher(subscribers, self._coalesce_interval or 0.0, self._coalesce_chars)
+
+    def finish_early(self):
+        """
+        让当前 send 在处理完这一块后正常结束（关闭连接），已收到的内容作为完整回答写入历史，
+        usage 由本地分词器估算。可以在回调或其他线程中调用。
+        """
+        self._finish_early = True
+
+    def estimate_tokens(self, user_input: str = "") -> int:
+        """预估加上 user_input 之后整个请求的提示词 token 数，可用于选择模型或调整 max_tokens"""
+        n = self.tokenizer.count_messages(self.history)
+        if user_input:
+            n += self.tokenizer.message_tokens({"role": "user", "content": user_input})
+        return n
+
+    def _compact(self):
+        """按策略压缩历史，只重建 MessageLog，不拷贝消息内容"""
+        result = self._compaction.compact(self.history, self.tokenizer.message_tokens)
+        if result is None:
+            return
+        self.history = MessageLog(result.messages)
+        self.compaction_stats["compactions"] += 1
+        self.compaction_stats["tokens_saved"] += result.tokens_saved
+        self.compaction_stats["dropped_messages"] += result.dropped
+        self.compaction_stats["last"] = {"before": result.tokens_before, "after": result.tokens_after}
+
+    def _prepare(self, user_input: str):
+        """追加用户消息并构建请求，返回 (request_kwargs, 预估提示词 token 数, max_tokens)"""
+        # 累积上下文
+        self.history.append({"role": "user", "content": user_input})
+        if self._compaction is not None:
+            self._compact()
+        # 不可变快照，O(1) 且不拷贝消息，直接交给客户端
+        snapshot = self.history.snapshot()
+
+        # 预估提示词 token 数（按消息缓存，增量计算），超出上下文直接拒绝，不浪费请求
+        prompt_tokens = self.tokenizer.count_messages(snapshot)
+        self.last_preflight = prompt_tokens
+        max_tokens = self.max_tokens
+        if self.context_window is not None:
+            if prompt_tokens >= self.context_window:
+                self.history.truncate(len(self.history) - 1)
+                raise PromptTooLarge(f"提示词约 {prompt_tokens} tokens，超出上下文长度 {self.context_window}")
+            max_tokens = min(max_tokens, self.context_window - prompt_tokens)
+
+        # 构建请求
+        request_kwargs = {
+            "model": self.model,
+            "messages": snapshot,
+            "stream": True,
+            "max_tokens": max_tokens,
+            "stream_options": {"include_usage": True},
+            **self.extra,
+        }
+
+        # 写调试 payload（后台线程序列化、写盘）
+        if self._payload_writer is not None:
+            self._payload_writer.submit(request_kwargs)
+        return request_kwargs, prompt_tokens, max_tokens
+
+    def _lookup(self, request_kwargs):
+        """查找 cassette 和缓存，返回 (缓存键, 命中的 (events, usage) 或 None, 回放节奏)"""
+        key = None
+        try:
+            replay = self._cassette.take(request_kwargs) if self._cassette is not None else None
+        except CassetteMiss:
+            # 回放缺失与请求失败一样回退这一轮，会话仍可继续使用
+            self.history.truncate(len(self.history) - 1)
+            raise
+        pacer = self._cassette if replay is not None else None
+        if replay is None and self._cache is not None:
+            key = cache_key(request_kwargs)
+            replay = self._cache.get(key)
+        return key, replay, pacer
+
+    def _replay_event(self, kind: str, text: str, answer_parts: List[str], on_resp, on_think, on_chunk):
+        if kind == "think":
+            if on_think: on_think(text)
+        else:
+            if on_resp: on_resp(text)
+            answer_parts.append(text)
+        if on_chunk: on_chunk(text)
+
+    def _new_events(self, key) -> Optional[List]:
+        # 需要缓存或录制时记录 (类型, 文本, 相对时间)
+        return [] if key is not None or self._cassette is not None else None
+
+    def _pick(self, tried: List[Endpoint]) -> Optional[Endpoint]:
+        return self._providers.pick(tried) if self._providers is not None else None
+
+    def _limiter_for(self, endpoint: Optional[Endpoint]) -> Optional[RateLimiter]:
+        """端点有自己的限流器时优先使用，否则使用会话的限流器"""
+        if endpoint is not None and endpoint.limiter is not None:
+            return endpoint.limiter
+        return self._limiter
+
+    def _route(self, request_kwargs, endpoint: Optional[Endpoint]):
+        """返回本次请求使用的客户端和请求参数（端点可以指定自己的模型）"""
+        client = self.client
+        if endpoint is not None:
+            client = self._endpoint_client(endpoint)
+            if endpoint.model:
+                request_kwargs = dict(request_kwargs, model=endpoint.model)
+        return client, request_kwargs
+
+    def _hedge_kwargs(self, request_kwargs):
+        return dict(request_kwargs, model=self._hedge.model or self.model)
+
+    def _endpoint_client(self, endpoint: Endpoint):
+        key = (endpoint.base_url, endpoint.api_key)
+        client = self._endpoint_clients.get(key)
+        if client is None:
+            client = self._new_client(endpoint.base_url, endpoint.api_key)
+            self._endpoint_clients[key] = client
+        return client
+
+    def _opened(self, stream_iter):
+        response = getattr(stream_iter, "response", None)
+        self.last_response_headers = response.headers if response is not None else None
+
+    def _attempt_succeeded(self, permit, endpoint: Optional[Endpoint], timer: StreamTimer, usage: Dict[str, int]):
+        if permit is not None:
+            permit.release(latency=timer.attempt_ttft, tokens_used=usage["total_tokens"])
+        if endpoint is not None:
+            self._providers.report(endpoint, True, timer.attempt_ttft, self.last_response_headers)
+
+    def _attempt_cancelled(self, permit, endpoint: Optional[Endpoint]):
+        """手动中断不计入端点健康度"""
+        if permit is not None:
+            permit.release(ok=False)
+        if endpoint is not None:
+            self._providers.report(endpoint, None)
+
+    def _attempt_failed(self, permit, endpoint: Optional[Endpoint], e: Exception, tried: List[Endpoint]):
+        if permit is not None:
+            permit.release(ok=False, throttled=is_rate_limited(e))
+        if endpoint is not None:
+            # 只有网络错误、5xx 和 429 计入端点健康度；手动中断和请求本身的错误（如 400）不计
+            ok = False if is_endpoint_failure(e) and not self._stop else None
+            response = getattr(e, "response", None)
+            self._providers.report(endpoint, ok, headers=getattr(response, "headers", None))
+            tried.append(endpoint)
+
+    def _retry_delay(self, attempt: int, e: Exception, endpoint: Optional[Endpoint], tried: List[Endpoint],
+                     history_len: int) -> Optional[float]:
+        """
+        返回第 attempt 次重试前的等待秒数；不再重试时回退本轮历史并返回 None，由调用方抛出异常
+        """
+        if attempt >= self._retry.max_retries or not self._retry.is_retryable(e):
+            self.history.truncate(history_len)
+            self.retry_stats["failures"] += 1
+            return None
+        delay = self._retry.delay(attempt, e)
+        # 还有其他端点可用时立即切换，不等待
+        if endpoint is not None and self._providers.has_alternative(tried):
+            delay = 0.0
+        reason = error_reason(e)
+        self.retry_stats["retries"] += 1
+        self.retry_stats["retry_delay"] += delay
+        self.retry_stats["reasons"][reason] = self.retry_stats["reasons"].get(reason, 0) + 1
+        if self._on_retry is not None:
+            self._on_retry(attempt + 1, e, delay)
+        return delay
+
+    def _finish(self, request_kwargs, usage: Dict[str, int], final_answer: str, reasoning: str, prompt_tokens: int,
+                timer: StreamTimer, endpoint: Optional[Endpoint], key, events) -> Dict[str, int]:
+        """请求成功后补全 usage、记录延迟、保存历史并写入缓存/cassette"""
+        # 服务商没有返回 usage 时用本地估算补全
+        if not usage.get("total_tokens"):
+            completion = self.tokenizer.count_text(reasoning) + self.tokenizer.count_text(final_answer)
+            usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion,
+                     "total_tokens": prompt_tokens + completion, "estimated": 1}
+
+        base_url = endpoint.base_url if endpoint is not None else self.base_url
+        record = timer.finish(self.role, self.model, base_url, usage["completion_tokens"])
+        self.last_latency = record
+        self.latency.add(record)
+        if self._on_latency is not None:
+            self._on_latency(record)
+
+        # 保存历史
+        self.history.append({"role": "assistant", "content": final_answer})
+        if key is not None:
+            self._cache.put(key, events, usage)
+        if self._cassette is not None:
+            self._cassette.record(request_kwargs, events, usage)
+        return usage
@@ -0,0 +1,146 @@
+from __future__ import annotations
+import re, threading, importlib.util
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+_CJK_RE = re.compile(r"[　-鿿가-힯＀-￯]")
+
+# 每条消息的格式开销（role、分隔符）和每次请求的固定开销，与 OpenAI 的计算方式一致
+MESSAGE_OVERHEAD = 4
+REQUEST_OVERHEAD = 3
+
+# 已知模型的上下文长度（按前缀匹配），未知模型不做检查
+CONTEXT_WINDOWS: List[Tuple[str, int]] = [
+    ("gpt-4o", 128000),
+    ("gpt-4.1", 1047576),
+    ("deepseek-chat", 65536),
+    ("deepseek-reasoner", 65536),
+    # 腾讯云等第三方平台上的 deepseek 模型名
+    ("deepseek-v3", 65536),
+    ("deepseek-r1", 65536),
+]
+
+
+class PromptTooLarge(ValueError):
+    """预估的提示词已超出模型上下文长度时抛出（请求不会发出）"""
+    pass
+
+
+def approx_tokens(text: str) -> int:
+    """离线粗估 token 数：中日韩字符约 1 token/字，其余约 4 字符/token"""
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+class ApproxCounter:
+    """不依赖任何第三方库的估算"""
+    name = "approx"
+
+    def count(self, text: str) -> int:
+        return approx_tokens(text)
+
+
+class TiktokenCounter:
+    """OpenAI 系列模型，需要 pip install tiktoken"""
+
+    def __init__(self, encoding: str = "o200k_base"):
+        import tiktoken
+        self._enc = tiktoken.get_encoding(encoding)
+        self.name = f"tiktoken:{encoding}"
+
+    def count(self, text: str) -> int:
+        return len(self._enc.encode(text, disallowed_special=()))
+
+
+class HFTokenizerCounter:
+    """加载 tokenizer.json（如 deepseek 官方提供的分词器），需要 pip install tokenizers"""
+
+    def __init__(self, path: str):
+        from tokenizers import Tokenizer
+        self._tok = Tokenizer.from_file(path)
+        self.name = f"hf:{path}"
+
+    def count(self, text: str) -> int:
+        return len(self._tok.encode(text, add_special_tokens=False).ids)
+
+
+def _tiktoken_or_approx(encoding: str):
+    def factory():
+        if importlib.util.find_spec("tiktoken") is None:
+            return ApproxCounter()
+        return TiktokenCounter(encoding)
+    return factory
+
+
+# 按模型名前缀选择分词器，可用 register_counter 扩展
+_REGISTRY: List[Tuple[str, Callable[[], object]]] = [
+    ("gpt-4o", _tiktoken_or_approx("o200k_base")),
+    ("gpt-4.1", _tiktoken_or_approx("o200k_base")),
+    ("o1", _tiktoken_or_approx("o200k_base")),
+    ("o3", _tiktoken_or_approx("o200k_base")),
+    ("gpt-", _tiktoken_or_approx("cl100k_base")),
+]
+
+
+def register_counter(prefix: str, factory: Callable[[], object]):
+    """注册模型族的分词器，后注册的优先"""
+    _REGISTRY.insert(0, (prefix, factory))
+
+
+def counter_for_model(model: str):
+    for prefix, factory in _REGISTRY:
+        if model.startswith(prefix):
+            return factory()
+    return ApproxCounter()
+
+
+def context_window_for(model: str) -> Optional[int]:
+    for prefix, window in CONTEXT_WINDOWS:
+        if model.startswith(prefix):
+            return window
+    return None
+
+
+class TokenizerService:
+    """
+    带缓存的本地 token 计数：按消息哈希记住每条消息的 token 数，
+    历史增长时只需要计算新消息，重新统计整个历史是增量的。
+    """
+
+    def __init__(self, counter=None, max_entries: int = 100000):
+        self.counter = counter or ApproxCounter()
+        self.max_entries = max_entries
+        self._memo: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def for_model(cls, model: str) -> TokenizerService:
+        return cls(counter_for_model(model))
+
+    def count_text(self, text: str) -> int:
+        return self.counter.count(text)
+
+    def message_tokens(self, message: Dict) -> int:
+        key = getattr(message, "hash", None)
+        if key is None:
+            # 普通 dict 没有预先算好的哈希，直接计数
+            return self.counter.count(message.get("content") or "") + MESSAGE_OVERHEAD
+        with self._lock:
+            n = self._memo.get(key)
+            if n is not None:
+                self._memo.move_to_end(key)
+                self.hits += 1
+                return n
+        n = self.counter.count(message.get("content") or "") + MESSAGE_OVERHEAD
+        with self._lock:
+            self.misses += 1
+            self._memo[key] = n
+            if len(self._memo) > self.max_entries:
+                self._memo.popitem(last=False)
+        return n
+
+    def count_messages(self, messages: Iterable[Dict]) -> int:
+        """整个请求的提示词 token 数"""
+        return REQUEST_OVERHEAD + sum(self.message_tokens(m) for m in messages)
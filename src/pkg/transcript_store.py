@@ -0,0 +1,189 @@
+from __future__ import annotations
+import re, sys, json, time, hashlib, threading
+from pathlib import Path
+from typing import Dict, List, Iterator, Optional, Tuple
+
+MESSAGES_FILE = "messages.jsonl"
+REQUESTS_FILE = "requests.jsonl"
+
+
+def segments(directory: Path) -> List[Tuple[Path, Path]]:
+    """目录中已轮转的分段（旧→新），每段为 (messages, requests)，不包括当前段"""
+    found = []
+    for path in directory.glob("requests.*.jsonl"):
+        m = re.fullmatch(r"requests\.(\d+)\.jsonl", path.name)
+        if m:
+            found.append((int(m.group(1)), directory / f"messages.{m.group(1)}.jsonl", path))
+    return [(msgs, reqs) for _, msgs, reqs in sorted(found)]
+
+
+def message_hash(message: Dict) -> str:
+    """消息内容的规范化哈希（键排序，保证同一内容得到同一哈希）"""
+    canonical = json.dumps(message, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:32]
+
+
+class TranscriptStore:
+    """
+    按内容寻址的对话记录：每条消息只写一次（messages.jsonl），
+    每次请求只记录参数和消息哈希列表（requests.jsonl）。
+    N 轮对话的存储从 O(N²) 降为 O(N)。
+
+    当前段（两个文件合计）超过 segment_bytes 时轮转为 messages.N.jsonl/requests.N.jsonl，
+    新的一段重新记录它引用的消息，每段可以单独还原；只保留最近 max_segments 段，
+    目录总大小约不超过 segment_bytes × (max_segments + 1)。segment_bytes 为 None 时不轮转。
+
+    usage:
+        store = TranscriptStore("debug_payloads")
+        store.record(request_kwargs)
+        TranscriptReader("debug_payloads").payload(-1)   # 还原最后一次请求体
+    """
+
+    def __init__(self, directory: str = "debug_payloads", segment_bytes: Optional[int] = 20 * 1024 * 1024,
+                 max_segments: int = 9):
+        self.directory = Path(directory)
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+        self._lock = threading.Lock()
+        self._known = None          # 延迟加载当前段已有的哈希
+        self._segment_size = 0
+        self.requests = 0
+        self.new_messages = 0
+        self.reused_messages = 0
+        self.rotations = 0
+
+    def _load_known(self):
+        self._known = set()
+        self._segment_size = sum(p.stat().st_size for p in (self.directory / MESSAGES_FILE,
+                                                             self.directory / REQUESTS_FILE) if p.exists())
+        path = self.directory / MESSAGES_FILE
+        if not path.exists():
+            return
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    self._known.add(json.loads(line)["h"])
+                except (ValueError, KeyError):
+                    continue      # 忽略崩溃时写了一半的行
+
+    def record(self, payload: Dict, ts: Optional[int] = None, hashes: Optional[List[str]] = None) -> int:
+        """
+        记录一次请求，返回请求序号。
+        hashes 可由调用方传入已算好的消息哈希，避免重复计算。
+        """
+        messages = payload.get("messages", [])
+        if hashes is None:
+            hashes = [message_hash(m) for m in messages]
+        params = dict(payload)
+        params["messages"] = hashes
+        entry = {"ts": ts if ts is not None else int(time.time() * 1000), "params": params}
+
+        with self._lock:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            if self._known is None or not (self.directory / MESSAGES_FILE).exists():
+                self._load_known()
+            new_lines = []
+            for h, m in zip(hashes, messages):
+                if h in self._known:
+                    self.reused_messages += 1
+                    continue
+                self._known.add(h)
+                self.new_messages += 1
+                new_lines.append(json.dumps({"h": h, "m": m}, ensure_ascii=False) + "\n")
+            # 先写消息再写请求，保证请求引用的消息一定存在
+            request_line = json.dumps(entry, ensure_ascii=False) + "\n"
+            if new_lines:
+                with open(self.directory / MESSAGES_FILE, "a", encoding="utf-8") as f:
+                    f.writelines(new_lines)
+            with open(self.directory / REQUESTS_FILE, "a", encoding="utf-8") as f:
+                f.write(request_line)
+            self._segment_size += sum(len(line.encode("utf-8")) for line in new_lines) + len(request_line.encode("utf-8"))
+            if self.segment_bytes is not None and self._segment_size >= self.segment_bytes:
+                self._rotate()
+            self.requests += 1
+            return self.requests - 1
+
+    def _rotate(self):
+        """当前段改名为下一个编号，删除超出 max_segments 的旧段；新的一段从空的哈希集合开始"""
+        rolled = segments(self.directory)
+        n = int(rolled[-1][1].name.split(".")[1]) + 1 if rolled else 1
+        for name in (MESSAGES_FILE, REQUESTS_FILE):
+            path = self.directory / name
+            if path.exists():
+                path.rename(self.directory / f"{path.stem}.{n:06d}.jsonl")
+        self._known = set()
+        self._segment_size = 0
+        self.rotations += 1
+        for msgs, reqs in segments(self.directory)[:-self.max_segments or None]:
+            for path in (msgs, reqs):
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    pass
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "requests": self.requests,
+            "new_messages": self.new_messages,
+            "reused_messages": self.reused_messages,
+            "rotations": self.rotations,
+        }
+
+
+class TranscriptReader:
+    """读取 TranscriptStore 目录（已轮转的各段和当前段，按时间顺序）并还原任意一次请求的完整请求体"""
+
+    def __init__(self, directory: str = "debug_payloads"):
+        self.directory = Path(directory)
+        self.messages: Dict[str, Dict] = {}
+        self.entries: List[Dict] = []
+        self.reload()
+
+    def reload(self):
+        self.messages.clear()
+        self.entries.clear()
+        files = [f for pair in segments(self.directory) for f in pair]
+        files += [self.directory / MESSAGES_FILE, self.directory / REQUESTS_FILE]
+        for path in files:
+            target = None if path.name.startswith("messages") else self.entries
+            if not path.exists():
+                continue
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        obj = json.loads(line)
+                    except ValueError:
+                        continue
+                    if target is None:
+                        self.messages[obj["h"]] = obj["m"]
+                    else:
+                        target.append(obj)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def payload(self, index: int) -> Dict:
+        """还原第 index 次请求的请求体（支持负数下标）"""
+        params = self.entries[index]["params"]
+        payload = dict(params)
+        payload["messages"] = [self.messages[h] for h in params["messages"]]
+        return payload
+
+    def timestamp(self, index: int) -> int:
+        return self.entries[index]["ts"]
+
+    def __iter__(self) -> Iterator[Dict]:
+        for i in range(len(self.entries)):
+            yield self.payload(i)
+
+
+if __name__ == "__main__":
+    # python -m pkg.transcript_store [目录] [序号]  打印还原后的请求体
+    directory = sys.argv[1] if len(sys.argv) > 1 else "debug_payloads"
+    reader = TranscriptReader(directory)
+    if len(sys.argv) > 2:
+        print(json.dumps(reader.payload(int(sys.argv[2])), ensure_ascii=False, indent=2))
+    else:
+        for i, entry in enumerate(reader.entries):
+            params = entry["params"]
+            print(f"{i}\t{entry['ts']}\t{params.get('model')}\t{len(params['messages'])} messages")
@@ -10,7 +10,10 @@ def extract_code(text: str) -> str:
     # 1. 提取代码块或整段
     m = FENCE_RE.search(text)
     code = m.group(1) if m else text
+    return clean_code(code)
 
+
+def clean_code(code: str) -> str:
     # 2. 去掉公共缩进
     dedented = textwrap.dedent(code)
 
@@ -26,7 +29,8 @@ def extract_code(text: str) -> str:
 def save(path: str, content: str):
     pathlib.Path(path).write_text(content, encoding="utf-8")
 
-def check_syntax(path: str):
+def check_syntax(path: str, filename: str = None):
+    # filename 为报错信息中显示的文件名，默认为 path
     with open(path, encoding='utf-8') as f:
         source = f.read()
-        ast.parse(source, filename=path)
+        ast.parse(source, filename=filename or path)
@@ -0,0 +1,68 @@
+from __future__ import annotations
+import os, shutil, tempfile
+from pathlib import Path
+from typing import Optional
+
+KEEP_POLICIES = ("never", "on_failure", "always")
+
+
+def tmpfs_dir() -> Optional[str]:
+    """可写的内存文件系统目录（Linux 的 /dev/shm），没有时返回 None"""
+    shm = "/dev/shm"
+    if os.path.isdir(shm) and os.access(shm, os.W_OK):
+        return shm
+    return None
+
+
+class Workspace:
+    """
+    一个 CodingManager 的工作目录：solution.py/test_solution.py 的保存、语法检查、依赖扫描和测试子进程都限定在这里，
+    多个任务可以在同一进程、同一台机器上并发运行。
+
+        path:   指定已有目录（不存在时创建），该目录不会被删除；为 None 时新建临时目录
+        tmpfs:  新建的临时目录放在内存文件系统（/dev/shm）中，不可用时退回系统临时目录
+        base_dir: 新建临时目录所在的目录，优先于 tmpfs
+        keep:   新建目录的保留策略：never 总是删除 / on_failure 测试未通过时保留 / always 总是保留
+
+    usage:
+        manager = CodingManager(..., workspace=Workspace(tmpfs=True, keep="on_failure"))
+        ...
+        manager.close()     # 按 keep 策略清理
+    """
+
+    def __init__(self, path: Optional[str] = None, tmpfs: bool = False,
+                 keep: str = "on_failure", prefix: str = "co-coding-", base_dir: Optional[str] = None):
+        if keep not in KEEP_POLICIES:
+            raise ValueError(f"keep 只能是 {', '.join(KEEP_POLICIES)}")
+        self.keep = keep
+        if path is None:
+            if base_dir is not None:
+                Path(base_dir).mkdir(parents=True, exist_ok=True)
+            else:
+                base_dir = tmpfs_dir() if tmpfs else None
+            self.root = Path(tempfile.mkdtemp(prefix=prefix, dir=base_dir))
+            self.owned = True
+        else:
+            self.root = Path(path)
+            self.root.mkdir(parents=True, exist_ok=True)
+            self.owned = False
+        self.removed = False
+
+    def path(self, name: str) -> str:
+        return str(self.root / name)
+
+    def cleanup(self, passed: bool = False) -> bool:
+        """按保留策略删除新建的目录，返回是否删除"""
+        if not self.owned or self.removed:
+            return False
+        if self.keep == "always" or (self.keep == "on_failure" and not passed):
+            return False
+        shutil.rmtree(self.root, ignore_errors=True)
+        self.removed = True
+        return True
+
+    def __fspath__(self):
+        return str(self.root)
+
+    def __repr__(self):
+        return f"Workspace({str(self.root)!r})"
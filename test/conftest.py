@@ -0,0 +1,143 @@
+import os, sys, json, time, asyncio, threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from pkg import OpenAISession, AsyncOpenAISession
+
+# test 目录下的 dev*/stream*/test_import.py 是手动运行的脚本，不作为测试收集
+collect_ignore_glob = ["dev*.py", "stream*.py", "test_import.py"]
+
+ANALYSIS = "<ANALYSIS>\n- 从 stdin 读取两个整数，输出它们的和\n"
+CODE = "```python\na, b = map(int, input().split())\nprint(a + b)\n```\n"
+TEST = ("```python\nimport subprocess, sys\n"
+        "r = subprocess.run([sys.executable, 'solution.py'], input='1 2\\n', capture_output=True, text=True)\n"
+        "print(r.stdout)\nsys.exit(0 if r.stdout.strip() == '3' else 1)\n```\n")
+
+
+class Drop(str):
+    """脚本返回 Drop(文本) 时输出这段文本后直接断开连接（模拟流中途断线）"""
+    pass
+
+
+def role_of(body) -> str:
+    """按 CodingManager 的系统提示词区分角色"""
+    sysmsg = body["messages"][0]["content"]
+    return "analyst" if "需求分析专家" in sysmsg else "developer" if "资深" in sysmsg else "tester"
+
+
+def default_script(role, k, body):
+    if role == "analyst":
+        return ANALYSIS
+    if role == "developer":
+        return CODE
+    return TEST
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        srv = self.server
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        role = role_of(body)
+        with srv.lock:
+            srv.requests.append((role, body))
+            k = sum(1 for r, _ in srv.requests if r == role)
+        reply = srv.script(role, k, body)
+        if isinstance(reply, int):
+            # 整数表示返回该状态码的错误
+            data = json.dumps({"error": {"message": f"status {reply}", "type": "fake"}}).encode()
+            self.send_response(reply)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def write(data: bytes):
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+
+        base = {"id": "x", "object": "chat.completion.chunk", "created": 0, "model": body["model"]}
+        try:
+            step = max(1, len(reply) // srv.pieces)
+            for i in range(0, len(reply), step):
+                time.sleep(srv.delay)
+                chunk = {**base, "choices": [{"index": 0, "delta": {"content": reply[i:i + step]}, "finish_reason": None}]}
+                write(f"data: {json.dumps(chunk)}\n\n".encode())
+            if isinstance(reply, Drop):
+                self.close_connection = True
+                return
+            write(f"data: {json.dumps({**base, 'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]})}\n\n".encode())
+            write(f"data: {json.dumps({**base, 'choices': [], 'usage': srv.usage})}\n\n".encode())
+            write(b"data: [DONE]\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+@pytest.fixture
+def fake_openai():
+    """
+    本地的 OpenAI 兼容流式服务：srv.script(role, 该角色第几次请求, body) 返回回答文本，
+    返回整数表示错误状态码，返回 Drop(文本) 表示输出后中途断线。
+    srv.requests 记录 (role, body)，srv.url 为 base_url，srv.usage 为每次返回的 usage。
+    """
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    srv.requests = []
+    srv.lock = threading.Lock()
+    srv.script = default_script
+    srv.delay = 0.0
+    srv.pieces = 4
+    srv.usage = {"prompt_tokens": 10, "completion_tokens": 8, "total_tokens": 18}
+    srv.url = f"http://127.0.0.1:{srv.server_address[1]}/v1"
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    yield srv
+    srv.shutdown()
+    srv.server_close()
+
+
+def _send(cls, url, user_input="hi", setup=None, **kwargs):
+    """用同步或异步会话发送一轮，返回 (usage, 会话)"""
+    kwargs.setdefault("capture_payloads", False)
+
+    def make():
+        session = cls(api_key="k", base_url=url, model="m", **kwargs)
+        if setup is not None:
+            setup(session)
+        return session
+
+    if cls is OpenAISession:
+        with make() as session:
+            return session.send(user_input), session
+
+    async def run():
+        async with make() as session:
+            return await session.send(user_input), session
+    return asyncio.run(run())
+
+
+@pytest.fixture(params=[OpenAISession, AsyncOpenAISession], ids=["sync", "async"])
+def session_cls(request):
+    return request.param
+
+
+@pytest.fixture
+def send():
+    """send(会话类, base_url, user_input="hi", setup=None, **会话参数) -> (usage, 会话)"""
+    return _send
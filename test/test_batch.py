@@ -0,0 +1,25 @@
+import asyncio
+from pkg.batch import BatchRunner, session_factory
+
+
+def test_run_closes_factory_pool(fake_openai, tmp_path):
+    factory = session_factory(fake_openai.url, "k", "m")
+    runner = BatchRunner(factory, concurrency=2, base_dir=str(tmp_path))
+    clients = []
+
+    async def run():
+        results = []
+        async for result in runner.run(["两数之和", "两数之和"]):
+            pool = factory.pool
+            clients.extend(c for c in pool._async_clients.values())
+            results.append(result)
+        return results, pool
+
+    results, pool = asyncio.run(run())
+    assert [r["status"] for r in results] == ["passed", "passed"]
+    # run() 结束后连接池已关闭，factory 之后会创建新的连接池
+    assert factory.pool is None and pool._closed
+    assert clients and all(c.is_closed for c in clients)
+
+    results, _ = asyncio.run(run())
+    assert [r["status"] for r in results] == ["passed", "passed"]
@@ -0,0 +1,103 @@
+import time, threading
+import pytest
+from pkg import OpenAISession, HttpClientPool
+from pkg.session_core import GenerationInterrupted
+from pkg.cancel import CancelScope, Cancelled, abort_stream
+
+
+class _Socket:
+    def __init__(self):
+        self.shutdowns = 0
+
+    def shutdown(self, how):
+        self.shutdowns += 1
+
+
+class _NetworkStream:
+    def __init__(self, sock):
+        self.sock = sock
+
+    def get_extra_info(self, name):
+        return self.sock if name == "socket" else None
+
+
+class _Response:
+    def __init__(self, http_version, sock):
+        self.extensions = {"http_version": http_version, "network_stream": _NetworkStream(sock)}
+
+
+class _Stream:
+    """模拟 openai 流：产出第一个分块后等待 gate，再产出剩下的分块"""
+
+    def __init__(self, http_version):
+        self.sock = _Socket()
+        self.response = _Response(http_version, self.sock)
+        self.gate = threading.Event()
+        self.closed_by = None
+
+    def __iter__(self):
+        yield "a"
+        self.gate.wait(5)
+        yield "b"
+        yield "c"
+
+    def close(self):
+        self.closed_by = threading.current_thread()
+
+
+def test_abort_only_shuts_down_exclusive_connections():
+    h1, h2 = _Stream(b"HTTP/1.1"), _Stream(b"HTTP/2")
+    assert abort_stream(h1) and h1.sock.shutdowns == 1 and h1.closed_by is not None
+    # HTTP/2 的连接由多个流共用，不能 shutdown，也不在其他线程中关闭
+    assert not abort_stream(h2)
+    assert h2.sock.shutdowns == 0 and h2.closed_by is None
+
+
+def test_cancel_shared_connection_stream():
+    stream = _Stream(b"HTTP/2")
+    scope = CancelScope()
+    chunks = scope.iterate(scope.open(lambda: stream))
+    assert next(chunks) == "a"
+    threading.Timer(0.05, scope.cancel).start()
+    start = time.perf_counter()
+    with pytest.raises(Cancelled):
+        next(chunks)
+    # 调用线程立即返回，读取线程在下一个分块到达时自己关闭这个流
+    assert time.perf_counter() - start < 1
+    assert stream.sock.shutdowns == 0 and stream.closed_by is None
+    stream.gate.set()
+    for _ in range(100):
+        if stream.closed_by is not None:
+            break
+        time.sleep(0.01)
+    assert stream.closed_by is not None and stream.closed_by is not threading.current_thread()
+
+
+def test_stop_leaves_sibling_stream_working(fake_openai):
+    fake_openai.script = lambda role, k, body: "x" * 40
+    fake_openai.pieces = 20
+    fake_openai.delay = 0.05
+    pool = HttpClientPool()
+    sessions = [OpenAISession(api_key="k", base_url=fake_openai.url, model="m", http_pool=pool,
+                              capture_payloads=False) for _ in range(2)]
+    results = {}
+
+    def run(i):
+        try:
+            results[i] = sessions[i].send("hi")
+        except GenerationInterrupted as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(2)]
+    for t in threads:
+        t.start()
+    time.sleep(0.3)
+    sessions[0].stop()
+    threads[0].join(1)
+    assert isinstance(results[0], GenerationInterrupted)
+    assert sessions[0].cancel_latency < 0.2
+    threads[1].join(5)
+    assert results[1]["total_tokens"] == 18
+    assert sessions[1].history[-1]["content"] == "x" * 40
+    sessions[1].close()
+    pool.close()
@@ -0,0 +1,47 @@
+import pytest
+from pkg import OpenAISession, Cassette, CassetteMiss
+from conftest import CODE
+
+# 回放时不应联网：指向一个没有服务的端口
+OFFLINE_URL = "http://127.0.0.1:9/v1"
+
+
+def test_record_then_replay_offline(send, fake_openai, session_cls, tmp_path):
+    fake_openai.script = lambda role, k, body: CODE
+    path = str(tmp_path / "tape.jsonl")
+    recorded, session = send(session_cls, fake_openai.url, "两数之和", cassette=Cassette(path, mode="record"))
+    answer = session.history[-1]["content"]
+    assert session._cassette.recorded == 1 and len(fake_openai.requests) == 1
+
+    tape = Cassette(path, mode="replay")
+    chunks = []
+    usage, replayed = send(session_cls, OFFLINE_URL, "两数之和", cassette=tape,
+                           setup=lambda s: s.subscribe(chunks.append, granularity="chunk"))
+    assert tape.played == 1 and len(fake_openai.requests) == 1
+    assert usage == recorded and replayed.history[-1]["content"] == answer
+    # 按录制的分块回放，而不是一次给出整段回答
+    assert len(chunks) > 1 and "".join(chunks) == answer
+
+
+def test_replay_miss_raises_and_keeps_history(send, session_cls, tmp_path):
+    path = tmp_path / "tape.jsonl"
+    path.write_text("")
+    tape = Cassette(str(path), mode="replay")
+    sessions = []
+    with pytest.raises(CassetteMiss):
+        send(session_cls, OFFLINE_URL, "没有录制过", cassette=tape, setup=sessions.append)
+    assert tape.played == 0 and len(sessions[0].history) == 0
+
+
+def test_auto_records_missing_and_replays_in_order(send, fake_openai, tmp_path):
+    fake_openai.script = lambda role, k, body: f"第 {k} 次"
+    path = str(tmp_path / "tape.jsonl")
+    for _ in range(2):
+        send(OpenAISession, fake_openai.url, "同一个问题", cassette=Cassette(path, mode="record"))
+
+    # 同一请求录制了多次时按录制顺序依次回放，用完后 auto 模式联网并追加录制
+    tape = Cassette(path, mode="auto")
+    answers = [send(OpenAISession, fake_openai.url, "同一个问题", cassette=tape)[1].history[-1]["content"]
+               for _ in range(3)]
+    assert answers == ["第 1 次", "第 2 次", "第 3 次"]
+    assert tape.played == 2 and tape.recorded == 1 and len(fake_openai.requests) == 3
@@ -0,0 +1,81 @@
+import json
+from pkg import OpenAISession, CodingManager
+from pkg.checkpoint import Checkpoint, HISTORY_FILE
+from pkg.coding_manager import INTERNAL_STAGE
+from conftest import CODE, default_script
+from test_coding_manager import make_manager
+
+
+def wrong_first_code(role, k, body):
+    # 第一版代码有错，测试失败后需要修复
+    if (role, k) == ("developer", 1):
+        return CODE.replace("a + b", "a - b")
+    if (role, k) == ("tester", 2):
+        return "<REPORT>\n结果不对"
+    return default_script(role, k, body)
+
+
+def run_until(manager, stage):
+    while manager.get_stage() != stage:
+        assert not manager.step()
+
+
+def resume(srv, path):
+    def session():
+        return OpenAISession(api_key="k", base_url=srv.url, model="m", capture_payloads=False)
+    return CodingManager.resume(path, lambda t, m: None, lambda t, m: None, lambda e, m: None,
+                                analyst=session(), developer=session(), tester=session())
+
+
+def test_resume_mid_repair_continues_to_pass(fake_openai, tmp_path):
+    fake_openai.script = wrong_first_code
+    cp = str(tmp_path / "cp")
+    manager = make_manager(fake_openai, tmp_path / "ws", [], checkpoint=cp)
+    manager.chat("两数之和")
+    run_until(manager, INTERNAL_STAGE.need_repairing)
+    histories = {role: s.history.snapshot().to_list() for role, s in manager._sessions.items()}
+    manager.close()
+    assert not manager.passed and "a - b" in manager.code
+
+    resumed = resume(fake_openai, cp)
+    assert resumed.get_stage() == INTERNAL_STAGE.need_repairing
+    assert resumed.report == manager.report and resumed.code == manager.code
+    assert {role: s.history.snapshot().to_list() for role, s in resumed._sessions.items()} == histories
+    sent = len(fake_openai.requests)
+    while not resumed.step():
+        pass
+    resumed.close()
+    assert resumed.passed and "a + b" in resumed.code
+    # 修复请求接着恢复的历史继续，而不是从头开始
+    role, body = fake_openai.requests[sent]
+    assert role == "developer"
+    assert body["messages"][:len(histories["developer"])] == histories["developer"]
+
+
+def test_load_truncates_torn_history_line(fake_openai, tmp_path):
+    cp = tmp_path / "cp"
+    manager = make_manager(fake_openai, tmp_path / "ws", [], checkpoint=str(cp))
+    manager.chat("两数之和")
+    manager.step()
+    manager.close()
+    path = cp / HISTORY_FILE
+    size = path.stat().st_size
+    lengths = manager._checkpoint_store.state["lengths"]
+
+    # 崩溃在追加历史和替换 state.json 之间：多出一条下一序号的完整行和一条写了一半的行
+    seq = manager._checkpoint_store.seq
+    extra = json.dumps({"seq": seq + 1, "role": "developer", "m": {"role": "user", "content": "x"}})
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(extra + "\n" + extra[:len(extra) // 2])
+
+    store = Checkpoint(str(cp))
+    assert path.stat().st_size == size
+    assert {role: len(m) for role, m in store.histories.items()} == lengths
+    assert store.histories["developer"] == manager._developer.history.snapshot().to_list()
+
+    resumed = resume(fake_openai, str(cp))
+    assert resumed.get_stage() == manager.get_stage()
+    while not resumed.step():
+        pass
+    resumed.close()
+    assert resumed.passed
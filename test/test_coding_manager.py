@@ -0,0 +1,149 @@
+import time, asyncio, threading
+import pytest
+from pkg import OpenAISession, AsyncOpenAISession, CodingManager, Workspace
+from pkg.coding_manager import EVENT_CODE, INTERNAL_STAGE
+from conftest import CODE, TEST, default_script
+
+
+def slow_developer(role, k, body):
+    # tester 先完成，developer 后完成
+    if role == "developer":
+        time.sleep(0.3)
+    return default_script(role, k, body)
+
+
+def make_manager(srv, workspace, events, session_cls=OpenAISession, **kwargs):
+    def session():
+        return session_cls(api_key="k", base_url=srv.url, model="m", capture_payloads=False)
+
+    def on_event(event, manager):
+        events.append((event, manager.get_stage(), threading.current_thread() is threading.main_thread()))
+    return CodingManager(session(), session(), session(), lambda t, m: None, lambda t, m: None, on_event,
+                         workspace=Workspace(str(workspace)), **kwargs)
+
+
+def test_parallel_step_emits_events_in_order(fake_openai, tmp_path):
+    fake_openai.script = slow_developer
+    events = []
+    manager = make_manager(fake_openai, tmp_path, events, parallel_tests=True)
+    assert manager.chat("两数之和")
+    assert not manager.step()
+    manager.close()
+    assert [e for e, _, _ in events] == [EVENT_CODE.analyzing_done, EVENT_CODE.developing_done,
+                                        EVENT_CODE.test_developing_done]
+    # 事件都在调用 step() 的线程中触发，阶段不会倒退
+    assert all(stage == INTERNAL_STAGE.need_testing for _, stage, _ in events[1:])
+    assert all(main for _, _, main in events)
+    assert manager.code.strip() in CODE and manager.test_code.strip() in TEST
+
+
+def test_parallel_step_keeps_tests_when_developer_fails(fake_openai, tmp_path):
+    fake_openai.script = lambda role, k, body: 400 if role == "developer" else default_script(role, k, body)
+    events = []
+    manager = make_manager(fake_openai, tmp_path, events, parallel_tests=True)
+    manager.chat("两数之和")
+    with pytest.raises(RuntimeError):
+        manager.step()
+    assert manager.get_stage() == INTERNAL_STAGE.need_developing
+    assert manager.test_code and not manager.code
+    assert [e for e, _, _ in events][-1] == EVENT_CODE.test_developing_done
+    manager.close()
+
+
+def test_async_parallel_run(fake_openai, tmp_path):
+    fake_openai.script = slow_developer
+    events = []
+
+    async def run():
+        manager = make_manager(fake_openai, tmp_path, events, AsyncOpenAISession, parallel_tests=True)
+        try:
+            return await manager.arun("两数之和")
+        finally:
+            await manager.aclose()
+
+    result = asyncio.run(run())
+    assert result.status == "passed"
+    assert [e for e, _, _ in events] == [EVENT_CODE.analyzing_done, EVENT_CODE.developing_done,
+                                        EVENT_CODE.test_developing_done, EVENT_CODE.done]
+    assert events[1][1] == events[2][1] == INTERNAL_STAGE.need_testing
+
+
+def test_parallel_step_writes_one_complete_checkpoint(fake_openai, tmp_path):
+    fake_openai.script = slow_developer
+    events, states = [], []
+    manager = make_manager(fake_openai, tmp_path / "ws", events, parallel_tests=True,
+                           checkpoint=str(tmp_path / "cp"))
+    store = manager._checkpoint_store
+    manager._event_listener = lambda event, m: states.append(dict(store.state))
+    manager.chat("两数之和")
+    saves = store.saves
+    manager.step()
+    manager.close()
+    # 并行步骤只在两边都完成后保存一次，检查点中代码和测试脚本都已就绪
+    assert store.saves == saves + 1
+    assert store.state["stage"] == "need_testing"
+    assert store.state["code"] and store.state["test_code"]
+    assert len(states) == 2 and all(s["stage"] == "need_testing" and s["code"] for s in states)
+
+    resumed = CodingManager.resume(str(tmp_path / "cp"), lambda t, m: None, lambda t, m: None, lambda e, m: None,
+                                   api_key="k")
+    assert resumed.get_stage() == INTERNAL_STAGE.need_testing and resumed.code == manager.code
+    resumed.close()
+
+
+def test_prefetch_never_runs_tests_in_background(fake_openai, tmp_path):
+    events = []
+    manager = make_manager(fake_openai, tmp_path, events, prefetch=True)
+    assert manager.chat("两数之和")
+    assert not manager.step()
+    assert not manager.step()
+    # 下一步是运行测试：不在后台执行生成的代码
+    assert manager.get_stage() == INTERNAL_STAGE.need_testing
+    assert manager._prefetched is None
+    time.sleep(0.2)
+    assert EVENT_CODE.testing_done not in [e for e, _, _ in events]
+    assert not manager.test_res
+    manager.close()
+
+
+@pytest.mark.parametrize("closing", ["close", "aclose"])
+def test_close_and_aclose_with_async_sessions(fake_openai, tmp_path, closing):
+    manager = make_manager(fake_openai, tmp_path, [], AsyncOpenAISession)
+    assert asyncio.run(manager.arun("两数之和")).status == "passed"
+    clients = [c for s in (manager._analyst, manager._developer, manager._tester) for c in s._http_clients]
+    # 异步会话同样可以同步关闭，私有客户端都会关闭
+    if closing == "close":
+        manager.close()
+    else:
+        asyncio.run(manager.aclose())
+    assert clients and all(c.is_closed for c in clients)
+
+
+def test_aclose_waits_for_prefetch(fake_openai, tmp_path):
+    fake_openai.script = slow_developer
+    manager = make_manager(fake_openai, tmp_path, [], prefetch=True)
+    assert manager.chat("两数之和")
+    asyncio.run(manager.aclose())
+    assert manager._prefetched is None and manager.code
+
+
+def test_history_prefix_is_stable_and_cache_hits_reported(fake_openai, tmp_path):
+    fake_openai.usage = {"prompt_tokens": 10, "completion_tokens": 8, "total_tokens": 18,
+                         "prompt_cache_hit_tokens": 6, "prompt_cache_miss_tokens": 4}
+    # 第一版代码有错，经过测试报告和修复两轮
+    fake_openai.script = lambda role, k, body: CODE.replace("a + b", "a - b") if (role, k) == ("developer", 1) \
+        else "<REPORT>\n结果不对" if (role, k) == ("tester", 2) else default_script(role, k, body)
+    manager = make_manager(fake_openai, tmp_path, [])
+    manager.chat("两数之和")
+    while not manager.step():
+        pass
+    manager.close()
+    assert manager.passed
+    # 同一角色的后一次请求以前一次请求和回答逐字节开头，命中服务商的前缀缓存
+    tester = [body["messages"] for role, body in fake_openai.requests if role == "tester"]
+    developer = [body["messages"] for role, body in fake_openai.requests if role == "developer"]
+    for turns in (tester, developer):
+        assert len(turns) >= 2
+        assert turns[1][:len(turns[0])] == turns[0]
+        assert turns[1][len(turns[0])]["role"] == "assistant"
+    assert manager.cache_report() == {"analyst": 0.6, "developer": 0.6, "tester": 0.6, "total": 0.6}
@@ -0,0 +1,80 @@
+import asyncio
+import pytest
+from pkg import OpenAISession, SlidingWindow, PinFirstTurn, SummarizeOlder
+
+TEN = lambda m: 10
+
+
+def conversation(turns: int):
+    """系统提示词 + turns 个完整回合 + 当前这条 user 消息，每条 10 token"""
+    messages = [{"role": "system", "content": "sys"}]
+    for i in range(turns):
+        messages += [{"role": "user", "content": f"q{i}"}, {"role": "assistant", "content": f"a{i}"}]
+    return messages + [{"role": "user", "content": "now"}]
+
+
+def contents(messages):
+    return [m["content"] for m in messages]
+
+
+def test_triggers_only_above_budget():
+    messages = conversation(5)
+    assert SlidingWindow(120, counter=TEN).compact(messages) is None
+    result = SlidingWindow(119, counter=TEN).compact(messages)
+    assert result is not None and result.tokens_before == 120 and result.tokens_after <= 119
+
+
+def test_sliding_window_keeps_system_prompt_and_newest_turns():
+    result = SlidingWindow(60, counter=TEN).compact(conversation(5))
+    assert contents(result.messages) == ["sys", "q3", "a3", "q4", "a4", "now"]
+    assert result.dropped == 6 and result.tokens_saved == 60
+    # 保留部分从 user 开始，user/assistant 交替不被破坏
+    assert [m["role"] for m in result.messages[1:]] == ["user", "assistant"] * 2 + ["user"]
+
+
+def test_pin_first_turn_keeps_the_first_turn():
+    result = PinFirstTurn(60, counter=TEN).compact(conversation(5))
+    assert contents(result.messages) == ["sys", "q0", "a0", "q4", "a4", "now"]
+
+
+def test_summarize_older_replaces_dropped_turns():
+    policy = SummarizeOlder(80, summary_tokens=20, counter=TEN)
+    result = policy.compact(conversation(5))
+    summary, ack = result.messages[1:3]
+    assert (summary["role"], ack["role"]) == ("user", "assistant")
+    assert all(f"q{i}" in summary["content"] for i in range(3))
+    assert contents(result.messages)[0] == "sys" and contents(result.messages)[3:] == ["q3", "a3", "q4", "a4", "now"]
+    assert result.tokens_after <= 80
+
+
+def test_current_message_is_kept_even_over_budget():
+    # 最后一个完整回合都放不下时也不丢当前这条 user 消息
+    result = SlidingWindow(25, counter=TEN).compact(conversation(3))
+    assert contents(result.messages) == ["sys", "now"]
+
+
+@pytest.mark.parametrize("budget, compacted_on", [(60, 4), (40, 3)])
+def test_session_compacts_at_threshold(fake_openai, session_cls, budget, compacted_on):
+    session = session_cls(api_key="k", base_url=fake_openai.url, model="m", capture_payloads=False,
+                          system_as_user=False, compaction=SlidingWindow(budget, counter=TEN))
+    session.set_sys_prompt("sys")
+    inputs = ["q1", "q2", "q3", "q4", "now"]
+    counts = []
+    if session_cls is OpenAISession:
+        with session:
+            for text in inputs:
+                session.send(text)
+                counts.append(session.compaction_stats["compactions"])
+    else:
+        async def run():
+            async with session:
+                for text in inputs:
+                    await session.send(text)
+                    counts.append(session.compaction_stats["compactions"])
+        asyncio.run(run())
+    # 第 n 次发送前历史为系统提示词 + 2(n-1) 条 + 当前消息，第一次超出预算时触发压缩
+    assert counts.index(1) == compacted_on - 1
+    last = contents(fake_openai.requests[-1][1]["messages"])
+    # 请求保留系统提示词和最近的回合，不超出预算
+    assert last[0] == "sys" and last[-1] == "now" and last[-3] == "q4"
+    assert len(last) * 10 <= budget
@@ -0,0 +1,46 @@
+from pkg import FenceParser, extract_code
+from conftest import CODE, default_script
+from test_coding_manager import make_manager
+
+ANSWER = "思路：直接相加。\n" + CODE + "\n说明：读入两个整数。\n"
+
+
+def test_fence_split_across_chunks_matches_extract_code():
+    expected = extract_code(ANSWER)
+    # 在任意两处切开，``` 和 python 标记都可能被拆到不同分块
+    for i in range(1, len(ANSWER)):
+        for j in range(i, len(ANSWER), 3):
+            found = []
+            parser = FenceParser(found.append)
+            results = [parser.feed(part) for part in (ANSWER[:i], ANSWER[i:j], ANSWER[j:])]
+            assert found == [expected], (i, j)
+            assert parser.code == expected
+            # 只在代码块结束的那一块返回代码，之后的分块被忽略
+            assert [r for r in results if r is not None] == [expected]
+
+
+def test_no_code_until_closing_fence():
+    parser = FenceParser()
+    for ch in CODE.rstrip("\n")[:-1]:
+        assert parser.feed(ch) is None
+    assert parser.feed("`") == extract_code(CODE)
+
+
+def test_stop_after_code_ends_stream_after_closing_fence(fake_openai, tmp_path):
+    tail = "\n" + "补充说明。" * 200 + "END"
+
+    def script(role, k, body):
+        return CODE + tail if role == "developer" else default_script(role, k, body)
+    fake_openai.script = script
+    fake_openai.pieces = len(CODE + tail) // 4
+    fake_openai.delay = 0.005
+    manager = make_manager(fake_openai, tmp_path, [], early_extract=True, stop_after_code=True)
+    manager.chat("两数之和")
+    while not manager.step():
+        pass
+    manager.close()
+    assert manager.passed and manager.code == extract_code(CODE)
+    # 代码块结束后不再等待剩余的说明文字，历史中保存已收到的部分
+    answer = manager._developer.history[-1]["content"]
+    assert answer.startswith(CODE.rstrip("\n")) and not answer.endswith("END")
+    assert len(answer) < len(CODE + tail) // 2
@@ -0,0 +1,77 @@
+import asyncio
+import pytest
+from pkg import OpenAISession, AsyncOpenAISession, HttpClientPool
+
+
+def echo(role, k, body):
+    return "answer to " + body["messages"][-1]["content"]
+
+
+def make(cls, url, pool):
+    # system_as_user=True（默认）时系统提示词是一条 user 消息，rewind 也不能撤销它
+    session = cls(api_key="k", base_url=url, model="m", http_pool=pool, capture_payloads=False)
+    session.set_sys_prompt("sys")
+    return session
+
+
+def contents(session):
+    return [m["content"] for m in session.history]
+
+
+def test_fork_history_is_independent(fake_openai):
+    fake_openai.script = echo
+    pool = HttpClientPool()
+    parent = make(OpenAISession, fake_openai.url, pool)
+    parent.send("one")
+    child = parent.fork()
+    parent.send("parent two")
+    child.send("child two")
+    assert contents(parent) == ["sys", "one", "answer to one", "parent two", "answer to parent two"]
+    assert contents(child) == ["sys", "one", "answer to one", "child two", "answer to child two"]
+    # 子会话的请求只包含共享前缀和它自己的消息
+    assert [m["content"] for m in fake_openai.requests[-1][1]["messages"]] == ["sys", "one", "answer to one", "child two"]
+
+    # 父会话撤销不影响子会话；子会话单独持有连接池引用
+    parent.rewind(2)
+    assert contents(parent) == ["sys"] and child.turns == 2
+    assert pool.stats()[f"sync:{fake_openai.url}"] == 2
+    child.close()
+    parent.close()
+    assert pool.stats()[f"sync:{fake_openai.url}"] == 0
+
+
+def test_async_fork_history_is_independent(fake_openai):
+    fake_openai.script = echo
+
+    async def run():
+        pool = HttpClientPool()
+        parent = make(AsyncOpenAISession, fake_openai.url, pool)
+        await parent.send("one")
+        child = parent.fork()
+        await asyncio.gather(parent.send("parent two"), child.send("child two"))
+        result = contents(parent), contents(child)
+        await child.aclose()
+        await parent.aclose()
+        return result
+
+    parent, child = asyncio.run(run())
+    assert parent[-2:] == ["parent two", "answer to parent two"]
+    assert child[-2:] == ["child two", "answer to child two"]
+    assert parent[:3] == child[:3] == ["sys", "one", "answer to one"]
+
+
+def test_rewind_keeps_system_prompt(fake_openai):
+    fake_openai.script = echo
+    with make(OpenAISession, fake_openai.url, HttpClientPool()) as session:
+        for text in ("one", "two", "three"):
+            session.send(text)
+        assert session.turns == 3
+        session.rewind()
+        assert contents(session)[-1] == "answer to two" and session.turns == 2
+        session.rewind(2)
+        # 系统提示词作为 user 消息发送，但不算一轮，不会被撤销
+        assert contents(session) == ["sys"] and session.turns == 0
+        with pytest.raises(ValueError):
+            session.rewind()
+        session.send("again")
+        assert [m["content"] for m in fake_openai.requests[-1][1]["messages"]] == ["sys", "again"]
@@ -0,0 +1,140 @@
+import time, asyncio, threading
+from types import SimpleNamespace
+import pytest
+from pkg import HedgePolicy
+from pkg.hedging import HedgedStream, AsyncHedgedStream
+
+
+def chunk(text):
+    return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text, reasoning_content=None))])
+
+
+def failing_primary(after):
+    def open_stream():
+        time.sleep(after)
+        raise ConnectionError("primary down")
+    return open_stream
+
+
+async def astream(texts):
+    for t in texts:
+        yield chunk(t)
+
+
+class _AsyncStream:
+    def __init__(self, texts):
+        self._it = astream(texts)
+
+    def __aiter__(self):
+        return self._it
+
+    async def close(self):
+        pass
+
+
+def test_primary_failure_records_censored_sample():
+    # 主请求在首 token 前失败，立即改用备用请求；失败时已等待的时间作为样本
+    policy = HedgePolicy(threshold=None, min_samples=100, default_threshold=5.0)
+    stream = HedgedStream(failing_primary(0.05), lambda: iter([chunk("a"), chunk("b")]), policy)
+    assert "".join(c.choices[0].delta.content for c in stream) == "ab"
+    stream.close()
+    deadline = time.perf_counter() + 1
+    while not policy.stats["censored"] and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    assert policy.stats["censored"] == 1 and policy.stats["hedged"] == 1
+    assert policy._samples[0] == pytest.approx(0.05, abs=0.04)
+
+
+def test_async_primary_cancelled_records_censored_sample():
+    policy = HedgePolicy(threshold=None, min_samples=1, default_threshold=0.01)
+
+    async def run():
+        async def slow_primary():
+            await asyncio.sleep(10)
+        async def secondary():
+            return _AsyncStream(["x"])
+        stream = AsyncHedgedStream(slow_primary, secondary, policy)
+        out = [c.choices[0].delta.content async for c in stream]
+        await stream.close()
+        await asyncio.sleep(0.01)
+        return out
+
+    assert asyncio.run(run()) == ["x"]
+    assert policy.stats["censored"] == 1 and len(policy._samples) == 1
+
+
+def test_primary_with_content_is_not_censored():
+    policy = HedgePolicy(threshold=5.0)
+    stream = HedgedStream(lambda: iter([chunk("a")]), lambda: iter([chunk("b")]), policy)
+    assert [c.choices[0].delta.content for c in stream] == ["a"]
+    stream.close()
+    assert policy.stats["censored"] == 0 and len(policy._samples) == 1
+
+
+class _SharedConnectionStream:
+    """模拟 HTTP/2 流：与其他流共用 sock，每 20ms 产出一个不带内容的分块，关闭后结束"""
+
+    def __init__(self, sock, texts=None):
+        self.response = SimpleNamespace(extensions={
+            "http_version": b"HTTP/2",
+            "network_stream": SimpleNamespace(get_extra_info=lambda name: sock)})
+        self.texts = texts
+        self.closed_by = None
+
+    def __iter__(self):
+        if self.texts is not None:
+            for t in self.texts:
+                time.sleep(0.02)
+                yield chunk(t)
+            return
+        while self.closed_by is None:
+            time.sleep(0.02)
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=None, reasoning_content=None))])
+
+    def close(self):
+        self.closed_by = threading.current_thread()
+
+
+def test_losing_primary_closed_at_once_without_touching_shared_connection():
+    sock = SimpleNamespace(shutdowns=0)
+    sock.shutdown = lambda how: setattr(sock, "shutdowns", sock.shutdowns + 1)
+    primary = _SharedConnectionStream(sock)
+    secondary = _SharedConnectionStream(sock, ["a", "b", "c"])
+    policy = HedgePolicy(threshold=0.05)
+    stream = HedgedStream(lambda: primary, lambda: secondary, policy)
+    # 备用请求胜出后主请求立即关闭，共用的连接没有被 shutdown，胜出一方完整输出
+    assert "".join(c.choices[0].delta.content for c in stream) == "abc"
+    deadline = time.perf_counter() + 1
+    while primary.closed_by is None and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    assert primary.closed_by is not None and primary.closed_by.name == "hedge-0"
+    stream.close()
+    assert sock.shutdowns == 0
+    assert policy.stats["secondary_wins"] == 1 and policy.stats["censored"] == 1
+
+
+def test_async_losing_primary_closed_at_once():
+    policy = HedgePolicy(threshold=0.05)
+
+    async def run():
+        async def stalled():
+            while True:
+                await asyncio.sleep(0.02)
+                yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=None, reasoning_content=None))])
+
+        primary = _AsyncStream([])
+        primary._it = stalled()
+        async def open_primary():
+            return primary
+        async def open_secondary():
+            return _AsyncStream(["x", "y"])
+        stream = AsyncHedgedStream(open_primary, open_secondary, policy)
+        out = [c.choices[0].delta.content async for c in stream]
+        await asyncio.sleep(0.01)
+        # 不需要等到 close()，胜负一分出来主请求就已结束
+        assert stream._tasks[0].done()
+        await stream.close()
+        return out
+
+    assert asyncio.run(run()) == ["x", "y"]
+    assert policy.stats["censored"] == 1
@@ -0,0 +1,69 @@
+import asyncio
+from pkg import AsyncOpenAISession, HttpClientPool
+from pkg.http_pool import default_pool
+
+
+def _send_once(url, pool=None):
+    async def run():
+        session = AsyncOpenAISession(api_key="k", base_url=url, model="m", http_pool=pool, capture_payloads=False)
+        try:
+            return await session.send("hi")
+        finally:
+            await session.aclose()
+    return asyncio.run(run())
+
+
+def test_default_pool_survives_second_event_loop(fake_openai):
+    # 每次 asyncio.run 都是新的事件循环，不能复用上一个循环的客户端
+    assert _send_once(fake_openai.url)["total_tokens"] == 18
+    assert _send_once(fake_openai.url)["total_tokens"] == 18
+    assert len(fake_openai.requests) == 2
+
+
+def test_async_clients_shared_within_loop_and_refcounted():
+    pool = HttpClientPool()
+
+    async def run():
+        a = pool.get_async("http://x/v1")
+        b = pool.get_async("http://x/v1/")
+        assert a is b
+        assert pool.stats()["async:http://x/v1"] == 2
+        assert not pool.release_async(a)
+        assert not pool.release_async(b)
+        return a
+
+    first = asyncio.run(run())
+    second = asyncio.run(run())
+    assert first is not second
+
+
+def test_client_created_outside_loop_is_private(fake_openai):
+    pool = HttpClientPool()
+    session = AsyncOpenAISession(api_key="k", base_url=fake_openai.url, model="m", http_pool=pool,
+                                 capture_payloads=False)
+    client = session._http_clients[0]
+    assert not pool._async_clients
+
+    async def run():
+        usage = await session.send("hi")
+        await session.aclose()
+        return usage
+
+    assert asyncio.run(run())["total_tokens"] == 18
+    assert client.is_closed
+
+
+def test_default_pool_is_process_wide():
+    assert default_pool() is default_pool()
+
+
+def test_async_session_sync_close(fake_openai):
+    # 与 OpenAISession 一样可以同步关闭，私有客户端也会关闭
+    pool = HttpClientPool()
+    session = AsyncOpenAISession(api_key="k", base_url=fake_openai.url, model="m", http_pool=pool,
+                                 capture_payloads=False)
+    client = session._http_clients[0]
+    assert asyncio.run(session.send("hi"))["total_tokens"] == 18
+    session.close()
+    session.close()
+    assert client.is_closed and not pool._async_refs
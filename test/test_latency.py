@@ -0,0 +1,87 @@
+import pytest
+from pkg import LatencyStats, Cassette, latency
+from pkg.latency import StreamTimer, LatencyRecord, percentile
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(latency.time, "perf_counter", clock)
+    return clock
+
+
+def record(role="r", model="m", ttft=0.1, wall=1.0, tokens=10, gaps=(0.1,)):
+    return LatencyRecord(role, model, "u", 0.05, None, ttft, list(gaps), tokens, wall, wall - ttft, len(gaps) + 1, 1)
+
+
+def test_stream_timer_measures_from_send_start_across_retries(clock):
+    timer = StreamTimer()
+    clock.now += 1.0                    # 第一次尝试失败、退避等待
+    timer.attempt()
+    clock.now += 0.2
+    timer.connected()
+    clock.now += 0.3
+    timer.chunk("think")
+    clock.now += 0.1
+    timer.chunk("resp")
+    clock.now += 0.4
+    timer.chunk("resp")
+    clock.now += 0.2
+    rec = timer.finish("developer", "m", "u", completion_tokens=12)
+    # 首 token 相对 send 开始（包含重试等待），connect 只算最后一次尝试
+    assert rec.connect == pytest.approx(0.2)
+    assert rec.ttft_think == pytest.approx(1.5) and rec.ttft_resp == pytest.approx(1.6) and rec.ttft == rec.ttft_think
+    assert timer.attempt_ttft == pytest.approx(0.5)
+    assert rec.gap_max == pytest.approx(0.4) and rec.chunks == 3 and rec.attempts == 1
+    assert rec.wall == pytest.approx(2.2)
+    assert rec.tokens_per_sec == pytest.approx(12 / 0.7)
+
+
+def test_percentile_is_nearest_rank():
+    values = [float(i) for i in range(1, 101)]
+    assert percentile(values, 50) == 50.0 and percentile(values, 95) == 95.0
+    assert percentile([3.0], 95) == 3.0 and percentile([], 50) == 0.0
+
+
+def test_stats_group_by_role_and_model_and_keep_recent():
+    stats = LatencyStats(max_records=3)
+    for i in range(5):
+        stats.add(record(ttft=0.1 * (i + 1), wall=float(i + 1)))
+    stats.add(record(role="tester", model="x", ttft=0.5, tokens=20, wall=2.5))
+    summary = stats.summary()
+    assert set(summary) == {"r/m", "tester/x"}
+    # 每组只保留最近 max_records 条
+    assert summary["r/m"]["requests"] == 3 and summary["r/m"]["wall_p50"] == 4.0
+    assert summary["r/m"]["ttft_p95"] == pytest.approx(0.5)
+    assert summary["tester/x"]["tokens_per_sec"] == pytest.approx(20 / 2.0)
+    assert len(stats.records()) == 4
+    stats.clear()
+    assert stats.summary() == {}
+
+
+def test_session_records_latency_only_for_network_requests(send, fake_openai, session_cls, tmp_path):
+    fake_openai.script = lambda role, k, body: "abcdefgh"
+    fake_openai.delay = 0.05
+    seen = []
+    shared = LatencyStats()
+    path = str(tmp_path / "tape.jsonl")
+    _, session = send(session_cls, fake_openai.url, "hi", role="developer", latency_stats=shared,
+                      on_latency=seen.append, cassette=Cassette(path, mode="record"))
+    rec = session.last_latency
+    assert seen == [rec] and shared.records() == [rec]
+    assert rec.role == "developer" and rec.ttft >= 0.05 and rec.chunks == fake_openai.pieces
+    assert rec.wall >= rec.ttft and rec.completion_tokens == fake_openai.usage["completion_tokens"]
+
+    # 回放不产生延迟记录
+    _, replayed = send(session_cls, fake_openai.url, "hi", role="developer", latency_stats=shared,
+                       on_latency=seen.append, cassette=Cassette(path, mode="replay"))
+    assert replayed.last_latency is None and len(seen) == 1
+    assert shared.summary()["developer/m"]["requests"] == 1
@@ -0,0 +1,64 @@
+import copy, json
+import pytest
+from pkg import MessageLog, message_log
+from pkg.transcript_store import message_hash
+
+
+def msg(i, role="user"):
+    return {"role": role, "content": f"m{i}"}
+
+
+def test_snapshot_is_unaffected_by_later_changes():
+    log = MessageLog([msg(0), msg(1, "assistant")])
+    snap = log.snapshot()
+    log.append(msg(2))
+    assert len(snap) == 2 and len(log) == 3
+    log.truncate(1)
+    log.append(msg(3))
+    assert snap == [msg(0), msg(1, "assistant")]
+    assert log == [msg(0), msg(3)]
+
+
+def test_snapshots_share_messages_without_copying():
+    log = MessageLog([msg(0)])
+    first = log.snapshot()
+    log.append(msg(1))
+    second = log.snapshot()
+    # 同一条消息在所有快照中是同一个对象
+    assert first[0] is second[0] is log[0]
+    assert copy.deepcopy(second)[1] is second[1]
+    with pytest.raises(TypeError):
+        second[0]["content"] = "x"
+    # 没有追加时重复取快照得到同一个对象
+    assert log.snapshot() is second
+
+
+def test_forks_from_snapshot_share_prefix_and_stay_independent():
+    base = MessageLog([msg(0), msg(1, "assistant")])
+    snap = base.snapshot()
+    left, right = MessageLog.from_snapshot(snap), MessageLog.from_snapshot(snap)
+    left.append(msg(2))
+    right.append(msg(3))
+    base.append(msg(4))
+    assert [m["content"] for m in left] == ["m0", "m1", "m2"]
+    assert [m["content"] for m in right] == ["m0", "m1", "m3"]
+    assert [m["content"] for m in base] == ["m0", "m1", "m4"]
+    assert left[0] is right[0] is base[0]
+    right.truncate(1)
+    assert [m["content"] for m in left] == ["m0", "m1", "m2"] and len(right) == 1
+
+
+def test_serializes_each_message_once(monkeypatch):
+    log = MessageLog([msg(0), {"role": "assistant", "content": "中文", "name": "x"}])
+    snap = log.snapshot()
+    assert json.loads(snap.to_json()) == snap.to_list()
+    assert snap.hashes() == [message_hash(m) for m in snap.to_list()]
+
+    # 消息在追加时已编码，之后生成 JSON 和哈希都不再序列化
+    def dumps(*args, **kwargs):
+        raise AssertionError("重复序列化")
+    monkeypatch.setattr(message_log.json, "dumps", dumps)
+    again = MessageLog.from_snapshot(snap).snapshot()
+    assert again.to_json() == snap.to_json()
+    assert snap.to_json() is snap.to_json()
+    assert again.hashes() == snap.hashes()
@@ -0,0 +1,79 @@
+import gzip, json, time, threading
+from pkg import PayloadWriter
+
+
+def stalled(writer):
+    """让后台线程卡在第一个请求体上，返回放行用的 Event"""
+    gate = threading.Event()
+    write = writer._write
+
+    def _write(*item):
+        gate.wait()
+        write(*item)
+    writer._write = _write
+    return gate
+
+
+def wait_taken(writer):
+    # 等后台线程取走第一个请求体
+    deadline = time.monotonic() + 2
+    while not writer._queue.empty() and time.monotonic() < deadline:
+        time.sleep(0.005)
+
+
+def test_drop_policy_never_blocks(tmp_path):
+    writer = PayloadWriter(str(tmp_path), max_queue=2)
+    gate = stalled(writer)
+    assert writer.submit({"i": 0})
+    wait_taken(writer)
+    assert writer.submit({"i": 1}) and writer.submit({"i": 2})
+    start = time.perf_counter()
+    assert not writer.submit({"i": 3})
+    assert time.perf_counter() - start < 0.05
+    gate.set()
+    writer.close()
+    assert writer.stats()["written"] == 3 and writer.stats()["dropped"] == 1
+
+
+def test_block_policy_waits_for_room(tmp_path):
+    writer = PayloadWriter(str(tmp_path), max_queue=1, policy="block")
+    gate = stalled(writer)
+    writer.submit({"i": 0})
+    wait_taken(writer)
+    writer.submit({"i": 1})
+    late = threading.Thread(target=writer.submit, args=({"i": 2},))
+    late.start()
+    late.join(0.1)
+    assert late.is_alive()
+    gate.set()
+    late.join(2)
+    writer.close()
+    assert not late.is_alive()
+    assert writer.stats()["written"] == 3 and writer.stats()["dropped"] == 0
+
+
+def test_rotation_by_file_count_keeps_newest(tmp_path):
+    writer = PayloadWriter(str(tmp_path), max_files=3, max_bytes=None)
+    for i in range(5):
+        writer.submit({"i": i})
+    writer.close()
+    kept = sorted(tmp_path.iterdir())
+    assert len(kept) == 3 and writer.stats()["files"] == 3
+    assert [json.loads(p.read_text())["i"] for p in kept] == [2, 3, 4]
+
+
+def test_rotation_by_total_bytes_counts_existing_files(tmp_path):
+    first = PayloadWriter(str(tmp_path), max_files=None, compression="gzip")
+    first.submit({"i": 0, "pad": "x" * 100})
+    first.close()
+    size = first.stats()["bytes"]
+    assert json.loads(gzip.decompress(next(tmp_path.iterdir()).read_bytes()))["i"] == 0
+
+    # 新的 writer 启动时登记已有文件，轮转时一并计入
+    writer = PayloadWriter(str(tmp_path), max_files=None, max_bytes=int(size * 2.5), compression="gzip")
+    for i in range(1, 4):
+        writer.submit({"i": i, "pad": "x" * 100})
+    writer.close()
+    kept = sorted(tmp_path.iterdir())
+    assert len(kept) == 2 and writer.stats()["bytes"] <= size * 2.5
+    assert [json.loads(gzip.decompress(p.read_bytes()))["i"] for p in kept] == [2, 3]
@@ -0,0 +1,33 @@
+import pytest
+from pkg import ProviderPool, Endpoint
+from pkg.retry import RetryPolicy
+
+
+def test_bad_request_does_not_eject_endpoint(fake_openai, session_cls, send):
+    # 400 是请求本身的问题，换哪个端点都一样，不能把端点摘除
+    fake_openai.script = lambda role, k, body: 400
+    pool = ProviderPool([Endpoint(fake_openai.url, "k")], max_failures=1)
+    for _ in range(3):
+        with pytest.raises(RuntimeError):
+            send(session_cls, "", provider_pool=pool, retry_policy=RetryPolicy(max_retries=0))
+    ep = pool.endpoints[0]
+    assert ep.failures == 0 and ep.ejected_until == 0.0 and not ep.results
+    assert ep.in_flight == 0
+
+
+def test_server_error_ejects_endpoint(fake_openai, session_cls, send):
+    fake_openai.script = lambda role, k, body: 503
+    pool = ProviderPool([Endpoint(fake_openai.url, "k")], max_failures=1)
+    with pytest.raises(RuntimeError):
+        send(session_cls, "", provider_pool=pool, retry_policy=RetryPolicy(max_retries=0))
+    ep = pool.endpoints[0]
+    assert ep.results[-1] is False and ep.ejected_until > 0
+
+
+def test_failover_to_healthy_endpoint(fake_openai, session_cls, send):
+    # 第一个端点的请求返回 500，第二个正常
+    fake_openai.script = lambda role, k, body: 500 if body["model"] == "bad" else "ok"
+    pool = ProviderPool([Endpoint(fake_openai.url, "k", model="bad", weight=10), Endpoint(fake_openai.url, "k2", model="good")])
+    usage, session = send(session_cls, "", provider_pool=pool, retry_policy=RetryPolicy(max_retries=1))
+    assert session.history[-1]["content"] == "ok"
+    assert pool.endpoints[0].results[-1] is False and pool.endpoints[1].results[-1] is True
@@ -0,0 +1,23 @@
+import pytest
+from pkg import RateLimiter
+from pkg.retry import RetryPolicy
+
+
+def test_failed_permit_refunds_reservation():
+    limiter = RateLimiter(tpm=1000)
+    limiter.acquire(600).release(ok=False)
+    assert limiter.stats()["tpm_available"] == pytest.approx(1000, abs=1)
+    limiter.acquire(600).release(tokens_used=100)
+    assert limiter.stats()["tpm_available"] == pytest.approx(900, abs=1)
+
+
+def test_failed_requests_do_not_drain_tpm(fake_openai, session_cls, send):
+    fake_openai.script = lambda role, k, body: 400
+    limiter = RateLimiter(tpm=100000)
+    for _ in range(3):
+        with pytest.raises(RuntimeError):
+            send(session_cls, fake_openai.url, rate_limiter=limiter, max_tokens=8192,
+                 retry_policy=RetryPolicy(max_retries=0))
+    stats = limiter.stats()
+    assert stats["tpm_available"] == pytest.approx(100000, abs=10)
+    assert stats["in_flight"] == 0
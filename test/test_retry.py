@@ -0,0 +1,114 @@
+import asyncio
+import httpx, openai
+import pytest
+from pkg import OpenAISession
+from pkg.retry import RetryPolicy, PartialStream
+from conftest import Drop
+
+FAST = dict(base_delay=0.01, max_delay=0.05)
+
+
+def run_turns(cls, url, inputs, setup=None, **kwargs):
+    """在同一个会话中依次发送 inputs，返回 (每轮的结果或异常, 会话)"""
+    kwargs.setdefault("capture_payloads", False)
+    results = []
+
+    def make():
+        session = cls(api_key="k", base_url=url, model="m", **kwargs)
+        session.set_sys_prompt("sys")
+        if setup is not None:
+            setup(session)
+        return session
+
+    def record(send, text):
+        try:
+            results.append(send(text))
+        except Exception as e:
+            results.append(e)
+
+    if cls is OpenAISession:
+        with make() as session:
+            for text in inputs:
+                record(session.send, text)
+        return results, session
+
+    async def run():
+        async with make() as session:
+            for text in inputs:
+                try:
+                    results.append(await session.send(text))
+                except Exception as e:
+                    results.append(e)
+        return session
+    return results, asyncio.run(run())
+
+
+@pytest.mark.parametrize("status", [429, 503])
+def test_transient_status_then_success(fake_openai, session_cls, status):
+    fake_openai.script = lambda role, k, body: status if k == 1 else "ok"
+    retries = []
+    results, session = run_turns(session_cls, fake_openai.url, ["hi"], retry_policy=RetryPolicy(**FAST),
+                                 on_retry=lambda attempt, e, delay: retries.append((attempt, delay)))
+    assert results[0]["total_tokens"] == 18
+    assert len(fake_openai.requests) == 2 and len(retries) == 1 and retries[0][0] == 1
+    assert session.retry_stats["retries"] == 1 and session.retry_stats["reasons"] == {str(status): 1}
+    assert [m["role"] for m in session.history][-2:] == ["user", "assistant"]
+
+
+def test_bad_request_is_not_retried(fake_openai, session_cls):
+    fake_openai.script = lambda role, k, body: 400
+    results, session = run_turns(session_cls, fake_openai.url, ["hi"], retry_policy=RetryPolicy(**FAST))
+    assert isinstance(results[0], RuntimeError) and len(fake_openai.requests) == 1
+    assert session.retry_stats["retries"] == 0 and session.retry_stats["failures"] == 1
+
+
+def test_mid_stream_drop_continues_without_repeating(fake_openai, session_cls):
+    # 第一次输出 "hello " 后断线，重试得到完整回答；已输出的前缀不再推给回调
+    fake_openai.script = lambda role, k, body: Drop("hello ") if k == 1 else "hello world"
+    fake_openai.pieces = 2
+    shown = []
+    results, session = run_turns(session_cls, fake_openai.url, ["hi"], retry_policy=RetryPolicy(**FAST),
+                                 setup=lambda s: s.subscribe(shown.append, kind="resp", granularity="chunk"))
+    assert results[0]["total_tokens"] == 18
+    assert session.history[-1]["content"] == "hello world"
+    assert "".join(shown) == "hello world"
+    assert session.retry_stats["retries"] == 1 and len(fake_openai.requests) == 2
+
+
+def test_retries_exhausted_restore_history(fake_openai, session_cls):
+    fake_openai.script = lambda role, k, body: "first answer" if k == 1 else 503 if k <= 4 else "second answer"
+    results, session = run_turns(session_cls, fake_openai.url, ["one", "two", "three"],
+                                 retry_policy=RetryPolicy(max_retries=2, **FAST))
+    # 第二轮重试 2 次后失败，历史回退到第一轮结束时，第三轮照常进行
+    assert isinstance(results[1], RuntimeError) and results[2]["total_tokens"] == 18
+    assert len(fake_openai.requests) == 5
+    assert [m["content"] for m in session.history] == ["sys", "one", "first answer", "three", "second answer"]
+    assert [m["content"] for m in fake_openai.requests[-1][1]["messages"]] == ["sys", "one", "first answer", "three"]
+    assert session.retry_stats["failures"] == 1 and session.retry_stats["retries"] == 2
+
+
+def test_backoff_and_retry_after():
+    policy = RetryPolicy(base_delay=1.0, max_delay=5.0, jitter=0.0)
+    assert [policy.delay(i) for i in range(4)] == [1.0, 2.0, 4.0, 5.0]
+    jittered = RetryPolicy(base_delay=1.0, jitter=0.5)
+    assert all(0.5 <= jittered.delay(0) <= 1.0 for _ in range(20))
+
+    request = httpx.Request("POST", "http://x/v1/chat/completions")
+    limited = openai.RateLimitError("slow down", response=httpx.Response(429, headers={"retry-after": "3"},
+                                                                          request=request), body=None)
+    assert policy.is_retryable(limited) and policy.delay(0, limited) == 3.0
+    bad = openai.BadRequestError("bad", response=httpx.Response(400, request=request), body=None)
+    assert not policy.is_retryable(bad)
+    assert policy.is_retryable(httpx.ReadError("reset"))
+
+
+def test_partial_stream_skips_repeated_prefix():
+    partial = PartialStream()
+    assert partial.feed("resp", "hello ") == "hello "
+    partial.restart()
+    assert partial.feed("resp", "hel") == ""
+    assert partial.feed("resp", "lo wor") == "wor"
+    assert partial.feed("resp", "ld") == "ld"
+    # 内容不一致时照常输出
+    partial.restart()
+    assert partial.feed("resp", "goodbye") == "goodbye" and partial.diverged
@@ -0,0 +1,88 @@
+import time, asyncio, functools
+import pytest
+from pkg import ResponseCache, AsyncOpenAISession
+from pkg import session_core
+from pkg.dispatcher import StreamDispatcher
+
+
+def test_send_appends_history(fake_openai, session_cls, send):
+    fake_openai.script = lambda role, k, body: "hello world"
+    usage, session = send(session_cls, fake_openai.url)
+    assert usage["total_tokens"] == 18
+    assert session.history[-1] == {"role": "assistant", "content": "hello world"}
+
+
+def test_subscribe_and_coalesce(fake_openai, session_cls, send):
+    fake_openai.script = lambda role, k, body: "line 1\nline 2\n"
+    lines, chunks = [], []
+    send(session_cls, fake_openai.url, coalesce_interval=0.01,
+         setup=lambda s: s.subscribe(lines.append, kind="resp", granularity="line"))
+    assert "".join(lines) == "line 1\nline 2\n"
+    send(session_cls, fake_openai.url, setup=lambda s: s.subscribe(chunks.append, granularity="chunk"))
+    assert "".join(chunks) == "line 1\nline 2\n"
+
+
+def test_cache_replay_skips_request(fake_openai, session_cls, send, tmp_path):
+    cache = ResponseCache(str(tmp_path / "cache.sqlite3"))
+    fake_openai.script = lambda role, k, body: "cached answer"
+    send(session_cls, fake_openai.url, cache=cache)
+    usage, session = send(session_cls, fake_openai.url, cache=cache)
+    assert len(fake_openai.requests) == 1
+    assert session.history[-1]["content"] == "cached answer"
+    assert usage["total_tokens"] == 18
+
+
+def test_async_cancel_rolls_back_history(fake_openai):
+    # 外部取消（如 arun 的阶段超时）后会话仍可使用，历史中不留下没有回答的用户消息
+    fake_openai.script = lambda role, k, body: "x" * 40
+    fake_openai.pieces = 20
+
+    async def run():
+        async with AsyncOpenAISession(api_key="k", base_url=fake_openai.url, model="m",
+                                      system_as_user=False, capture_payloads=False) as session:
+            session.set_sys_prompt("sys")
+            fake_openai.delay = 0.05
+            with pytest.raises(asyncio.TimeoutError):
+                await asyncio.wait_for(session.send("first"), 0.2)
+            assert [m["role"] for m in session.history] == ["system"]
+            fake_openai.delay = 0.0
+            await session.send("second")
+            return [m["role"] for m in session.history], fake_openai.requests[-1][1]["messages"]
+
+    roles, sent = asyncio.run(run())
+    assert roles == ["system", "user", "assistant"]
+    assert [m["content"] for m in sent] == ["sys", "second"]
+
+
+def test_async_slow_subscriber_does_not_block_event_loop(fake_openai, monkeypatch):
+    fake_openai.script = lambda role, k, body: "".join(f"{i}\n" for i in range(40))
+    fake_openai.pieces = 40
+    monkeypatch.setattr(session_core, "StreamDispatcher", functools.partial(StreamDispatcher, max_queue=1))
+    received = []
+
+    def slow(text):
+        time.sleep(0.05)
+        received.append(text)
+
+    async def run():
+        gaps = []
+
+        async def ticker():
+            last = time.perf_counter()
+            while True:
+                await asyncio.sleep(0.005)
+                now = time.perf_counter()
+                gaps.append(now - last)
+                last = now
+
+        tick = asyncio.ensure_future(ticker())
+        async with AsyncOpenAISession(api_key="k", base_url=fake_openai.url, model="m", capture_payloads=False,
+                                      coalesce_interval=0.0) as session:
+            session.subscribe(slow, granularity="chunk")
+            await session.send("hi")
+        tick.cancel()
+        return max(gaps)
+
+    # 投递队列满时读取方等待背压，但不占用事件循环线程
+    assert asyncio.run(run()) < 0.04
+    assert "".join(received) == fake_openai.script(None, 0, None)
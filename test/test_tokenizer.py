@@ -0,0 +1,31 @@
+import pytest
+from pkg import OpenAISession, MessageLog
+from pkg.tokenizer import TokenizerService, PromptTooLarge, context_window_for
+
+
+@pytest.mark.parametrize("model", ["deepseek-v3", "deepseek-r1", "deepseek-v3-0324", "deepseek-chat"])
+def test_deepseek_models_have_context_window(model):
+    assert context_window_for(model) == 65536
+
+
+def test_history_counting_is_incremental():
+    service = TokenizerService()
+    history = MessageLog([{"role": "user", "content": "你好" * 10}, {"role": "assistant", "content": "hello " * 10}])
+    first = service.count_messages(history)
+    history.append({"role": "user", "content": "再来一次"})
+    assert service.count_messages(history) > first
+    assert service.misses == 3 and service.hits == 2
+
+
+def test_preflight_refuses_and_sizes_max_tokens(fake_openai):
+    session = OpenAISession(api_key="k", base_url=fake_openai.url, model="deepseek-v3", max_tokens=8192,
+                            capture_payloads=False)
+    # 超出上下文长度时不发请求，历史也不留下这条消息
+    with pytest.raises(PromptTooLarge):
+        session.send("字" * 70000)
+    assert not fake_openai.requests and len(session.history) == 0
+
+    # 剩余空间不足 max_tokens 时自动调小
+    session.send("字" * 60000)
+    assert fake_openai.requests[-1][1]["max_tokens"] < 8192
+    session.close()
@@ -0,0 +1,41 @@
+from pkg.transcript_store import TranscriptStore, TranscriptReader, segments
+
+
+def payload(i):
+    return {"model": "m", "messages": [{"role": "system", "content": "sys"},
+                                       {"role": "user", "content": f"question {i} " + "x" * 200}]}
+
+
+def test_messages_written_once(tmp_path):
+    store = TranscriptStore(str(tmp_path))
+    for i in range(3):
+        store.record({"model": "m", "messages": payload(0)["messages"][:1] + [{"role": "user", "content": str(i)}]})
+    assert store.stats()["new_messages"] == 4 and store.stats()["reused_messages"] == 2
+    assert TranscriptReader(str(tmp_path)).payload(-1)["messages"][-1]["content"] == "2"
+
+
+def test_segments_rotate_and_stay_bounded(tmp_path):
+    store = TranscriptStore(str(tmp_path), segment_bytes=2000, max_segments=2)
+    for i in range(50):
+        store.record(payload(i))
+    # 目录大小有上限：只保留最近 2 段和当前段
+    assert store.rotations > 2 and len(segments(tmp_path)) == 2
+    total = sum(p.stat().st_size for p in tmp_path.iterdir())
+    assert total < 2000 * 3 + 1000
+
+    # 每段自带它引用的消息，保留下来的请求都能完整还原
+    reader = TranscriptReader(str(tmp_path))
+    assert 0 < len(reader) < 50
+    assert reader.payload(-1) == payload(49)
+    assert all(p["messages"][0]["content"] == "sys" for p in reader)
+
+
+def test_rotation_resumes_numbering(tmp_path):
+    store = TranscriptStore(str(tmp_path), segment_bytes=500, max_segments=5)
+    for i in range(3):
+        store.record(payload(i))
+    store = TranscriptStore(str(tmp_path), segment_bytes=500, max_segments=5)
+    store.record(payload(3))
+    names = [reqs.name for _, reqs in segments(tmp_path)]
+    assert names == sorted(names) and len(names) == len(set(names)) == 4
+    assert TranscriptReader(str(tmp_path)).payload(-1) == payload(3)
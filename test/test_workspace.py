@@ -0,0 +1,66 @@
+import os, asyncio
+import pytest
+from pkg import AsyncOpenAISession, CodingManager, Workspace
+from pkg.workspace import tmpfs_dir
+from conftest import TEST, default_script
+
+# 测试脚本额外输出自己的工作目录
+CWD_TEST = TEST.replace("print(r.stdout)", "print(r.stdout)\nimport os; print('CWD=' + os.getcwd())")
+
+
+def make(srv, workspace):
+    def session():
+        return AsyncOpenAISession(api_key="k", base_url=srv.url, model="m", capture_payloads=False)
+    return CodingManager(session(), session(), session(), lambda t, m: None, lambda t, m: None, lambda e, m: None,
+                         workspace=workspace)
+
+
+def test_concurrent_managers_run_in_their_own_workspaces(fake_openai, tmp_path, monkeypatch):
+    fake_openai.script = lambda role, k, body: CWD_TEST if role == "tester" else default_script(role, k, body)
+    monkeypatch.chdir(tmp_path)
+    workspaces = [Workspace(base_dir=str(tmp_path / "runs"), keep="always") for _ in range(3)]
+
+    async def run():
+        managers = [make(fake_openai, ws) for ws in workspaces]
+        results = await asyncio.gather(*(m.arun("两数之和") for m in managers))
+        for m in managers:
+            await m.aclose()
+        return managers, results
+
+    managers, results = asyncio.run(run())
+    assert len({str(ws.root) for ws in workspaces}) == 3
+    for manager, result, ws in zip(managers, results, workspaces):
+        assert result.status == "passed" and result.workspace == str(ws.root)
+        assert (ws.root / "solution.py").exists() and (ws.root / "test_solution.py").exists()
+        # 测试子进程以各自的工作目录为 cwd
+        assert f"CWD={os.path.realpath(ws.root)}" in manager.test_res
+    # 进程的当前目录不受影响，也不会写入任何文件
+    assert os.getcwd() == str(tmp_path) and not (tmp_path / "solution.py").exists()
+
+
+@pytest.mark.parametrize("keep, passed, removed", [
+    ("never", False, True), ("on_failure", True, True), ("on_failure", False, False), ("always", True, False),
+])
+def test_cleanup_follows_keep_policy(tmp_path, keep, passed, removed):
+    ws = Workspace(base_dir=str(tmp_path), keep=keep)
+    (ws.root / "solution.py").write_text("print(1)\n")
+    assert ws.owned and ws.root.parent == tmp_path
+    assert ws.cleanup(passed) is removed
+    assert ws.root.exists() is not removed
+
+
+def test_given_directory_is_never_removed(tmp_path):
+    ws = Workspace(str(tmp_path / "mine"), keep="never")
+    assert ws.root.is_dir() and not ws.owned
+    assert not ws.cleanup(passed=True) and ws.root.exists()
+    assert ws.path("solution.py") == str(tmp_path / "mine" / "solution.py")
+
+
+@pytest.mark.skipif(tmpfs_dir() is None, reason="没有可写的 /dev/shm")
+def test_tmpfs_workspace_lives_in_memory():
+    ws = Workspace(tmpfs=True, keep="never")
+    try:
+        assert str(ws.root).startswith(tmpfs_dir())
+    finally:
+        ws.cleanup()
+    assert ws.removed and not ws.root.exists()